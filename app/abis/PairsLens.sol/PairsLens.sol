@@ -0,0 +1,87 @@
+// SPDX-License-Identifier: MIT
+pragma solidity ^0.8.13;
+
+// Read-only lens, never deployed: its runtime bytecode is sent in the
+// `eth_call` state override, see `app/chain/lens.py`.
+//
+// Compile with `solc --optimize --bin-runtime PairsLens.sol` and set the
+// `LENS_BYTECODE` env var to the result.
+
+interface IPair {
+    function getReserves() external view returns (uint256, uint256, uint256);
+
+    function token0() external view returns (address);
+
+    function token1() external view returns (address);
+
+    function totalSupply() external view returns (uint256);
+
+    function stable() external view returns (bool);
+}
+
+interface IVoter {
+    function gauges(address pair) external view returns (address);
+
+    function external_bribes(address gauge) external view returns (address);
+
+    function internal_bribes(address gauge) external view returns (address);
+
+    function isAlive(address gauge) external view returns (bool);
+}
+
+interface IGauge {
+    function totalSupply() external view returns (uint256);
+
+    function rewardRate(address token) external view returns (uint256);
+}
+
+contract PairsLens {
+    // The layout is decoded by `PairsLens.SIGNATURE`, keep them in sync
+    struct PairState {
+        address pair;
+        uint256 reserve0;
+        uint256 reserve1;
+        address token0;
+        address token1;
+        uint256 totalSupply;
+        bool stable;
+        address gauge;
+        uint256 gaugeTotalSupply;
+        uint256 rewardRate;
+        address externalBribe;
+        address internalBribe;
+        bool isAlive;
+    }
+
+    function pairs(
+        address voter,
+        address rewardToken,
+        address[] calldata addresses
+    ) external view returns (PairState[] memory states) {
+        states = new PairState[](addresses.length);
+
+        for (uint256 i = 0; i < addresses.length; i++) {
+            PairState memory state = states[i];
+            IPair pair = IPair(addresses[i]);
+
+            state.pair = address(pair);
+            (state.reserve0, state.reserve1, ) = pair.getReserves();
+            state.token0 = pair.token0();
+            state.token1 = pair.token1();
+            state.totalSupply = pair.totalSupply();
+            state.stable = pair.stable();
+            state.gauge = IVoter(voter).gauges(address(pair));
+
+            if (state.gauge == address(0)) {
+                continue;
+            }
+
+            IGauge gauge = IGauge(state.gauge);
+            state.gaugeTotalSupply = gauge.totalSupply();
+            state.rewardRate = gauge.rewardRate(rewardToken);
+            state.externalBribe = IVoter(voter).external_bribes(state.gauge);
+            state.internalBribe = IVoter(voter).internal_bribes(state.gauge);
+            state.isAlive = IVoter(voter).isAlive(state.gauge);
+        }
+    }
+}
@@ -5,7 +5,8 @@ import json
 import falcon
 
 from app.misc import JSONEncoder
-from app.settings import CACHE, LOGGER, TOKEN_CACHE_EXPIRATION
+from app.settings import LOGGER, TOKEN_CACHE_EXPIRATION
+from app.sync import Snapshots
 
 from .model import Token
 
@@ -23,11 +24,11 @@ class Assets(object):
             tok._data for tok in Tokens if tok._data["logoURI"] is not None
         ]
 
-        CACHE.set(
-            "assets:json",
+        Snapshots.set(
+            cls.CACHE_KEY,
             json.dumps(dict(data=serializable_tokens), cls=JSONEncoder),
+            ttl=TOKEN_CACHE_EXPIRATION,
         )
-        CACHE.expire("assets:json", TOKEN_CACHE_EXPIRATION)
 
     @staticmethod
     def serialize():
@@ -61,16 +62,23 @@ class Assets(object):
 
         tokens = json.dumps(dict(data=cls.serialize()), cls=JSONEncoder)
 
-        CACHE.set(cls.CACHE_KEY, tokens)
+        Snapshots.set(cls.CACHE_KEY, tokens)
         LOGGER.debug("Cache updated for %s.", cls.CACHE_KEY)
 
         return tokens
 
     def on_get(self, req, resp):
         """Caches and returns our assets"""
-        assets = CACHE.get(self.CACHE_KEY)
+        generation = Snapshots.generation(self.CACHE_KEY)
+        if generation is not None and req.if_none_match:
+            if any(tag == str(generation) for tag in req.if_none_match):
+                resp.status = falcon.HTTP_304
+                return
+
+        assets = Snapshots.get(self.CACHE_KEY)
         if assets:
             resp.status = falcon.HTTP_200
+            resp.etag = str(generation)
         else:
             LOGGER.warning("Assets not found in cache!")
             assets = Assets.recache()
@@ -5,13 +5,15 @@ from statistics import mean, stdev
 from typing import Dict, Union
 
 import requests
-from multicall import Call, Multicall
+from multicall import Call
 from walrus import BooleanField, FloatField, IntegerField, Model, TextField
-from web3.auto import w3
 from web3.exceptions import ContractLogicError
 
+from app.chain import CallPlan, PairIndex, read, w3
 from app.misc import ModelUteis
+from app.sessions import HTTP
 from app.settings import (
+    ASSETS_SYNC_SECONDS,
     BRIBED_DEFAULT_TOKEN_ADDRESS,
     CACHE,
     DEFAULT_TOKEN_ADDRESS,
@@ -24,6 +26,9 @@ from app.settings import (
     STABLE_TOKEN_ADDRESS,
     TOKENLISTS,
 )
+from app.sync import Checkpoint, Deadline, bind_context
+
+from .prices import ExternalPriceCache, ExternalPrices, PriceGraph
 
 DEXSCREENER_ENDPOINT = "https://api.dexscreener.com/latest/dex/tokens/"
 DEFILLAMA_ENDPOINT = "https://coins.llama.fi/prices/current/"
@@ -32,6 +37,12 @@ DEBANK_ENDPOINT = "https://api.debank.com/history/token_price?chain=kava&"
 
 MAX_RETRIES = 0
 
+# Most tokens asked at once, per request
+DEXSCREENER_BATCH = 30
+# Most pairs answered at once, per request
+DEXSCREENER_PAIRS = 30
+DEFILLAMA_BATCH = 100
+
 
 class Token(Model):
 
@@ -69,6 +80,9 @@ class Token(Model):
     stable_route = BooleanField(default=False)
     price_control = TextField()
 
+    # Tokens priced recently (ex. before a restart) are not priced again
+    CHECKPOINT = Checkpoint("tokens", ASSETS_SYNC_SECONDS)
+
     DEXSCREENER_ENDPOINT = DEXSCREENER_ENDPOINT
     DEFILLAMA_ENDPOINT = DEFILLAMA_ENDPOINT
     DEXGURU_ENDPOINT = DEXGURU_ENDPOINT
@@ -117,6 +131,75 @@ class Token(Model):
 
         return 0
 
+    @classmethod
+    def price_externally(cls, tokens):
+        """
+        Prices tokens from the external sources in `EXTERNAL_PRICE_ORDER`
+        together: sources quoting many tokens per request (Dexscreener,
+        DefiLlama) are asked for all of them at once, the others a token at
+        a time. Every source is asked only for the tokens still unpriced.
+        """
+        # The same token can be listed more than once
+        pending = {}
+        for token in tokens:
+            pending.setdefault(token.address, []).append(token)
+
+        batched = {
+            "_get_price_from_dexscreener": cls._get_prices_from_dexscreener,
+            "_get_price_from_defillama": cls._get_prices_from_defillama,
+        }
+        single = ("_get_price_from_debank", "_get_price_from_dexguru")
+
+        for func_name in EXTERNAL_PRICE_ORDER:
+            if not pending or Deadline.exceeded():
+                break
+
+            if func_name in batched:
+                prices = batched[func_name](list(pending))
+            elif func_name in single:
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    prices = dict(
+                        zip(
+                            pending,
+                            executor.map(
+                                bind_context(cls._get_price_with),
+                                [same[0] for same in pending.values()],
+                                [func_name] * len(pending),
+                            ),
+                        )
+                    )
+            else:
+                continue
+
+            for address, price in prices.items():
+                if price > 0 and address in pending:
+                    for token in pending.pop(address):
+                        token.price = price
+                        token.save()
+                    cls.CHECKPOINT.mark(address)
+
+            LOGGER.debug(
+                "Priced tokens using %s, %s left.", func_name, len(pending)
+            )
+
+        # Late tokens keep their last price till the next sync
+        if Deadline.exceeded():
+            return
+
+        for address, same in pending.items():
+            for token in same:
+                token.price = 0
+                token.save()
+            cls.CHECKPOINT.mark(address)
+
+    @staticmethod
+    def _get_price_with(token, func_name):
+        try:
+            return getattr(token, func_name)() or 0
+        except Exception as e:
+            LOGGER.error(f"Error fetching price {func_name}: {e}")
+            return 0
+
     def _get_direct_price(self, stablecoin):
         """
         Fetches the direct price of the token in terms of the provided
@@ -135,46 +218,58 @@ class Token(Model):
         """
 
         try:
-            amount, is_stable = Call(
-                ROUTER_ADDRESS,
-                [
-                    "getAmountOut(uint256,address,address)(uint256,bool)",
-                    1 * 10**self.decimals,
-                    self.address,
-                    stablecoin.address,
-                ],
-            )()
+            amount, is_stable = read(
+                Call(
+                    ROUTER_ADDRESS,
+                    [
+                        "getAmountOut(uint256,address,address)(uint256,bool)",
+                        1 * 10**self.decimals,
+                        self.address,
+                        stablecoin.address,
+                    ],
+                )
+            )
             return amount / 10**stablecoin.decimals * stablecoin.price
         except ContractLogicError:
             LOGGER.debug("Found error getting chain price for %s", self.symbol)
             return 0
 
     def get_pair(self, address):
+        # The factory is only asked before the first pairs sync
+        if not PairIndex.is_empty():
+            return PairIndex.get(self.address, address, True) or (
+                PairIndex.get(self.address, address, False)
+            )
+
         try:
-            pair = Call(
-                FACTORY_ADDRESS,
-                [
-                    "getPair(address,address,bool)(address)",
-                    self.address,
-                    address,
-                    True,
-                ],
-                [],
-            )()
-            if pair == "0x0000000000000000000000000000000000000000":
-                raise ContractLogicError
-        except ContractLogicError:
-            try:
-                pair = Call(
+            pair = read(
+                Call(
                     FACTORY_ADDRESS,
                     [
                         "getPair(address,address,bool)(address)",
                         self.address,
                         address,
-                        False,
+                        True,
                     ],
                     [],
-                )()
+                )
+            )
+            if pair == "0x0000000000000000000000000000000000000000":
+                raise ContractLogicError
+        except ContractLogicError:
+            try:
+                pair = read(
+                    Call(
+                        FACTORY_ADDRESS,
+                        [
+                            "getPair(address,address,bool)(address)",
+                            self.address,
+                            address,
+                            False,
+                        ],
+                        [],
+                    )
+                )
                 if pair == "0x0000000000000000000000000000000000000000":
                     raise ContractLogicError
             except ContractLogicError:
@@ -198,11 +293,11 @@ class Token(Model):
             if pair is None:
                 continue
 
-            token0 = Call(pair, "token0()(address)", [])()
-            token1 = Call(pair, "token1()(address)", [])()
-            reserve0, reserve1 = Call(
-                pair, ["getReserves()(uint256,uint256)"], []
-            )()
+            token0 = read(Call(pair, "token0()(address)", []))
+            token1 = read(Call(pair, "token1()(address)", []))
+            reserve0, reserve1 = read(
+                Call(pair, ["getReserves()(uint256,uint256)"], [])
+            )
             LOGGER.debug(f"Reserves for pair {pair}: {reserve0}, {reserve1}")
 
             if token0 == self.address:
@@ -312,15 +407,18 @@ class Token(Model):
             if route_token.address == STABLE_TOKEN_ADDRESS:
                 route_token.price = 1.0
             try:
-                amount, is_stable = Call(
-                    ROUTER_ADDRESS,
-                    [
-                        "getAmountOut(uint256,address,address)(uint256,bool)",
-                        1 * 10 ** (self.decimals - 4),
-                        self.address,
-                        route_token.address,
-                    ],
-                )()
+                amount, is_stable = read(
+                    Call(
+                        ROUTER_ADDRESS,
+                        [
+                            "getAmountOut(uint256,address,address)"
+                            "(uint256,bool)",
+                            1 * 10 ** (self.decimals - 4),
+                            self.address,
+                            route_token.address,
+                        ],
+                    )
+                )
                 # amount = Call(
                 #     pair_selected,
                 #     [
@@ -352,121 +450,253 @@ class Token(Model):
     @classmethod
     def from_chain(cls, address, logoURI=None):
         """Fetches and returns a token from chain."""
+        return cls.from_chain_many([address]).get(address.lower())
 
-        try:
-            address = address.lower()
+    @classmethod
+    def from_chain_many(cls, addresses):
+        """Fetches tokens from chain with one multicall, by address."""
+        addresses = [address.lower() for address in addresses]
+
+        if not addresses:
+            return {}
+
+        plan = CallPlan()
+        for address in addresses:
             LOGGER.debug("Fetching from chain %s:%s...", cls.__name__, address)
+            plan.add(cls.prepare_chain_calls(address))
+        data = plan.run()
 
-            token_multi = Multicall(
-                [
-                    Call(address, ["name()(string)"], [["name", None]]),
-                    Call(address, ["symbol()(string)"], [["symbol", None]]),
-                    Call(address, ["decimals()(uint8)"], [["decimals", None]]),
-                ]
-            )
+        tokens = {}
+        for address in addresses:
+            try:
+                token_data = CallPlan.scoped(data, cls.__name__, address)
+                if not token_data:
+                    raise ValueError("no chain data")
+
+                failed = plan.failed_fields(cls.__name__, address)
+                if failed:
+                    LOGGER.warning(
+                        "Token %s calls failed: %s.", address, failed
+                    )
+
+                tokens[address] = cls.from_chain_calls(address, token_data)
+            except Exception as e:
+                LOGGER.error(
+                    f"Failed to fetch data for address {address}: {e}"
+                )
+
+        return tokens
 
-            data = token_multi()
+    @classmethod
+    def find_many(cls, addresses):
+        """Returns tokens by address, fetching the missing ones at once."""
+        tokens = {}
+        missing = []
 
-            # TODO: Add a dummy logo...
-            token = cls.create(address=address, **data)
-            # token._update_price()
-            token._price_feed()
+        for address in addresses:
+            try:
+                tokens[address.lower()] = cls.load(address.lower())
+            except KeyError:
+                missing.append(address)
 
-            LOGGER.debug("Fetched %s:%s.", cls.__name__, address)
+        tokens.update(cls.from_chain_many(missing))
 
-            return token
-        except Exception as e:
-            LOGGER.error(f"Failed to fetch data for address {address}: {e}")
-            return None
+        return tokens
 
-    def _get_price_from_dexscreener(self):
-        try:
-            res = requests.get(self.DEXSCREENER_ENDPOINT + self.address)
+    @classmethod
+    def prepare_chain_calls(cls, address):
+        """Returns prepared ERC20 calls for a token address."""
+        key_prefix = "|".join([cls.__name__, address])
+
+        return [
+            Call(
+                address,
+                ["name()(string)"],
+                [["%s|name" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                ["symbol()(string)"],
+                [["%s|symbol" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                ["decimals()(uint8)"],
+                [["%s|decimals" % key_prefix, None]],
+            ),
+        ]
 
-            res.raise_for_status()
-            data = res.json()
+    @classmethod
+    def from_chain_calls(cls, address, data):
+        """Imports/creates a token from the prepared calls data."""
 
-            pairs = data.get("pairs")
+        # TODO: Add a dummy logo...
+        token = cls.create(address=address, **data)
+        # token._update_price()
+        token._price_feed()
 
-            if pairs is None or not isinstance(pairs, list) or len(pairs) == 0:
-                # LOGGER.warning("Unexpected struct in Dexscreener response:\
-                # 'pairs' key missing, None, or not a non-empty list.")
-                # LOGGER.debug(f"Dexscreener API Response: {data}")
-                return 0
-            pairs_in_kava = [
-                pair
-                for pair in pairs
-                if pair["chainId"] == "kava"
-                and pair["dexId"] == "equilibre"
-                and pair["quoteToken"]["address"].lower()
-                != self.address.lower()
-            ]
+        LOGGER.debug("Fetched %s:%s.", cls.__name__, address)
 
-            if len(pairs_in_kava) == 0:
-                price = str(pairs[0].get("priceUsd") or 0).replace(",", "")
-            else:
-                price = str(pairs_in_kava[0].get("priceUsd") or 0).replace(
-                    ",", ""
-                )
+        return token
 
-            return float(price)
-        except (requests.RequestException, ValueError, IndexError) as e:
-            LOGGER.error("Error fetching price from Dexscreener: %s", e)
-            return 0
+    def _get_price_from_dexscreener(self):
+        prices = self._get_prices_from_dexscreener([self.address])
 
-    def _get_price_from_defillama(self) -> float:
-        url = self.DEFILLAMA_ENDPOINT + "kava:" + self.address.lower()
+        return prices.get(self.address.lower(), 0)
 
-        try:
-            res = requests.get(url)
-            res.raise_for_status()
-            data = res.json()
+    @classmethod
+    def _get_prices_from_dexscreener(cls, addresses):
+        """Returns the Dexscreener prices of tokens, by address."""
+        cached = ExternalPriceCache.get_many("dexscreener", addresses)
+        prices = {address: price for address, price in cached.items() if price}
+        addresses = [
+            address for address in addresses if address.lower() not in cached
+        ]
+
+        for start in range(0, len(addresses), DEXSCREENER_BATCH):
+            end = start + DEXSCREENER_BATCH
+            batch = [address.lower() for address in addresses[start:end]]
 
-            if "coins" not in data or not isinstance(data["coins"], dict):
-                LOGGER.error(
-                    f"Unexpected structure in DefiLlama response for token"
-                    f"{self.address}: 'coins' key missing or"
-                    f"not a dictionary."
+            try:
+                res = HTTP.get(cls.DEXSCREENER_ENDPOINT + ",".join(batch))
+
+                res.raise_for_status()
+                pairs = res.json().get("pairs")
+
+                # No pairs at all for tokens it does not list
+                if not isinstance(pairs, list):
+                    pairs = []
+
+                by_token = {}
+                for pair in pairs:
+                    address = pair["baseToken"]["address"].lower()
+                    if address in batch:
+                        by_token.setdefault(address, []).append(pair)
+
+                for address, quotes in by_token.items():
+                    # Our pairs first
+                    quote = next(
+                        (
+                            pair
+                            for pair in quotes
+                            if pair["chainId"] == "kava"
+                            and pair["dexId"] == "equilibre"
+                        ),
+                        quotes[0],
+                    )
+                    price = str(quote.get("priceUsd") or 0).replace(",", "")
+                    prices[address] = float(price)
+
+                # Pairs are listed up to a limit, not for every token
+                # asked: tokens without any are not listed only when the
+                # answer is below it, or when asked alone
+                complete = len(pairs) < DEXSCREENER_PAIRS or len(batch) == 1
+                ExternalPriceCache.set_many(
+                    "dexscreener",
+                    {
+                        address: prices.get(address, 0)
+                        for address in batch
+                        if address in prices or complete
+                    },
                 )
-                return 0
+            except (requests.RequestException, ValueError, KeyError) as e:
+                LOGGER.error("Error fetching prices from Dexscreener: %s", e)
 
-            coins = data["coins"]
-            for _, coin in coins.items():
-                price = coin.get("price", 0)
-                if price:
-                    return price
+        return prices
 
+    def _get_price_from_defillama(self) -> float:
+        prices = self._get_prices_from_defillama([self.address])
+        price = prices.get(self.address.lower(), 0)
+
+        if not price:
             LOGGER.warning(
                 f"No price found in DefiLlama for token: {self.symbol}"
             )
-            return 0
 
-        except (requests.RequestException, ValueError) as e:
-            LOGGER.error(
-                f"Error fetching price from DefiLlama for token"
-                f"{self.address} using URL {url}: {e}"
+        return price
+
+    @classmethod
+    def _get_prices_from_defillama(cls, addresses):
+        """Returns the DefiLlama prices of tokens, by address."""
+        cached = ExternalPriceCache.get_many("defillama", addresses)
+        prices = {address: price for address, price in cached.items() if price}
+        addresses = [
+            address for address in addresses if address.lower() not in cached
+        ]
+
+        for start in range(0, len(addresses), DEFILLAMA_BATCH):
+            end = start + DEFILLAMA_BATCH
+            batch = addresses[start:end]
+            url = cls.DEFILLAMA_ENDPOINT + ",".join(
+                "kava:" + address.lower() for address in batch
             )
-            return 0
+
+            try:
+                res = HTTP.get(url)
+                res.raise_for_status()
+                data = res.json()
+
+                if "coins" not in data or not isinstance(data["coins"], dict):
+                    LOGGER.error(
+                        f"Unexpected structure in DefiLlama response using"
+                        f" URL {url}: 'coins' key missing or"
+                        f" not a dictionary."
+                    )
+                    continue
+
+                for coin_id, coin in data["coins"].items():
+                    price = coin.get("price", 0)
+                    if price:
+                        prices[coin_id.split(":")[-1].lower()] = price
+
+                ExternalPriceCache.set_many(
+                    "defillama",
+                    {
+                        address.lower(): prices.get(address.lower(), 0)
+                        for address in batch
+                    },
+                )
+            except (requests.RequestException, ValueError) as e:
+                LOGGER.error(
+                    "Error fetching prices from DefiLlama using URL %s: %s",
+                    url,
+                    e,
+                )
+
+        return prices
 
     def _get_price_from_debank(self):
+        cached = ExternalPriceCache.get_many("debank", [self.address])
+        if cached:
+            return cached[self.address.lower()]
+
         try:
-            res = requests.get(
+            res = HTTP.get(
                 self.DEBANK_ENDPOINT + "token_id=" + self.address.lower()
             )
 
             res.raise_for_status()
             token_data = res.json().get("data") or {}
+            price = token_data.get("price") or 0
 
-            return token_data.get("price") or 0
+            ExternalPriceCache.set_many("debank", {self.address: price})
+            return price
         except (requests.RequestException, ValueError) as e:
             LOGGER.error("Error fetching price from DeBank: %s", e)
             return 0
 
     def _get_price_from_dexguru(self):
+        cached = ExternalPriceCache.get_many("dexguru", [self.address])
+        if cached:
+            return cached[self.address.lower()]
+
         try:
-            res = requests.get(self.DEXGURU_ENDPOINT % self.address.lower())
+            res = HTTP.get(self.DEXGURU_ENDPOINT % self.address.lower())
             res.raise_for_status()
-            return res.json().get("price_usd", 0)
+            price = res.json().get("price_usd") or 0
+
+            ExternalPriceCache.set_many("dexguru", {self.address: price})
+            return price
         except (requests.RequestException, ValueError) as e:
             LOGGER.error("Error fetching price from DexGuru: %s", e)
             return 0
@@ -501,7 +731,14 @@ class Token(Model):
     @classmethod
     def from_tokenlists(cls):
         our_chain_id = w3.eth.chain_id
-        all_tokens = cls._fetch_all_tokens(our_chain_id)
+
+        # Priced from the last synced pairs, in one pass, and then the
+        # tokens left from the external sources, all together
+        with PriceGraph.within(PriceGraph.from_snapshot()):
+            with ExternalPrices.within() as external:
+                all_tokens = cls._fetch_all_tokens(our_chain_id)
+
+        cls.price_externally(external.tokens)
 
         return all_tokens
 
@@ -512,7 +749,9 @@ class Token(Model):
         all_tokens = []
         with concurrent.futures.ThreadPoolExecutor() as executor:
             futures = [
-                executor.submit(cls._fetch_tokenlist, tlist, our_chain_id)
+                executor.submit(
+                    bind_context(cls._fetch_tokenlist), tlist, our_chain_id
+                )
                 for tlist in TOKENLISTS
             ]
             for future in concurrent.futures.as_completed(futures):
@@ -531,7 +770,7 @@ class Token(Model):
 
         try:
             headers = {"Cache-Control": "no-cache"}
-            res = requests.get(tlist, headers=headers).json()
+            res = HTTP.get(tlist, headers=headers).json()
 
             for token_data in res.get("tokens", []):
                 if cls._is_valid_token(token_data, our_chain_id):
@@ -566,6 +805,15 @@ class Token(Model):
         """Creates and updates the token."""
 
         address = token_data.get("address", "").lower()
+
+        try:
+            previous = cls.load(address)
+        except KeyError:
+            previous = None
+
+        if previous is not None and cls.CHECKPOINT.is_fresh(address):
+            return previous
+
         liquid_staked_address = token_data.get(
             "liquid_staked_address", ""
         ).lower()
@@ -575,6 +823,8 @@ class Token(Model):
             address=address,
             liquid_staked_address=liquid_staked_address,
             symbol=symbol,
+            # Kept if the price is left for later
+            price=previous.price if previous is not None else 0,
         )
 
         token.name = token_data.get("name", "")
@@ -593,7 +843,9 @@ class Token(Model):
         token.decimals = token_data.get("decimals", 18)
 
         # token._update_price()
-        token._price_feed()
+        # Without a price, left for later, the last one is kept till then
+        if token._price_feed() is not None:
+            cls.CHECKPOINT.mark(address)
 
         return token
 
@@ -614,7 +866,8 @@ class Token(Model):
 
     def _price_feed(self):
         """
-        Returns the price feed of the token.
+        Returns the price feed of the token, `None` when left for the next
+        sync (the last price is kept).
         Based on different sources as:
             - Direct routing to some token
             - Direct routing to stablecoin
@@ -647,10 +900,23 @@ class Token(Model):
                     Token.find(STABLE_TOKEN_ADDRESS)
                 )
 
-            # * GENERAL CASE - Automatically calculated from the route
-            # * tokens/reserves of liquidity pools
-            if price <= 0:
+            # * GENERAL CASE - Automatically calculated from the
+            # * reserves of the liquidity pools, on chain without pairs yet
+            graph = PriceGraph.current()
+            if price <= 0 and graph is not None:
+                price = graph.price_of(self.address)
+            elif price <= 0:
                 price = self.chain_price_in_route_tokens_reserves()
+            # External sources are slow, left for the next sync when late
+            if price <= 0 and Deadline.exceeded():
+                return self._keep_last_price()
+
+            # Priced together with the other tokens, when batched
+            external = ExternalPrices.current()
+            if price <= 0 and external is not None:
+                external.defer(self)
+                return self._keep_last_price()
+
             if price <= 0:
                 price = self.get_price_external_source()
             if price > 0:
@@ -660,6 +926,13 @@ class Token(Model):
             LOGGER.error(f"Error fetching price: {e}")
             return self._finalize_update(0, start_time)
 
+    def _keep_last_price(self):
+        """Saves the token with its last price, to be priced later."""
+        self.save()
+        LOGGER.debug(
+            "Price of %s left for later, kept %s.", self.symbol, self.price
+        )
+
     def _finalize_update(self, price, start_time):
         """Finalizes the update by setting the price and saving the token."""
 
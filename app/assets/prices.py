@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.settings import (
+    CACHE,
+    EXTERNAL_PRICE_CACHE_SECONDS,
+    EXTERNAL_PRICE_NEGATIVE_CACHE_SECONDS,
+    LOGGER,
+    PRICE_GRAPH_MIN_LIQUIDITY,
+    STABLE_TOKEN_ADDRESS,
+)
+from app.sync import Snapshots
+
+_current = ContextVar("price_graph", default=None)
+_external = ContextVar("external_prices", default=None)
+
+
+class PriceGraph(object):
+    """
+    Token prices computed from the pairs liquidity, in one pass.
+
+    The graph is built from the reserves of the last synced pairs (tokens
+    are synced before the pairs). Prices are spread outwards from the
+    stable token, a hop at a time: every token reached is priced from all
+    its pairs with already priced tokens, weighted by their liquidity in
+    USD. Pairs with less than `PRICE_GRAPH_MIN_LIQUIDITY` on the priced
+    side are left out.
+
+    Volatile pairs quote the reserves ratio, stable pairs the spot price
+    of their `x³y + y³x = k` curve.
+    """
+
+    PAIRS_CACHE_KEY = "pairs:json"
+
+    def __init__(self, pairs, anchors=None):
+        # token -> [(other token, own reserve, other reserve, stable)]
+        self.edges = defaultdict(list)
+        self.anchors = anchors or {STABLE_TOKEN_ADDRESS.lower(): 1.0}
+
+        for pair in pairs:
+            token0 = str(pair.get("token0_address") or "").lower()
+            token1 = str(pair.get("token1_address") or "").lower()
+            reserve0 = float(pair.get("reserve0") or 0)
+            reserve1 = float(pair.get("reserve1") or 0)
+            stable = bool(pair.get("stable"))
+
+            if not token0 or not token1 or reserve0 <= 0 or reserve1 <= 0:
+                continue
+
+            self.edges[token0].append((token1, reserve0, reserve1, stable))
+            self.edges[token1].append((token0, reserve1, reserve0, stable))
+
+        self.prices = self.spread()
+
+    def __len__(self):
+        return len(self.edges)
+
+    @classmethod
+    def from_snapshot(cls):
+        """Builds the graph from the published pairs."""
+        cached = Snapshots.get(cls.PAIRS_CACHE_KEY)
+        pairs = json.loads(cached)["data"] if cached else []
+
+        graph = cls(pairs)
+        LOGGER.debug(
+            "Priced %s tokens from %s pairs.", len(graph.prices), len(pairs)
+        )
+
+        return graph
+
+    @classmethod
+    @contextmanager
+    def within(cls, graph):
+        """Prices the tokens of the context from the graph."""
+        token = _current.set(graph)
+
+        try:
+            yield graph
+        finally:
+            _current.reset(token)
+
+    @classmethod
+    def current(cls):
+        """Returns the graph of the context, if any and not empty."""
+        graph = _current.get()
+
+        return graph if graph else None
+
+    def price_of(self, address):
+        return self.prices.get(address.lower(), 0)
+
+    @staticmethod
+    def spot(reserve, other_reserve, stable):
+        """Returns the price of the other token, in the token."""
+        if not stable:
+            return reserve / other_reserve
+
+        x, y = other_reserve, reserve
+
+        return (3 * x**2 * y + y**3) / (x**3 + 3 * x * y**2)
+
+    def spread(self):
+        prices = dict(self.anchors)
+        frontier = set(prices)
+
+        while frontier:
+            quotes = defaultdict(lambda: [0.0, 0.0])
+
+            for address in frontier:
+                price = prices[address]
+
+                edges = self.edges.get(address, ())
+
+                for other, reserve, other_reserve, stable in edges:
+                    if other in prices:
+                        continue
+
+                    liquidity = reserve * price
+                    if liquidity < PRICE_GRAPH_MIN_LIQUIDITY:
+                        continue
+
+                    quote = quotes[other]
+                    quote[0] += (
+                        price
+                        * self.spot(reserve, other_reserve, stable)
+                        * liquidity
+                    )
+                    quote[1] += liquidity
+
+            frontier = set()
+            for address, (weighted, liquidity) in quotes.items():
+                prices[address] = weighted / liquidity
+                frontier.add(address)
+
+        return prices
+
+
+class ExternalPrices(object):
+    """
+    Tokens left to price from the external sources.
+
+    Instead of a request per token, they are priced together once all the
+    tokens of the sync were priced from chain (see `Token.price_externally`).
+    """
+
+    def __init__(self):
+        self.tokens = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def within(cls):
+        """Defers the external prices of the tokens of the context."""
+        prices = cls()
+        token = _external.set(prices)
+
+        try:
+            yield prices
+        finally:
+            _external.reset(token)
+
+    @classmethod
+    def current(cls):
+        return _external.get()
+
+    def defer(self, token):
+        with self._lock:
+            self.tokens.append(token)
+
+
+class ExternalPriceCache(object):
+    """
+    External prices by `(source, token)`, in Redis for every sync worker.
+
+    Prices are kept `EXTERNAL_PRICE_CACHE_SECONDS`. Tokens a source
+    answered for without a price (not listed) are kept, as a `0` price, for
+    the longer `EXTERNAL_PRICE_NEGATIVE_CACHE_SECONDS`. Failed requests are
+    not cached.
+    """
+
+    CACHE_KEY = "prices:external:%s:%s"
+
+    @classmethod
+    def get_many(cls, source, addresses):
+        """Returns the cached prices of the tokens, `0` if not listed."""
+        if CACHE is None or not addresses:
+            return {}
+
+        addresses = [address.lower() for address in addresses]
+        values = CACHE.mget(
+            [cls.CACHE_KEY % (source, address) for address in addresses]
+        )
+
+        return {
+            address: float(value)
+            for address, value in zip(addresses, values)
+            if value is not None
+        }
+
+    @classmethod
+    def set_many(cls, source, prices):
+        """Caches the prices a source answered with, `0` if not listed."""
+        if CACHE is None or not prices:
+            return
+
+        with CACHE.pipeline() as pipe:
+            for address, price in prices.items():
+                pipe.set(
+                    cls.CACHE_KEY % (source, address.lower()),
+                    float(price or 0),
+                    ex=(
+                        EXTERNAL_PRICE_CACHE_SECONDS
+                        if price
+                        else EXTERNAL_PRICE_NEGATIVE_CACHE_SECONDS
+                    ),
+                )
+            pipe.execute()
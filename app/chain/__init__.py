@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+from .accounting import RPCStats  # noqa
+from .bloom import blocks_may_have_logs, bloom_bits, bloom_contains  # noqa
+from .engine import ENGINE, ChainEngine, RPCError  # noqa
+from .immutable import ImmutableReads  # noqa
+from .lens import PairsLens  # noqa
+from .logs import fetch_logs  # noqa
+from .pair_index import PairIndex  # noqa
+from .pinning import PinnedBlock, read  # noqa
+from .planner import CallPlan  # noqa
+from .provider import w3  # noqa
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.settings import CACHE, LOGGER
+
+_current = ContextVar("rpc_stats", default=None)
+_caller = ContextVar("rpc_caller", default=None)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RPCStats(object):
+    """
+    RPC accounting of a sync cycle.
+
+    Counts the JSON-RPC requests, their bytes and latencies by method, and
+    the chain calls (multicall sub-calls included) by the code reading
+    them, e.g. `Gauge._fetch_external_rewards`. Results cached by a
+    `PinnedBlock` are not counted, they never reach the node.
+    """
+
+    CACHE_KEY = "rpc:stats"
+
+    def __init__(self):
+        self.methods = {}
+        self.callers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def within(cls):
+        """Accounts the chain reads of the context, logs and saves them."""
+        stats = cls()
+        token = _current.set(stats)
+
+        try:
+            yield stats
+        finally:
+            _current.reset(token)
+            stats.log()
+            stats.save()
+
+    @classmethod
+    def current(cls):
+        return _current.get()
+
+    @staticmethod
+    def caller(depth=2):
+        """
+        Returns the name of the first function up the stack outside of the
+        chain package, as `Class.method` or `module.function`.
+        """
+        frame = sys._getframe(depth)
+
+        while frame is not None:
+            module = frame.f_globals.get("__name__", "")
+            if not module.startswith("app.chain"):
+                break
+            frame = frame.f_back
+
+        if frame is None:
+            return "unknown"
+
+        owner = frame.f_locals.get("self", frame.f_locals.get("cls"))
+        if owner is None:
+            prefix = module.rsplit(".", 1)[-1]
+        elif isinstance(owner, type):
+            prefix = owner.__name__
+        else:
+            prefix = type(owner).__name__
+
+        return "%s.%s" % (prefix, frame.f_code.co_name)
+
+    @staticmethod
+    @contextmanager
+    def bound(stats, caller):
+        """Accounts the context in `stats`, attributed to the `caller`."""
+        stats_token, caller_token = _current.set(stats), _caller.set(caller)
+
+        try:
+            yield
+        finally:
+            _caller.reset(caller_token)
+            _current.reset(stats_token)
+
+    @classmethod
+    def record_request(cls, method, sent, received, seconds):
+        stats = _current.get()
+        if stats is None:
+            return
+
+        bucket = next(
+            (str(bound) for bound in BUCKETS if seconds <= bound), "+Inf"
+        )
+
+        with stats._lock:
+            totals = stats.methods.setdefault(
+                method,
+                dict(requests=0, sent=0, received=0, seconds=0, latency={}),
+            )
+            totals["requests"] += 1
+            totals["sent"] += sent
+            totals["received"] += received
+            totals["seconds"] += seconds
+            totals["latency"][bucket] = totals["latency"].get(bucket, 0) + 1
+
+            caller = stats._caller_totals()
+            caller["requests"] += 1
+            caller["bytes"] += sent + received
+            caller["seconds"] += seconds
+
+    @classmethod
+    def record_calls(cls, count):
+        """Counts the chain calls answered by a request."""
+        stats = _current.get()
+        if stats is None:
+            return
+
+        with stats._lock:
+            stats._caller_totals()["calls"] += count
+
+    def _caller_totals(self):
+        return self.callers.setdefault(
+            _caller.get() or "unknown",
+            dict(requests=0, calls=0, bytes=0, seconds=0),
+        )
+
+    def to_dict(self):
+        with self._lock:
+            return json.loads(
+                json.dumps(dict(methods=self.methods, callers=self.callers))
+            )
+
+    def log(self):
+        data = self.to_dict()
+
+        for method, totals in sorted(data["methods"].items()):
+            LOGGER.info(
+                "RPC %s: %s requests, %s bytes sent, %s received in %.2fs.",
+                method,
+                totals["requests"],
+                totals["sent"],
+                totals["received"],
+                totals["seconds"],
+            )
+
+        callers = sorted(
+            data["callers"].items(), key=lambda item: -item[1]["calls"]
+        )
+        for caller, totals in callers:
+            LOGGER.info(
+                "RPC by %s: %s calls in %s requests, %s bytes, %.2fs.",
+                caller,
+                totals["calls"],
+                totals["requests"],
+                totals["bytes"],
+                totals["seconds"],
+            )
+
+    def save(self):
+        if CACHE is not None:
+            CACHE.set(self.CACHE_KEY, json.dumps(self.to_dict()))
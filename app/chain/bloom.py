@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+from web3 import Web3
+
+from app.settings import BLOOM_MAX_BLOCKS, LOGGER
+
+from .engine import ENGINE
+
+
+def bloom_bits(value):
+    """Returns the three bloom bit positions of an address or topic."""
+    if isinstance(value, str):
+        value = bytes.fromhex(value[2:] if value.startswith("0x") else value)
+
+    digest = Web3.keccak(value)
+
+    return [((digest[i] << 8) | digest[i + 1]) & 2047 for i in (0, 2, 4)]
+
+
+def bloom_contains(bloom, bits):
+    """Checks if all the bits are set in a 2048 bits block logs bloom."""
+    bloom = int.from_bytes(bytes(bloom), "big")
+
+    return all((bloom >> bit) & 1 for bit in bits)
+
+
+def blocks_may_have_logs(from_block, to_block, addresses):
+    """
+    Checks the blocks logs bloom for any log from the addresses.
+
+    A negative answer is certain, a positive one might be a false positive.
+    Ranges larger than `BLOOM_MAX_BLOCKS` are not checked and reported as
+    possibly having logs.
+    """
+    if from_block > to_block:
+        return False
+
+    if to_block - from_block + 1 > BLOOM_MAX_BLOCKS:
+        return True
+
+    addresses_bits = [bloom_bits(address) for address in set(addresses)]
+    numbers = range(from_block, to_block + 1)
+    headers = ENGINE.run(
+        ENGINE.batch(
+            [
+                ("eth_getBlockByNumber", [hex(number), False])
+                for number in numbers
+            ]
+        )
+    )
+
+    for number, header in zip(numbers, headers):
+        bloom = bytes.fromhex(header["logsBloom"][2:])
+
+        if any(bloom_contains(bloom, bits) for bits in addresses_bits):
+            LOGGER.debug("Block %s might have tracked logs.", number)
+            return True
+
+    return False
@@ -0,0 +1,543 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import atexit
+import itertools
+import json
+import random
+import threading
+import time
+from collections import deque
+
+import aiohttp
+from multicall import Call, Signature
+
+from app.settings import (
+    LOGGER,
+    MULTICALL_ADDRESS,
+    MULTICALL_CHUNK_SIZE,
+    MULTICALL_MAX_CHUNK_SIZE,
+    RPC_BATCH_SIZE,
+    RPC_ENDPOINT_COOLDOWN,
+    RPC_ENDPOINTS,
+    RPC_HEDGE,
+    RPC_HEDGE_SECONDS,
+    RPC_MAX_CONCURRENCY,
+    RPC_MAX_CONNECTIONS,
+    RPC_TIMEOUT,
+)
+
+from .accounting import RPCStats
+
+
+class RPCError(Exception):
+    """A JSON-RPC error answered by the node."""
+
+
+# Failures of an endpoint itself, as opposed to node answered errors
+TRANSPORT_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+
+
+class Endpoint(object):
+    """
+    An RPC endpoint with its recent latencies and failures.
+
+    Endpoints failing in a row are left out for `RPC_ENDPOINT_COOLDOWN`
+    seconds times the failures (up to ten times), faster ones get more
+    requests.
+
+    Every endpoint learns its own multicall chunk size: halved under the
+    failing chunk size, grown by a quarter with every full chunk answered,
+    up to `MULTICALL_MAX_CHUNK_SIZE`. Endpoints not answering JSON-RPC
+    batches are marked so, and get single requests from then on.
+    """
+
+    SAMPLES = 200
+    # Latencies needed before the p95 is trusted
+    MIN_SAMPLES = 20
+
+    def __init__(
+        self,
+        uri,
+        cooldown=RPC_ENDPOINT_COOLDOWN,
+        chunk_size=MULTICALL_CHUNK_SIZE,
+        max_chunk_size=MULTICALL_MAX_CHUNK_SIZE,
+    ):
+        self.uri = uri
+        self.cooldown = cooldown
+        self.max_chunk_size = max(1, max_chunk_size)
+        self.chunk_size = min(max(1, chunk_size), self.max_chunk_size)
+        self.latencies = deque(maxlen=self.SAMPLES)
+        self.failures = 0
+        self.down_until = 0
+        self.batches = True
+
+    def __repr__(self):
+        return "<Endpoint %s>" % self.uri
+
+    def record(self, seconds):
+        self.latencies.append(seconds)
+        self.failures = 0
+        self.down_until = 0
+
+    def fail(self):
+        self.failures += 1
+        self.down_until = time.monotonic() + self.cooldown * min(
+            self.failures, 10
+        )
+
+    def healthy(self):
+        return time.monotonic() >= self.down_until
+
+    def grow(self, size):
+        if size >= self.chunk_size:
+            self.chunk_size = min(
+                self.max_chunk_size,
+                self.chunk_size + max(1, self.chunk_size // 4),
+            )
+
+    def shrink(self, size):
+        self.chunk_size = max(1, min(self.chunk_size, size // 2))
+
+    def p95(self):
+        """Returns the 95th percentile latency, `None` without samples."""
+        if len(self.latencies) < self.MIN_SAMPLES:
+            return None
+
+        latencies = sorted(self.latencies)
+
+        return latencies[int(len(latencies) * 0.95) - 1]
+
+    def weight(self):
+        if not self.latencies:
+            return 1.0
+
+        return 1.0 / max(sum(self.latencies) / len(self.latencies), 0.001)
+
+
+class ChainEngine(object):
+    """
+    Asyncio JSON-RPC client running on a persistent event loop.
+
+    The loop lives in a daemon thread for the whole process, together with
+    one HTTP connection pool and a semaphore bounding the requests in
+    flight. Sync code submits coroutines with `run()`, so no executor or
+    event loop is created per call.
+
+    Requests are balanced between the healthy `RPC_ENDPOINTS` by their
+    latency. An `eth_call` slower than the p95 latency of its endpoint is
+    hedged: the same call goes to a second endpoint and the first answer
+    wins. Failed requests are retried once on another endpoint.
+    """
+
+    TRY_AGGREGATE = Signature(
+        "tryAggregate(bool,(address,bytes)[])((bool,bytes)[])"
+    )
+    HEADERS = {"Content-Type": "application/json"}
+
+    def __init__(
+        self,
+        endpoints=RPC_ENDPOINTS,
+        concurrency=RPC_MAX_CONCURRENCY,
+        connections=RPC_MAX_CONNECTIONS,
+        timeout=RPC_TIMEOUT,
+        hedge=RPC_HEDGE,
+    ):
+        self.endpoints = [Endpoint(uri) for uri in endpoints]
+        self.hedge = hedge and len(self.endpoints) > 1
+        self.concurrency = max(1, concurrency)
+        self.connections = connections
+        self.timeout = timeout
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._semaphore = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self):
+        """Returns the engine loop, started on first use."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=loop.run_forever, name="chain-engine", daemon=True
+                )
+                self._thread.start()
+                self._loop = loop
+
+        return self._loop
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the engine loop and waits for its result.
+
+        The requests are accounted in the current `RPCStats`, if any.
+        """
+        stats = RPCStats.current()
+        if stats is not None:
+            coroutine = self._accounted(coroutine, stats, RPCStats.caller())
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @staticmethod
+    async def _accounted(coroutine, stats, caller):
+        with RPCStats.bound(stats, caller):
+            return await coroutine
+
+    async def session(self):
+        # Only ever called from the engine loop thread
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+
+        return self._session
+
+    def pick(self, exclude=None):
+        """Returns a healthy endpoint, picked by weight."""
+        endpoints = [
+            endpoint for endpoint in self.endpoints if endpoint is not exclude
+        ]
+        if not endpoints:
+            return None
+
+        healthy = [endpoint for endpoint in endpoints if endpoint.healthy()]
+        if not healthy:
+            return min(endpoints, key=lambda endpoint: endpoint.down_until)
+
+        return random.choices(
+            healthy, weights=[endpoint.weight() for endpoint in healthy]
+        )[0]
+
+    async def request(self, method, params, hedge=False, endpoint=None):
+        """
+        Sends a JSON-RPC request, to the `endpoint` or a picked one, and
+        returns its result.
+
+        Only idempotent requests should be `hedge`d.
+        """
+        payload = dict(
+            jsonrpc="2.0", id=next(self._ids), method=method, params=params
+        )
+        first = endpoint or self.pick()
+        tasks = [asyncio.ensure_future(self._post(first, payload))]
+
+        if hedge and self.hedge:
+            done, _ = await asyncio.wait(tasks, timeout=self.delay(first))
+            second = None if done else self.pick(exclude=first)
+            if second is not None:
+                LOGGER.debug("Hedging %s: %s to %s.", method, first, second)
+                tasks.append(
+                    asyncio.ensure_future(self._post(second, payload))
+                )
+
+        try:
+            return await self._first_answer(tasks)
+        except TRANSPORT_ERRORS:
+            other = self.pick(exclude=first)
+            if other is None or len(tasks) > 1:
+                raise
+
+        return await self._post(other, payload)
+
+    @staticmethod
+    def delay(endpoint):
+        """Returns the seconds to wait for an endpoint before hedging."""
+        p95 = endpoint.p95()
+
+        return RPC_HEDGE_SECONDS if p95 is None else max(p95, 0.05)
+
+    @staticmethod
+    async def _first_answer(tasks):
+        """Returns the first answer, node errors included, of the tasks."""
+        pending = set(tasks)
+        error = None
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if isinstance(task.exception(), TRANSPORT_ERRORS):
+                        error = task.exception()
+                        continue
+
+                    return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        raise error
+
+    async def _post(self, endpoint, payload):
+        data = await self._send(endpoint, payload)
+
+        if data.get("error"):
+            raise RPCError("%s: %s" % (payload["method"], data["error"]))
+
+        return data["result"]
+
+    async def _send(self, endpoint, payload):
+        """Posts a request, or a batch of them, returns the parsed answer."""
+        session = await self.session()
+
+        body = json.dumps(payload).encode()
+
+        async with self._semaphore:
+            started = time.monotonic()
+            try:
+                async with session.post(
+                    endpoint.uri, data=body, headers=self.HEADERS
+                ) as resp:
+                    resp.raise_for_status()
+                    raw = await resp.read()
+            except TRANSPORT_ERRORS as error:
+                endpoint.fail()
+                LOGGER.warning("RPC endpoint %s failed: %r", endpoint, error)
+                raise
+
+            seconds = time.monotonic() - started
+            endpoint.record(seconds)
+
+        RPCStats.record_request(
+            payload["method"] if isinstance(payload, dict) else "batch",
+            len(body),
+            len(raw),
+            seconds,
+        )
+
+        return json.loads(raw)
+
+    async def batch(self, requests):
+        """
+        Sends `(method, params)` requests that can not be multicalled
+        (headers, logs...) as JSON-RPC batches of `RPC_BATCH_SIZE`, and
+        returns their results in order.
+
+        Endpoints not answering batches get concurrent single requests.
+        """
+        size = max(1, RPC_BATCH_SIZE)
+        chunks = [
+            requests[start:start + size]
+            for start in range(0, len(requests), size)
+        ]
+
+        results = []
+        for chunk_results in await asyncio.gather(
+            *[self._batch(chunk) for chunk in chunks]
+        ):
+            results.extend(chunk_results)
+
+        return results
+
+    async def _batch(self, requests):
+        endpoint = self.pick()
+
+        if endpoint.batches and len(requests) > 1:
+            payload = [
+                dict(
+                    jsonrpc="2.0",
+                    id=next(self._ids),
+                    method=method,
+                    params=params,
+                )
+                for method, params in requests
+            ]
+
+            try:
+                answers = await self._send(endpoint, payload)
+            except TRANSPORT_ERRORS:
+                answers = None
+            else:
+                results = self.batch_results(payload, answers)
+                if results is not None:
+                    return results
+
+                endpoint.batches = False
+                LOGGER.info("RPC endpoint %s does not batch.", endpoint)
+
+        return await asyncio.gather(
+            *[self.request(method, params) for method, params in requests]
+        )
+
+    @staticmethod
+    def batch_results(payload, answers):
+        """Returns the results of a batch in order, `None` if unanswered."""
+        if not isinstance(answers, list):
+            return None
+
+        by_id = {
+            answer.get("id"): answer
+            for answer in answers
+            if isinstance(answer, dict)
+        }
+        if not all(request["id"] in by_id for request in payload):
+            return None
+
+        results = []
+        for request in payload:
+            answer = by_id[request["id"]]
+            if answer.get("error"):
+                raise RPCError("%s: %s" % (request["method"], answer["error"]))
+            results.append(answer.get("result"))
+
+        return results
+
+    async def eth_call(
+        self, target, data, block_id=None, endpoint=None, state=None
+    ):
+        """Runs an `eth_call`, with the `state` override if any."""
+        params = [
+            {"to": target, "data": "0x" + data.hex()},
+            hex(block_id) if block_id is not None else "latest",
+        ]
+        if state:
+            params.append(state)
+
+        result = await self.request(
+            "eth_call", params, hedge=True, endpoint=endpoint
+        )
+
+        return bytes.fromhex(result[2:])
+
+    async def call(self, call, block_id=None):
+        """Runs a single `Call`, returns its decoded result."""
+        output = await self.eth_call(call.target, call.data, block_id)
+        RPCStats.record_calls(1)
+
+        return Call.decode_output(output, call.signature, call.returns)
+
+    async def aggregate(self, calls, block_id=None):
+        """
+        Runs named calls through the multicall contract, in concurrent
+        chunks, and returns the results by name and the failed calls.
+
+        Calls succeed or fail on their own (`tryAggregate`): a reverted or
+        undecodable call is only left out of the results.
+
+        Chunks are as large as the picked endpoint answered so far. A chunk
+        failing for its size (gas, response size, timeout) is split in half
+        and retried, recursively.
+        """
+        endpoint = self.pick()
+        size = endpoint.chunk_size
+        chunks = [
+            calls[start:start + size] for start in range(0, len(calls), size)
+        ]
+
+        return await self._gather(chunks, block_id, endpoint)
+
+    async def _gather(self, chunks, block_id, endpoint):
+        results, failed = {}, []
+
+        for chunk_results, chunk_failed in await asyncio.gather(
+            *[self._aggregate(chunk, block_id, endpoint) for chunk in chunks]
+        ):
+            results.update(chunk_results)
+            failed.extend(chunk_failed)
+
+        return results, failed
+
+    async def _aggregate(self, calls, block_id, endpoint):
+        try:
+            output = await self.eth_call(
+                MULTICALL_ADDRESS,
+                self.TRY_AGGREGATE.encode_data(
+                    [False, [[call.target, call.data] for call in calls]]
+                ),
+                block_id,
+                endpoint,
+            )
+        except (RPCError,) + TRANSPORT_ERRORS as error:
+            if len(calls) == 1 or not self.may_split(error, endpoint):
+                raise
+
+            endpoint.shrink(len(calls))
+            LOGGER.debug(
+                "Multicall of %s calls failed on %s, split: %s",
+                len(calls),
+                endpoint,
+                error,
+            )
+
+            half = len(calls) // 2
+            return await self._gather(
+                [calls[:half], calls[half:]], block_id, endpoint
+            )
+
+        endpoint.grow(len(calls))
+        (outputs,) = self.TRY_AGGREGATE.decode_data(output)
+        RPCStats.record_calls(len(calls))
+
+        results, failed = {}, []
+        for call, (success, call_output) in zip(calls, outputs):
+            try:
+                if not success:
+                    raise RPCError("reverted")
+
+                values = call.signature.decode_data(call_output)
+                results.update(
+                    {
+                        name: handler(value) if handler else value
+                        for (name, handler), value in zip(call.returns, values)
+                    }
+                )
+            except Exception as error:
+                LOGGER.debug("Chain call %s failed: %s", call, error)
+                failed.append(call)
+
+        LOGGER.debug(
+            "Aggregated %s chain calls, %s failed.", len(calls), len(failed)
+        )
+
+        return results, failed
+
+    @staticmethod
+    def may_split(error, endpoint):
+        """
+        Tells if a failed chunk may succeed split: not when the multicall
+        reverted, nor when the endpoint itself keeps failing.
+        """
+        if isinstance(error, RPCError):
+            return "revert" not in str(error).lower()
+
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status == 413
+
+        return isinstance(error, asyncio.TimeoutError) and (
+            endpoint.failures < 3
+        )
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def shutdown(self, timeout=5):
+        """Closes the session and stops the loop thread, if started."""
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+
+        if loop is None:
+            return
+
+        try:
+            asyncio.run_coroutine_threadsafe(self.close(), loop).result(
+                timeout
+            )
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join(timeout)
+            if not thread.is_alive():
+                loop.close()
+
+
+ENGINE = ChainEngine()
+atexit.register(ENGINE.shutdown)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from contextlib import contextmanager
+
+from app.settings import CACHE
+
+from .pinning import PinnedBlock
+
+
+class ImmutableReads(object):
+    """
+    Contract reads that never change, like a pair `token0()` or a token
+    `decimals()`.
+
+    Their results are kept by `(contract, signature)` forever, in process
+    and in a Redis hash, and `CallPlan` takes them from here instead of
+    the chain. The hash is kept when the cache is cleared on start.
+    """
+
+    CACHE_KEY = "chain:immutable"
+    FUNCTIONS = frozenset(
+        [
+            "decimals()",
+            "fee()",
+            "name()",
+            "stable()",
+            "symbol()",
+            "token0()",
+            "token1()",
+        ]
+    )
+
+    _values = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def is_immutable(cls, call):
+        return call.signature.function in cls.FUNCTIONS and (
+            PinnedBlock.is_cacheable(call)
+        )
+
+    @staticmethod
+    def field_of(call):
+        return "%s:%s" % (call.target.lower(), call.signature.signature)
+
+    @classmethod
+    def get_many(cls, calls):
+        """Returns the known values of the calls, by `field_of()`."""
+        known = {}
+        missing = []
+
+        with cls._lock:
+            for field in set(cls.field_of(call) for call in calls):
+                if field in cls._values:
+                    known[field] = cls._values[field]
+                else:
+                    missing.append(field)
+
+        if missing and CACHE is not None:
+            stored = {
+                field: json.loads(value)
+                for field, value in zip(
+                    missing, CACHE.hmget(cls.CACHE_KEY, missing)
+                )
+                if value is not None
+            }
+
+            with cls._lock:
+                cls._values.update(stored)
+            known.update(stored)
+
+        return known
+
+    @classmethod
+    def set_many(cls, values):
+        """Keeps the values of calls, by `field_of()`."""
+        if not values:
+            return
+
+        with cls._lock:
+            cls._values.update(values)
+
+        if CACHE is not None:
+            CACHE.hset(
+                cls.CACHE_KEY,
+                mapping={
+                    field: json.dumps(value) for field, value in values.items()
+                },
+            )
+
+    @classmethod
+    @contextmanager
+    def kept(cls):
+        """Restores the stored reads after the context (clears the cache)."""
+        stored = (
+            CACHE.hgetall(cls.CACHE_KEY) if CACHE is not None else {}
+        )
+
+        try:
+            yield
+        finally:
+            if stored:
+                CACHE.hset(cls.CACHE_KEY, mapping=stored)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from multicall import Signature
+from web3.constants import ADDRESS_ZERO
+
+from app.settings import (
+    DEFAULT_TOKEN_ADDRESS,
+    LENS_BYTECODE,
+    LOGGER,
+    VOTER_ADDRESS,
+)
+
+from .engine import ENGINE, RPCError
+from .pinning import PinnedBlock
+from .planner import CallPlan
+
+
+class PairsLens(object):
+    """
+    Reads the state of many pairs, and of their gauges, in one `eth_call`.
+
+    The lens contract (`app/abis/PairsLens.sol`) is never deployed: its
+    bytecode (`LENS_BYTECODE`) is sent in the call state override. The
+    results are keyed like the pair and gauge calls, to be passed as the
+    `known` results of their `CallPlan`.
+
+    Without bytecode, or on nodes without state overrides, nothing is read
+    and the plans make their usual multicalls.
+    """
+
+    # Where the lens code lives, for the call only
+    ADDRESS = "0x00000000000000000000000000000000001e4500"
+    SIGNATURE = Signature(
+        "pairs(address,address,address[])"
+        "((address,uint256,uint256,address,address,uint256,bool,"
+        "address,uint256,uint256,address,address,bool)[])"
+    )
+    PAIR_FIELDS = (
+        "reserve0",
+        "reserve1",
+        "token0_address",
+        "token1_address",
+        "total_supply",
+        "stable",
+        "gauge_address",
+    )
+    GAUGE_FIELDS = (
+        "total_supply",
+        "reward_rate",
+        "bribe_address",
+        "fees_address",
+        "isAlive",
+    )
+
+    supported = bool(LENS_BYTECODE)
+
+    @classmethod
+    def read(cls, addresses):
+        """Returns the pairs and gauges results, `{}` if not supported."""
+        if not cls.supported or not addresses:
+            return {}
+
+        try:
+            output = ENGINE.run(
+                ENGINE.eth_call(
+                    cls.ADDRESS,
+                    cls.SIGNATURE.encode_data(
+                        [VOTER_ADDRESS, DEFAULT_TOKEN_ADDRESS, list(addresses)]
+                    ),
+                    PinnedBlock.block_id(),
+                    state={cls.ADDRESS: {"code": LENS_BYTECODE}},
+                )
+            )
+            (states,) = cls.SIGNATURE.decode_data(output)
+        except RPCError as error:
+            # A single broken pair reverts the lens, that is not for good
+            if "revert" not in str(error).lower():
+                cls.supported = False
+            LOGGER.warning("Lens read of %s pairs: %s", len(addresses), error)
+            return {}
+        except Exception as error:
+            LOGGER.warning("Lens read of %s pairs: %s", len(addresses), error)
+            return {}
+
+        data = {}
+        for state in states:
+            pair, gauge = state[0].lower(), state[7].lower()
+
+            for field, value in zip(cls.PAIR_FIELDS, state[1:8]):
+                data[CallPlan.key("Pair", pair, field)] = value
+
+            if gauge == ADDRESS_ZERO:
+                continue
+
+            for field, value in zip(cls.GAUGE_FIELDS, state[8:]):
+                data[CallPlan.key("Gauge", gauge, field)] = value
+
+        return data
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from app.settings import LOGGER, LOGS_BLOCK_RANGE
+
+from .engine import ENGINE
+
+
+def fetch_logs(topics, from_block, to_block, addresses=None):
+    """
+    Returns the logs matching the topics between two blocks (inclusive).
+
+    The range is split in windows of `LOGS_BLOCK_RANGE` blocks to stay
+    below the node limits, all fetched in JSON-RPC batches. The logs are
+    returned as answered by the node (hex strings, not web3 types).
+    """
+    windows = [
+        (start, min(start + LOGS_BLOCK_RANGE - 1, to_block))
+        for start in range(from_block, to_block + 1, LOGS_BLOCK_RANGE)
+    ]
+
+    filters = []
+    for start, end in windows:
+        log_filter = dict(
+            fromBlock=hex(start), toBlock=hex(end), topics=topics
+        )
+
+        if addresses:
+            log_filter["address"] = addresses
+
+        filters.append(("eth_getLogs", [log_filter]))
+
+    logs = []
+    answers = ENGINE.run(ENGINE.batch(filters))
+    for (start, end), window in zip(windows, answers):
+        LOGGER.debug(
+            "Fetched %s logs from block %s to %s.", len(window), start, end
+        )
+        logs.extend(window)
+
+    return logs
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+
+from app.settings import CACHE
+
+
+class PairIndex(object):
+    """
+    The factory pairs by their tokens and type, `(tokenA, tokenB, stable)`.
+
+    Filled as the pairs are synced, and kept in process and in a Redis
+    hash, so looking up a pair never asks the factory `getPair()`. A pair
+    address never changes, the hash is kept when the cache is cleared on
+    start.
+    """
+
+    CACHE_KEY = "pairs:index"
+
+    _pairs = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def text(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    @classmethod
+    def field_of(cls, token_a, token_b, stable):
+        token_a, token_b = sorted(
+            [cls.text(token_a).lower(), cls.text(token_b).lower()]
+        )
+
+        return "%s:%s:%d" % (token_a, token_b, bool(stable))
+
+    @classmethod
+    def add_many(cls, pairs):
+        """Indexes the `(token0, token1, stable, address)` of pairs."""
+        values = {
+            cls.field_of(token0, token1, stable): cls.text(address).lower()
+            for token0, token1, stable, address in pairs
+            if token0 and token1 and address
+        }
+
+        if not values:
+            return
+
+        with cls._lock:
+            cls._pairs.update(values)
+
+        if CACHE is not None:
+            CACHE.hset(cls.CACHE_KEY, mapping=values)
+
+    @classmethod
+    def get(cls, token_a, token_b, stable):
+        """Returns the pair address, `None` if there is no such pair."""
+        field = cls.field_of(token_a, token_b, stable)
+
+        with cls._lock:
+            if field in cls._pairs:
+                return cls._pairs[field]
+
+        address = (
+            CACHE.hget(cls.CACHE_KEY, field) if CACHE is not None else None
+        )
+        if address is None:
+            return None
+
+        address = cls.text(address)
+
+        with cls._lock:
+            cls._pairs[field] = address
+
+        return address
+
+    @classmethod
+    def is_empty(cls):
+        """No pairs were indexed yet, ex. before the first pairs sync."""
+        with cls._lock:
+            if cls._pairs:
+                return False
+
+        return CACHE is None or not CACHE.exists(cls.CACHE_KEY)
+
+    @classmethod
+    @contextmanager
+    def kept(cls):
+        """Restores the index after the context (clears the cache)."""
+        stored = (
+            CACHE.hgetall(cls.CACHE_KEY) if CACHE is not None else {}
+        )
+
+        try:
+            yield
+        finally:
+            if stored:
+                CACHE.hset(cls.CACHE_KEY, mapping=stored)
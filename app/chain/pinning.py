@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from app.settings import CACHE, LOGGER, RPC_CACHE_REDIS, RPC_CACHE_SECONDS
+
+from .engine import ENGINE
+from .provider import w3
+
+_pinned = ContextVar("pinned_block", default=None)
+
+# Reused by the next run while no new block was mined
+_last = None
+_last_lock = threading.Lock()
+
+
+class PinnedBlock(object):
+    """
+    The block every chain read of a sync run is made at.
+
+    Results are cached by `(block, target, calldata)` in process, and in
+    Redis with `RPC_CACHE_REDIS`, so repeated reads do not hit the node and
+    all the published numbers are consistent to a single block.
+    """
+
+    CACHE_KEY = "rpc:%s:%s:%s"
+
+    def __init__(self, number):
+        self.number = int(number)
+        self.results = {}
+        self.hits = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    @contextmanager
+    def within(cls, number=None):
+        """Pins the chain reads of the context to a block, the latest one
+        by default."""
+        global _last
+
+        if number is None:
+            number = w3.eth.block_number
+
+        with _last_lock:
+            if _last is None or _last.number != int(number):
+                _last = cls(number)
+            pinned = _last
+
+        token = _pinned.set(pinned)
+        try:
+            yield pinned
+        finally:
+            _pinned.reset(token)
+            LOGGER.debug(
+                "Chain reads at block %s: %s results cached, %s hits.",
+                pinned.number,
+                len(pinned.results),
+                pinned.hits,
+            )
+
+    @classmethod
+    def current(cls):
+        return _pinned.get()
+
+    @classmethod
+    def block_id(cls):
+        """Returns the pinned block number, `None` for the latest block."""
+        pinned = _pinned.get()
+
+        return pinned.number if pinned is not None else None
+
+    @classmethod
+    def block_number(cls):
+        """Returns the pinned block number, or the latest one."""
+        pinned = _pinned.get()
+
+        return pinned.number if pinned is not None else w3.eth.block_number
+
+    @staticmethod
+    def is_cacheable(call):
+        """Results post-processed by custom handlers are not cached."""
+        return all(
+            handler is None or getattr(handler, "__module__", "") == "builtins"
+            for _, handler in (call.returns or [])
+        )
+
+    @staticmethod
+    def key_of(call, kind="values"):
+        """
+        Returns the cache key of a call. Multicalls cache the list of
+        values of a call (`values`), single reads the call result.
+        """
+        handlers = tuple(
+            getattr(handler, "__name__", "")
+            for _, handler in (call.returns or [])
+        )
+
+        return (kind, call.target, call.data.hex(), handlers)
+
+    def get(self, call, kind="values"):
+        """Returns if the result is cached, together with the result."""
+        key = self.key_of(call, kind)
+
+        with self._lock:
+            if key in self.results:
+                self.hits += 1
+                return True, self.results[key]
+
+        if RPC_CACHE_REDIS:
+            value = CACHE.get(self.redis_key(key))
+            if value is not None:
+                result = json.loads(value)
+                with self._lock:
+                    self.results[key] = result
+                    self.hits += 1
+                return True, result
+
+        return False, None
+
+    def set(self, call, result, kind="values"):
+        key = self.key_of(call, kind)
+
+        with self._lock:
+            self.results[key] = result
+
+        if RPC_CACHE_REDIS:
+            try:
+                value = json.dumps(result)
+            except (TypeError, ValueError):
+                return
+
+            CACHE.set(self.redis_key(key), value, ex=RPC_CACHE_SECONDS)
+
+    def redis_key(self, key):
+        kind, target, data, handlers = key
+
+        return self.CACHE_KEY % (
+            self.number,
+            target.lower(),
+            ":".join([kind, data] + list(handlers)),
+        )
+
+
+def read(call):
+    """Runs a single `Call` at the pinned block, through its cache."""
+    pinned = _pinned.get()
+
+    if pinned is None:
+        return ENGINE.run(ENGINE.call(call))
+
+    cacheable = PinnedBlock.is_cacheable(call)
+    if cacheable:
+        cached, result = pinned.get(call, "result")
+        if cached:
+            return tuple(result) if isinstance(result, list) else result
+
+    result = ENGINE.run(ENGINE.call(call, pinned.number))
+
+    if cacheable:
+        pinned.set(call, result, "result")
+
+    return result
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+from app.settings import LOGGER
+
+from .engine import ENGINE
+from .immutable import ImmutableReads
+from .pinning import PinnedBlock
+
+
+class CallPlan(object):
+    """
+    Chain calls collected for a whole sync step, run as one multicall.
+
+    Models prepare their calls with `Class|id|field` result keys (see
+    `VeNFT.prepare_chain_calls`), `scoped()` routes the results back to
+    every item. The chain engine splits large plans in concurrent chunks.
+
+    Results already `known` (ex. read by the `PairsLens`) are routed
+    without calling the chain.
+
+    Every call succeeds or fails on its own: the results of the failed
+    ones are missing, and the calls are kept in `failed` until the next run
+    (see `failed_fields()`). When the whole aggregate call fails, the items
+    are called one by one, so a single broken item does not fail the others.
+
+    Calls are expected to name their results, `Call.returns`.
+    """
+
+    def __init__(self, known=None):
+        self.calls = []
+        self.failed = []
+        self.known = known or {}
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, calls):
+        self.calls.extend(calls)
+        return self
+
+    def run(self):
+        """
+        Runs and forgets the planned calls, returns their results.
+
+        Identical calls run once, and under a `PinnedBlock` the calls run
+        at that block with the results already read taken from its cache.
+        Immutable reads are only made once, see `ImmutableReads`.
+        """
+        calls, self.calls = self.calls, []
+        self.failed = []
+        pinned = PinnedBlock.current()
+
+        immutable = [ImmutableReads.is_immutable(call) for call in calls]
+        known = ImmutableReads.get_many(
+            [call for call, fixed in zip(calls, immutable) if fixed]
+        )
+
+        data = {}
+        pending = OrderedDict()
+        for call, fixed in zip(calls, immutable):
+            names = [name for name, _ in call.returns or []]
+            if names and all(name in self.known for name in names):
+                self.route(call, [self.known[name] for name in names], data)
+                continue
+
+            field = ImmutableReads.field_of(call) if fixed else None
+            if field in known:
+                self.route(call, known[field], data)
+                continue
+
+            cacheable = PinnedBlock.is_cacheable(call)
+
+            if pinned is not None and cacheable:
+                cached, values = pinned.get(call)
+                if cached:
+                    self.route(call, values, data)
+                    continue
+
+            key = PinnedBlock.key_of(call) if cacheable else id(call)
+            pending.setdefault(key, []).append(call)
+
+        if not pending:
+            return data
+
+        unique = [same_calls[0] for same_calls in pending.values()]
+        results = self.aggregate(unique, PinnedBlock.block_id())
+
+        learned = {}
+        for key, same_calls in pending.items():
+            call = same_calls[0]
+            if not all(name in results for name, _ in call.returns or []):
+                self.failed.extend(same_calls)
+                continue
+
+            values = [results[name] for name, _ in call.returns or []]
+            if pinned is not None and not isinstance(key, int):
+                pinned.set(call, values)
+            if ImmutableReads.is_immutable(call):
+                learned[ImmutableReads.field_of(call)] = values
+
+            for same_call in same_calls:
+                self.route(same_call, values, data)
+
+        ImmutableReads.set_many(learned)
+
+        return data
+
+    @staticmethod
+    def route(call, values, data):
+        for (name, _), value in zip(call.returns or [], values):
+            data[name] = value
+
+    def aggregate(self, calls, block_id=None):
+        try:
+            results, _ = ENGINE.run(ENGINE.aggregate(calls, block_id))
+            return results
+        except Exception as error:
+            LOGGER.warning(
+                "Multicall of %s calls failed, calling item by item: %s",
+                len(calls),
+                error,
+            )
+
+        data = {}
+        for item, item_calls in self.by_item(calls).items():
+            try:
+                results, _ = ENGINE.run(ENGINE.aggregate(item_calls, block_id))
+                data.update(results)
+            except Exception as error:
+                LOGGER.error("Chain calls for %s failed: %s", item, error)
+
+        return data
+
+    @staticmethod
+    def item(call):
+        """Returns the `Class|id` part of a call result key."""
+        key = call.returns[0][0] if call.returns else ""
+
+        return "|".join(str(key).split("|")[:2])
+
+    @classmethod
+    def by_item(cls, calls):
+        items = OrderedDict()
+
+        for call in calls:
+            items.setdefault(cls.item(call), []).append(call)
+
+        return items
+
+    def failed_fields(self, *parts):
+        """Returns the failed result names under a key prefix."""
+        prefix = self.key(*parts) + "|"
+
+        return [
+            name[len(prefix):]
+            for call in self.failed
+            for name, _ in call.returns or []
+            if name.startswith(prefix)
+        ]
+
+    @staticmethod
+    def key(*parts):
+        return "|".join(str(part) for part in parts)
+
+    @classmethod
+    def scoped(cls, data, *parts):
+        """Returns the results under a key prefix, without the prefix."""
+        prefix = cls.key(*parts) + "|"
+
+        return {
+            key[len(prefix):]: value
+            for key, value in data.items()
+            if key.startswith(prefix)
+        }
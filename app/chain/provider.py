@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from web3 import Web3
+
+from app.sessions import HTTP
+from app.settings import RPC_TIMEOUT, WEB3_PROVIDER_URI
+
+# The web3 client, on the shared keep-alive HTTP session
+w3 = Web3(
+    Web3.HTTPProvider(
+        WEB3_PROVIDER_URI,
+        request_kwargs={"timeout": RPC_TIMEOUT},
+        session=HTTP,
+    )
+)
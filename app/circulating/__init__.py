@@ -1,16 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import falcon
-from multicall import Call, Multicall
+from multicall import Call
 
+from app.chain import CallPlan
 from app.settings import (
-    CACHE,
     DEFAULT_TOKEN_ADDRESS,
     LOGGER,
     SUPPLY_CACHE_EXPIRATION,
     TREASURY_ADDRESS,
     VE_ADDRESS,
 )
+from app.sync import Snapshots
 
 
 class CirculatingSupply:
@@ -25,7 +26,7 @@ class CirculatingSupply:
     @classmethod
     def recache(cls):
 
-        supply_multicall = Multicall(
+        supply_multicall = CallPlan().add(
             [
                 Call(
                     DEFAULT_TOKEN_ADDRESS,
@@ -55,7 +56,7 @@ class CirculatingSupply:
             ]
         )
 
-        data = supply_multicall()
+        data = supply_multicall.run()
 
         token_multiplier = 10 ** data["token_decimals"]
         lock_multiplier = 10 ** data["lock_decimals"]
@@ -69,15 +70,16 @@ class CirculatingSupply:
         )
 
         serializable_tokens = data["circulating_supply"]
-        CACHE.set(cls.CACHE_KEY, serializable_tokens)
-        CACHE.expire("circulating:string", SUPPLY_CACHE_EXPIRATION)
+        Snapshots.set(
+            cls.CACHE_KEY, serializable_tokens, ttl=SUPPLY_CACHE_EXPIRATION
+        )
 
         LOGGER.debug("Cache updated for %s.", cls.CACHE_KEY)
         return data["circulating_supply"]
 
     def on_get(self, req, resp):
         """Caches and returns our supply info"""
-        supply_data = CACHE.get(self.CACHE_KEY)
+        supply_data = Snapshots.get(self.CACHE_KEY)
 
         if supply_data:
             resp.text = supply_data
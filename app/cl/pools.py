@@ -4,12 +4,14 @@ import json
 import time
 from decimal import Decimal
 
-import requests
-from multicall import Call, Multicall
+from multicall import Call
 
+from app.chain import CallPlan
 from app.cl.range_tvl import range_tvl
 from app.cl.subgraph import get_cl_subgraph_pools, get_cl_subgraph_tokens
+from app.sessions import HTTP
 from app.settings import CACHE, LOGGER, NATIVE_TOKEN_ADDRESS
+from app.sync import Snapshots
 
 decimal.getcontext().prec = 50
 
@@ -23,7 +25,7 @@ def get_prices():
 
 
 def get_pairs_v2():
-    pairs = CACHE.get("pairs:json")
+    pairs = Snapshots.get("pairs:json")
     return pairs if pairs else {}
 
 
@@ -169,7 +171,7 @@ def _fetch_pools():
                 [[pool_address, lambda v: v[0]]],
             )
         )
-    for pool_address, value in Multicall(calls)().items():
+    for pool_address, value in CallPlan().add(calls).run().items():
         pools[pool_address]["totalVeShareByPeriod"] += value
 
     # fetch pair's vote bribes
@@ -189,7 +191,7 @@ def _fetch_pools():
                     [[key, lambda v: v[0]]],
                 )
             )
-    for key, value in Multicall(calls)().items():
+    for key, value in CallPlan().add(calls).run().items():
         pool_address, token_address = key.split("-")
         if value > 0:
             pools[pool_address]["voteBribes"][token_address] = value
@@ -198,9 +200,9 @@ def _fetch_pools():
     for pool_address, pool in pools.items():
         key = pool_address
         calls.append(
-            Call(pool_address, ["fee()(uint24)"], [[key, lambda v: v[0]]])
+            Call(pool_address, ["fee()(uint24)"], [[key, None]])
         )
-    for key, value in Multicall(calls)().items():
+    for key, value in CallPlan().add(calls).run().items():
         pool_address = key
         pools[pool_address]["initialFee"] = str(int(value))
 
@@ -223,7 +225,7 @@ def _fetch_pools():
                 ),
             )
 
-    for key, value in Multicall(calls)().items():
+    for key, value in CallPlan().add(calls).run().items():
         pool_address, token_address = key.split("-")
         _reward_rates[pool_address][token_address] = value
 
@@ -336,7 +338,7 @@ def _fetch_pools():
 def get_cl_pools():
     try:
         pools = _fetch_pools()
-        CACHE.set("cl_pools", json.dumps(pools))
+        Snapshots.set("cl_pools", json.dumps(pools))
     except Exception as e:
         LOGGER.warning(f"Unable to fetch the pools from subgraph: {e}")
         # pools = json.loads(CACHE.get('cl_pools'))
@@ -385,7 +387,7 @@ def get_unlimited_lge_chart():
             "{ user timestamp amount totalRaised } }" % (skip, limit)
         )
 
-        response = requests.post(
+        response = HTTP.post(
             url=(
                 "https://api.thegraph.com/subgraphs/name/"
                 "sullivany/unlimited-lge"
@@ -7,6 +7,7 @@ from app.cl.constants.tokenType import (
     token_type_dict,
     weth_address,
 )
+from app.sessions import HTTP
 from app.settings import CACHE, DEFAULT_TOKEN_ADDRESS, LOGGER
 
 cl_subgraph_url = (
@@ -49,7 +50,7 @@ def try_subgraph(urls, query):
     """
     for url in urls:
         try:
-            response = requests.post(url, json={"query": query}, timeout=10)
+            response = HTTP.post(url, json={"query": query}, timeout=10)
             if response.status_code == 200:
                 return response
         except requests.RequestException as e:
@@ -4,12 +4,12 @@ import json
 import math
 
 import falcon
-import requests
 from versiontools import Version
 
 from app import __version__
 from app.misc import JSONEncoder
 from app.pairs import Pair, Token
+from app.sessions import HTTP
 from app.settings import (
     CACHE,
     DEFAULT_TOKEN_ADDRESS,
@@ -17,6 +17,7 @@ from app.settings import (
     ROUTE_TOKEN_ADDRESSES,
     STABLE_TOKEN_ADDRESS,
 )
+from app.sync import Snapshots
 
 
 class Configuration(object):
@@ -47,7 +48,7 @@ class Configuration(object):
             ]
             if pairs_addresses:
                 for sub_pair_group in pairs_addresses:
-                    res = requests.get(
+                    res = HTTP.get(
                         DEXSCREENER_ENDPOINT + ",".join(sub_pair_group)
                     ).json()
 
@@ -73,7 +74,7 @@ class Configuration(object):
                     volume_h6=volume_h6,
                     volume_h24=volume_h24,
                 )
-                CACHE.set(CACHE_KEY, json.dumps(data, cls=JSONEncoder))
+                Snapshots.set(CACHE_KEY, json.dumps(data, cls=JSONEncoder))
                 return data
             return dict(
                 volume_m5=None, volume_h1=None, volume_h6=None, volume_h24=None
@@ -109,8 +110,9 @@ class Configuration(object):
             tvl = None
             max_apr = None
 
-        if CACHE.get("volume:json"):
-            volume = json.loads(CACHE.get("volume:json").decode("utf-8"))
+        cached_volume = Snapshots.get("volume:json")
+        if cached_volume:
+            volume = json.loads(cached_volume.decode("utf-8"))
         else:
             volume = self.dexscreener_volume_data()
         resp.status = falcon.HTTP_200
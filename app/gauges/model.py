@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from multicall import Call, Multicall
+from multicall import Call
 from walrus import (
     BooleanField,
     FloatField,
@@ -12,6 +12,8 @@ from walrus import (
 from web3.constants import ADDRESS_ZERO
 
 from app.assets import Token
+from app.chain import CallPlan, read
+from app.misc import ModelUteis
 from app.settings import (
     CACHE,
     DEFAULT_TOKEN_ADDRESS,
@@ -73,305 +75,486 @@ class Gauge(Model):
     @classmethod
     def from_chain(cls, address):
         """Fetch gauge data from the chain."""
+        return cls.from_chain_many([address]).get(address.lower())
 
-        address = address.lower()
+    @classmethod
+    def from_chain_many(cls, addresses, known=None):
+        """
+        Fetches gauges, with their rewards and APRs, from the chain.
+
+        Every step (gauge data, wrapped bribes, rewards, votes) is a single
+        multicall for all the gauges. Returns the gauges by address, gauges
+        not alive or without bribes are left out. Gauge results already
+        `known` (see `PairsLens`) are not read again.
+        """
+        addresses = [address.lower() for address in addresses]
+
+        if not addresses:
+            return {}
+
+        token = Token.find(DEFAULT_TOKEN_ADDRESS)
+        if not token:
+            LOGGER.warning(
+                f"Token not found for address: {DEFAULT_TOKEN_ADDRESS}"
+            )
+            return {}
+
+        plan = CallPlan(known)
+        for address in addresses:
+            plan.add(cls.prepare_chain_calls(address))
+        data = plan.run()
+
+        gauges_data = {}
+        for address in addresses:
+            try:
+                gauge_data = CallPlan.scoped(data, cls.__name__, address)
+                if not gauge_data:
+                    raise ValueError("no chain data")
+
+                failed = plan.failed_fields(cls.__name__, address)
+                if failed:
+                    raise ValueError("failed calls %s" % failed)
+
+                gauge_data = cls.from_chain_calls(address, gauge_data, token)
+            except Exception as e:
+                LOGGER.error(
+                    "Error fetching gauge data from chain for address %s: %s",
+                    address,
+                    e,
+                )
+                continue
 
-        data = {}
+            if gauge_data is not None:
+                gauges_data[address] = gauge_data
 
-        try:
-            data_calls = Multicall(
+        for address, gauge_data in gauges_data.items():
+            plan.add(
                 [
                     Call(
-                        address,
-                        "totalSupply()(uint256)",
-                        [["total_supply", None]],
-                    ),
-                    Call(
-                        address,
+                        WRAPPED_BRIBE_FACTORY_ADDRESS,
                         [
-                            "rewardRate(address)(uint256)",
-                            DEFAULT_TOKEN_ADDRESS,
+                            "oldBribeToNew(address)(address)",
+                            gauge_data["bribe_address"],
                         ],
-                        [["reward_rate", None]],
-                    ),
-                    Call(
-                        VOTER_ADDRESS,
-                        ["external_bribes(address)(address)", address],
-                        [["bribe_address", None]],
-                    ),
-                    Call(
-                        VOTER_ADDRESS,
-                        ["internal_bribes(address)(address)", address],
-                        [["fees_address", None]],
-                    ),
-                    Call(
-                        VOTER_ADDRESS,
-                        ["isAlive(address)(bool)", address],
-                        [["isAlive", None]],
-                    ),
+                        [
+                            [
+                                CallPlan.key(
+                                    cls.__name__, address, "wrapped_bribe"
+                                ),
+                                None,
+                            ]
+                        ],
+                    )
                 ]
-            )()
-            data.update(data_calls)
+            )
+        data = plan.run()
 
-            if not data.get("isAlive"):
-                LOGGER.warning(f"Gauge {address} is not Alive.")
-                return None
+        gauges = {}
+        for address, gauge_data in gauges_data.items():
+            wrapped_bribe_address = data.get(
+                CallPlan.key(cls.__name__, address, "wrapped_bribe")
+            )
+            if wrapped_bribe_address not in (ADDRESS_ZERO, "", None):
+                gauge_data["wrapped_bribe_address"] = wrapped_bribe_address
 
-            data["total_supply"] = data["total_supply"] / cls.DEFAULT_DECIMALS
+            try:
+                gauges[address] = ModelUteis.save_over(
+                    cls, address=address, **gauge_data
+                )
+                LOGGER.debug("Fetched %s:%s.", cls.__name__, address)
+            except Exception as e:
+                LOGGER.error(f"Error processing bribe data for {address}: {e}")
+
+        cls._fetch_external_rewards(
+            [
+                gauge
+                for address, gauge in gauges.items()
+                if "wrapped_bribe_address" in gauges_data[address]
+            ]
+        )
+        cls._fetch_internal_rewards(list(gauges.values()))
+        cls._update_apr(list(gauges.values()))
 
-            token = Token.find(DEFAULT_TOKEN_ADDRESS)
-            if token:
-                try:
-                    if data.get("reward_rate") is not None:
-                        data["reward"] = (
-                            data["reward_rate"]
-                            / 10 ** token.decimals
-                            * cls.DAY_IN_SECONDS
-                        )
-                    else:
-                        LOGGER.warning(
-                            f"No reward rate data for address {address}"
-                        )
-                        data["reward"] = 0
-                except Exception as e:
-                    LOGGER.error(
-                        f"Error processing reward rate {address}: {e}"
-                    )
+        return gauges
 
-                try:
-                    if data.get("bribe_address") in (ADDRESS_ZERO, None):
-                        LOGGER.warning(
-                            f"No bribe address data for address {address}"
-                        )
-                        data["bribe_address"] = ADDRESS_ZERO
-                        data["fees_address"] = ADDRESS_ZERO
-                        data["total_supply"] = 0
-                    else:
-                        if data.get("bribe_address") not in (
-                            ADDRESS_ZERO,
-                            None,
-                        ):
-                            data["wrapped_bribe_address"] = Call(
-                                WRAPPED_BRIBE_FACTORY_ADDRESS,
-                                [
-                                    "oldBribeToNew(address)(address)",
-                                    data["bribe_address"],
-                                ],
-                            )()
-                        else:
-                            data["wrapped_bribe_address"] = ADDRESS_ZERO
-
-                        if data.get("wrapped_bribe_address") in (
-                            ADDRESS_ZERO,
-                            "",
-                        ):
-                            del data["wrapped_bribe_address"]
-
-                        cls.query_delete(cls.address == address.lower())
-                        data["isAlive"] = data.get("isAlive")
-
-                        gauge = cls.create(address=address, **data)
-                        LOGGER.debug("Fetched %s:%s.", cls.__name__, address)
-
-                        if data.get("wrapped_bribe_address") not in (
-                            ADDRESS_ZERO,
-                            None,
-                        ):
-                            cls._fetch_external_rewards(gauge)
-
-                        cls._fetch_internal_rewards(gauge)
-                        cls._update_apr(gauge)
-                        return gauge
-
-                except Exception as e:
-                    LOGGER.error(
-                        f"Error processing bribe data for {address}: {e}"
-                    )
-
-            else:
-                LOGGER.warning(
-                    f"Token not found for address: {DEFAULT_TOKEN_ADDRESS}"
-                )
+    @classmethod
+    def prepare_chain_calls(cls, address):
+        """Returns prepared gauge and voter calls for a gauge address."""
+        key_prefix = "|".join([cls.__name__, address])
 
-        except Exception as e:
-            LOGGER.error(
-                "Error fetching gauge data from chain for address %s: %s",
+        return [
+            Call(
+                address,
+                "totalSupply()(uint256)",
+                [["%s|total_supply" % key_prefix, None]],
+            ),
+            Call(
                 address,
-                e,
+                [
+                    "rewardRate(address)(uint256)",
+                    DEFAULT_TOKEN_ADDRESS,
+                ],
+                [["%s|reward_rate" % key_prefix, None]],
+            ),
+            Call(
+                VOTER_ADDRESS,
+                ["external_bribes(address)(address)", address],
+                [["%s|bribe_address" % key_prefix, None]],
+            ),
+            Call(
+                VOTER_ADDRESS,
+                ["internal_bribes(address)(address)", address],
+                [["%s|fees_address" % key_prefix, None]],
+            ),
+            Call(
+                VOTER_ADDRESS,
+                ["isAlive(address)(bool)", address],
+                [["%s|isAlive" % key_prefix, None]],
+            ),
+        ]
+
+    @classmethod
+    def from_chain_calls(cls, address, data, token):
+        """
+        Returns the gauge data from the prepared calls data, or `None` for
+        gauges not alive or without bribes.
+        """
+        if not data.get("isAlive"):
+            LOGGER.warning(f"Gauge {address} is not Alive.")
+            return None
+
+        data["total_supply"] = data["total_supply"] / cls.DEFAULT_DECIMALS
+
+        if data.get("reward_rate") is not None:
+            data["reward"] = (
+                data["reward_rate"] / 10 ** token.decimals * cls.DAY_IN_SECONDS
             )
+        else:
+            LOGGER.warning(f"No reward rate data for address {address}")
+            data["reward"] = 0
 
-        return None
+        if data.get("bribe_address") in (ADDRESS_ZERO, None):
+            LOGGER.warning(f"No bribe address data for address {address}")
+            return None
+
+        return data
 
     @classmethod
     def _calc_rebase_apr(cls):
         """Rebase the APR."""
-        minter_address = Call(VOTER_ADDRESS, "minter()(address)")()
-        weekly = Call(minter_address, "weekly_emission()(uint256)")()
-        supply = Call(minter_address, "circulating_supply()(uint256)")()
-        growth = Call(
-            minter_address, ["calculate_growth(uint256)(uint256)", weekly]
-        )()
+        minter_address = read(Call(VOTER_ADDRESS, "minter()(address)"))
+        weekly = read(Call(minter_address, "weekly_emission()(uint256)"))
+        supply = read(Call(minter_address, "circulating_supply()(uint256)"))
+        growth = read(
+            Call(
+                minter_address, ["calculate_growth(uint256)(uint256)", weekly]
+            )
+        )
 
         return ((growth * 52) / supply) * 100
 
     @classmethod
-    def _update_apr(cls, gauge):
-        """Update the APR for the gauge."""
+    def _update_apr(cls, gauges):
+        """Update the APR of the gauges."""
+        if not gauges:
+            return
+
+        from app.pairs.model import Pair
+
+        plan = CallPlan()
+        for gauge in gauges:
+            try:
+                pair = Pair.get(Pair.gauge_address == gauge.address)
+            except ValueError:
+                LOGGER.error(f"No pair found for gauge {gauge.address}.")
+                continue
+
+            plan.add(
+                [
+                    Call(
+                        VOTER_ADDRESS,
+                        ["weights(address)(uint256)", pair.address],
+                        [[CallPlan.key(cls.__name__, gauge.address), None]],
+                    )
+                ]
+            )
 
         try:
-            from app.pairs.model import Pair
+            votes_data = plan.run()
+            token = Token.find(DEFAULT_TOKEN_ADDRESS)
+            rebase_apr = cls._calc_rebase_apr()
+        except Exception as e:
+            LOGGER.error(f"Error updating APR for gauges: {e}")
+            return
+
+        for gauge in gauges:
+            try:
+                votes = votes_data[CallPlan.key(cls.__name__, gauge.address)]
+                votes = votes / 10 ** token.decimals
+
+                gauge.apr = rebase_apr
+                gauge.rebase_apr += gauge.apr
+                if token.price and votes * token.price > 0:
+                    gauge.votes = votes
+                    gauge.apr += (
+                        (gauge.tbv * 52) / (votes * token.price)
+                    ) * 100
+                    gauge.bribes_apr += (
+                        (gauge.total_bribes * 52) / (votes * token.price)
+                    ) * 100
+                    gauge.fees_apr += (
+                        (gauge.total_fees * 52) / (votes * token.price)
+                    ) * 100
+                    gauge.save()
+
+            except Exception as e:
+                LOGGER.error(
+                    f"Error updating APR for gauge {gauge.address}: {e}"
+                )
 
-            pair = Pair.get(Pair.gauge_address == gauge.address)
-            votes = Call(
-                VOTER_ADDRESS, ["weights(address)(uint256)", pair.address]
-            )()
+    @classmethod
+    def refresh_votes(cls, gauges):
+        """Refreshes the votes and vote APRs of already synced gauges."""
 
-            token = Token.find(DEFAULT_TOKEN_ADDRESS)
-            votes = votes / 10 ** token.decimals
+        from app.pairs.model import Pair
+
+        pairs = {}
+        for gauge in gauges:
+            try:
+                pairs[gauge.address] = Pair.get(
+                    Pair.gauge_address == gauge.address
+                )
+            except ValueError:
+                LOGGER.debug("No pair found for gauge %s.", gauge.address)
+
+        if not pairs:
+            return
+
+        votes_data = CallPlan().add(
+            [
+                Call(
+                    VOTER_ADDRESS,
+                    ["weights(address)(uint256)", pair.address],
+                    [[gauge_address, None]],
+                )
+                for gauge_address, pair in pairs.items()
+            ]
+        ).run()
+
+        token = Token.find(DEFAULT_TOKEN_ADDRESS)
+        rebase_apr = cls._calc_rebase_apr()
+
+        for gauge in gauges:
+            if gauge.address not in votes_data:
+                continue
+
+            votes = votes_data[gauge.address] / 10 ** token.decimals
+
+            gauge.votes = votes
+            gauge.rebase_apr = rebase_apr
+            gauge.apr = rebase_apr
 
-            gauge.apr = cls._calc_rebase_apr()
-            gauge.rebase_apr += gauge.apr
             if token.price and votes * token.price > 0:
-                gauge.votes = votes
-                gauge.apr += ((gauge.tbv * 52) / (votes * token.price)) * 100
-                gauge.bribes_apr += (
-                    (gauge.total_bribes * 52) / (votes * token.price)
-                ) * 100
-                gauge.fees_apr += (
-                    (gauge.total_fees * 52) / (votes * token.price)
+                votes_value = votes * token.price
+                gauge.apr += ((gauge.tbv * 52) / votes_value) * 100
+                gauge.bribes_apr = (
+                    (gauge.total_bribes * 52) / votes_value
                 ) * 100
-                gauge.save()
+                gauge.fees_apr = ((gauge.total_fees * 52) / votes_value) * 100
 
-        except Exception as e:
-            LOGGER.error(f"Error updating APR for gauge {gauge.address}: {e}")
+            gauge.save()
 
     @classmethod
-    def _fetch_external_rewards(cls, gauge):
-        """Fetch external rewards for the gauge."""
+    def _fetch_external_rewards(cls, gauges):
+        """Fetch external rewards for the gauges."""
 
-        try:
-            LOGGER.debug("Fetched %s:%s.", cls.__name__, gauge)
-
-            tokens_len = Call(
-                gauge.wrapped_bribe_address, "rewardsListLength()(uint256)"
-            )()
-            reward_calls = []
-
-            for idx in range(tokens_len):
-                bribe_token_address = Call(
-                    gauge.wrapped_bribe_address,
-                    ["rewards(uint256)(address)", idx],
-                )()
-                reward_calls.append(
+        plan = CallPlan()
+        for gauge in gauges:
+            plan.add(
+                [
                     Call(
                         gauge.wrapped_bribe_address,
-                        ["left(address)(uint256)", bribe_token_address],
-                        [[bribe_token_address, None]],
+                        "rewardsListLength()(uint256)",
+                        [[CallPlan.key(cls.__name__, gauge.address), None]],
                     )
+                ]
+            )
+        lengths = plan.run()
+
+        for gauge in gauges:
+            tokens_len = lengths.get(CallPlan.key(cls.__name__, gauge.address))
+
+            for idx in range(tokens_len or 0):
+                plan.add(
+                    [
+                        Call(
+                            gauge.wrapped_bribe_address,
+                            ["rewards(uint256)(address)", idx],
+                            [
+                                [
+                                    CallPlan.key(
+                                        cls.__name__, gauge.address, idx
+                                    ),
+                                    None,
+                                ]
+                            ],
+                        )
+                    ]
                 )
-
-            rewards_data = Multicall(reward_calls)()
-
-            for bribe_token_address, amount in rewards_data.items():
-                # !We need all data in the UI in order
-                # !to show the correct Rewards.
-                # if amount == 0:
-                #     continue
-                bribe_token_address_str = (
-                    bribe_token_address.decode("utf-8")
-                    if isinstance(bribe_token_address, bytes)
-                    else bribe_token_address
+        bribe_tokens = plan.run()
+
+        for gauge in gauges:
+            for bribe_token_address in CallPlan.scoped(
+                bribe_tokens, cls.__name__, gauge.address
+            ).values():
+                plan.add(
+                    [
+                        Call(
+                            gauge.wrapped_bribe_address,
+                            ["left(address)(uint256)", bribe_token_address],
+                            [
+                                [
+                                    CallPlan.key(
+                                        cls.__name__,
+                                        gauge.address,
+                                        bribe_token_address,
+                                    ),
+                                    None,
+                                ]
+                            ],
+                        )
+                    ]
                 )
+        left = plan.run()
 
-                LOGGER.debug(
-                    "Checking bribe token %s:%s.",
-                    cls.__name__,
-                    bribe_token_address_str,
-                )
+        for gauge in gauges:
+            try:
+                LOGGER.debug("Fetched %s:%s.", cls.__name__, gauge)
 
-                token = Token.find(bribe_token_address_str)
+                rewards_data = CallPlan.scoped(
+                    left, cls.__name__, gauge.address
+                )
 
-                if token is not None:
-                    token_bribes = amount / 10 ** token.decimals
-                    gauge.rewards[token.address] = token_bribes
-                    gauge.bribes[token.address] = token_bribes
+                for bribe_token_address, amount in rewards_data.items():
+                    # !We need all data in the UI in order
+                    # !to show the correct Rewards.
+                    # if amount == 0:
+                    #     continue
+                    bribe_token_address_str = (
+                        bribe_token_address.decode("utf-8")
+                        if isinstance(bribe_token_address, bytes)
+                        else bribe_token_address
+                    )
 
                     LOGGER.debug(
-                        "Bribe token found %s: %s %s.",
+                        "Checking bribe token %s:%s.",
                         cls.__name__,
-                        token.symbol,
-                        token_bribes,
+                        bribe_token_address_str,
                     )
 
-                    if token.price:
-                        gauge.tbv += token_bribes * token.price
-                        gauge.total_bribes += token_bribes * token.price
+                    token = Token.find(bribe_token_address_str)
 
-            gauge.save()
-        except Exception as e:
-            LOGGER.error(
-                f"Error fetching external rewards for {gauge.address}: {e}"
-            )
+                    if token is not None:
+                        token_bribes = amount / 10 ** token.decimals
+                        gauge.rewards[token.address] = token_bribes
+                        gauge.bribes[token.address] = token_bribes
 
-    @classmethod
-    def _fetch_internal_rewards(cls, gauge):
-        """Fetch internal rewards for the gauge."""
+                        LOGGER.debug(
+                            "Bribe token found %s: %s %s.",
+                            cls.__name__,
+                            token.symbol,
+                            token_bribes,
+                        )
 
-        try:
-            from app.pairs.model import Pair
+                        if token.price:
+                            gauge.tbv += token_bribes * token.price
+                            gauge.total_bribes += token_bribes * token.price
+
+                gauge.save()
+            except Exception as e:
+                LOGGER.error(
+                    f"Error fetching external rewards for {gauge.address}: {e}"
+                )
 
-            pair = Pair.get(Pair.gauge_address == gauge.address)
-            fees_data = Multicall(
+    @classmethod
+    def _fetch_internal_rewards(cls, gauges):
+        """Fetch internal rewards for the gauges."""
+
+        from app.pairs.model import Pair
+
+        plan = CallPlan()
+        pairs = {}
+        for gauge in gauges:
+            try:
+                pair = Pair.get(Pair.gauge_address == gauge.address)
+            except ValueError as e:
+                LOGGER.error(
+                    f"Error fetching internal rewards for {gauge.address}: {e}"
+                )
+                continue
+
+            pairs[gauge.address] = pair
+            key_prefix = CallPlan.key(cls.__name__, gauge.address)
+            plan.add(
                 [
                     Call(
                         gauge.fees_address,
                         ["left(address)(uint256)", pair.token0_address],
-                        [["fees0", None]],
+                        [["%s|fees0" % key_prefix, None]],
                     ),
                     Call(
                         gauge.fees_address,
                         ["left(address)(uint256)", pair.token1_address],
-                        [["fees1", None]],
+                        [["%s|fees1" % key_prefix, None]],
                     ),
                 ]
-            )()
+            )
+        data = plan.run()
 
-            fees = [
-                [pair.token0_address, fees_data["fees0"]],
-                [pair.token1_address, fees_data["fees1"]],
-            ]
+        for gauge in gauges:
+            if gauge.address not in pairs:
+                continue
 
-            for token_address, fee in fees:
-                token_address_str = (
-                    token_address.decode("utf-8")
-                    if isinstance(token_address, bytes)
-                    else token_address
-                )
+            try:
+                pair = pairs[gauge.address]
+                fees_data = CallPlan.scoped(data, cls.__name__, gauge.address)
 
-                token = Token.find(token_address_str)
-                token_fees = fee / 10 ** token.decimals
+                fees = [
+                    [pair.token0_address, fees_data["fees0"]],
+                    [pair.token1_address, fees_data["fees1"]],
+                ]
 
-                if gauge.rewards.get(token_address):
-                    gauge.rewards[token_address] = (
-                        float(gauge.rewards[token_address]) + token_fees
-                    )
-                    gauge.fees[token_address] = token_fees
-                elif fee > 0:
-                    gauge.rewards[token_address] = token_fees
-                    gauge.fees[token_address] = token_fees
-                    LOGGER.debug(
-                        "Fees token found %s: %s %s.",
-                        cls.__name__,
-                        token.symbol,
-                        fee,
+                for token_address, fee in fees:
+                    token_address_str = (
+                        token_address.decode("utf-8")
+                        if isinstance(token_address, bytes)
+                        else token_address
                     )
 
-                if token.price:
-                    gauge.tbv += fee / 10 ** token.decimals * token.price
-                    gauge.total_fees += token_fees * token.price
+                    token = Token.find(token_address_str)
+                    token_fees = fee / 10 ** token.decimals
 
-            gauge.save()
-        except Exception as e:
-            LOGGER.error(
-                f"Error fetching internal rewards for {gauge.address}: {e}"
-            )
+                    if gauge.rewards.get(token_address):
+                        gauge.rewards[token_address] = (
+                            float(gauge.rewards[token_address]) + token_fees
+                        )
+                        gauge.fees[token_address] = token_fees
+                    elif fee > 0:
+                        gauge.rewards[token_address] = token_fees
+                        gauge.fees[token_address] = token_fees
+                        LOGGER.debug(
+                            "Fees token found %s: %s %s.",
+                            cls.__name__,
+                            token.symbol,
+                            fee,
+                        )
+
+                    if token.price:
+                        gauge.tbv += fee / 10 ** token.decimals * token.price
+                        gauge.total_fees += token_fees * token.price
+
+                gauge.save()
+            except Exception as e:
+                LOGGER.error(
+                    f"Error fetching internal rewards for {gauge.address}: {e}"
+                )
@@ -5,6 +5,8 @@ import decimal
 import json
 import uuid
 
+from walrus.models import _ContainerField
+
 
 class ModelUteis:
     """
@@ -37,6 +39,45 @@ class ModelUteis:
         valid_decimals = decimals is not None and isinstance(decimals, int)
         return valid_decimals
 
+    @staticmethod
+    def save_over(model_class, **data):
+        """
+        Saves a model over the stored one, if any. Unlike `query_delete()`
+        and `create()`, readers never find it missing or half written.
+
+        Container fields (ex. `HashField`) are emptied, like on a delete.
+
+        :param model_class: Walrus model class of the instance.
+        :return: The saved model instance.
+        """
+        instance = model_class(**data)
+        hash_id = instance.get_hash_id()
+
+        try:
+            previous = model_class.load(hash_id, convert_key=False)
+        except KeyError:
+            previous = None
+
+        # The stored fields are replaced in a single transaction
+        with model_class.__database__.pipeline() as pipe:
+            pipe.delete(hash_id)
+            for field in model_class._fields.values():
+                if isinstance(field, _ContainerField):
+                    pipe.delete(field.__key__(instance))
+            pipe.hset(hash_id, mapping=instance._get_data_dict())
+            pipe.sadd(model_class._query.all_index().key, hash_id)
+            pipe.execute()
+
+        for field in model_class._indexes:
+            for index in field.get_indexes():
+                if previous is not None and index.field_value(
+                    previous
+                ) != index.field_value(instance):
+                    index.remove(previous)
+                index.save(instance)
+
+        return instance
+
 
 class JSONEncoder(json.JSONEncoder):
     """
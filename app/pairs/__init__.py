@@ -1,15 +1,47 @@
 # -*- coding: utf-8 -*-
 
 import json
+import time
 from multiprocessing.pool import ThreadPool
 
 import falcon
 from web3 import Web3
+from web3.constants import ADDRESS_ZERO
 
 from app.assets import Token
+from app.chain import (
+    PairIndex,
+    PinnedBlock,
+    blocks_may_have_logs,
+    fetch_logs,
+)
 from app.gauges import Gauge
 from app.misc import JSONEncoder
-from app.settings import CACHE, LOGGER, reset_multicall_pool_executor
+from app.settings import (
+    CACHE,
+    DEFAULT_TOKEN_ADDRESS,
+    FACTORY_ADDRESS,
+    LOGGER,
+    PAIRS_FULL_SYNC_EVERY,
+    PAIRS_MAX_INCREMENTAL_BLOCKS,
+    PAIRS_SYNC_BATCH,
+    PAIRS_SYNC_BUDGET,
+    PAIRS_SYNC_SECONDS,
+    PAIRS_TIERS,
+    SYNC_LEASE_SECONDS,
+    SYNC_SHARDS,
+    SYNC_SHARDS_TIMEOUT,
+    VOTER_ADDRESS,
+)
+from app.sync import (
+    LEADER_LEASE,
+    Checkpoint,
+    Deadline,
+    Lease,
+    Snapshots,
+    Tiers,
+    bind_context,
+)
 
 from .model import Pair
 
@@ -20,9 +52,94 @@ class Pairs(object):
 
     CACHE_KEY = "pairs:json"
     ADDRESSES_CACHE_KEY = "pairs:addresses"
+    LAST_BLOCK_CACHE_KEY = "pairs:last_block"
+    RUNS_CACHE_KEY = "pairs:runs"
+    SWEEPS_CACHE_KEY = "pairs:sweeps"
+    # Pairs due but left over by the budget of the last sweep
+    OVERFLOW_CACHE_KEY = "pairs:overflow"
+    DEFERRED_CACHE_KEY = "pairs:deferred"
+    # Patched pairs, by the generation of their patch
+    PATCHES_CACHE_KEY = "pairs:patches"
+    # Gauge fields changed by the votes (see `Gauge.refresh_votes()`)
+    VOTES_FIELDS = ("votes", "apr", "rebase_apr", "bribes_apr", "fees_apr")
+    SHARDS_CYCLE_CACHE_KEY = "pairs:shards:cycle"
+    SHARDS_CACHE_KEY = "pairs:shards:%s"
+    LOCK_NAME = "pairs:json"
+    LOCK_TTL = 30 * 1000
+    CHECKPOINT = Checkpoint("pairs", PAIRS_SYNC_SECONDS)
+    TIERS = Tiers.parse(PAIRS_TIERS)
 
     @classmethod
     def sync(cls):
+        """
+        Syncs the pairs from chain.
+
+        Every `PAIRS_FULL_SYNC_EVERY` runs (or when catching up is not
+        possible) all the pairs are re-read. In between, only new pairs and
+        pairs that emitted a `Sync` event since the last run are refreshed.
+
+        When the new blocks logs bloom shows no activity on any tracked
+        contract, the chain is not read and only the values depending on
+        the token prices are recomputed.
+        """
+        current_block = PinnedBlock.block_number()
+        last_block = CACHE.get(cls.LAST_BLOCK_CACHE_KEY)
+
+        if last_block is not None and not blocks_may_have_logs(
+            int(last_block) + 1, current_block, cls.tracked_addresses()
+        ):
+            LOGGER.info(
+                "No pairs activity up to block %s, skipping chain sync.",
+                current_block,
+            )
+            for pair in Pair.all():
+                pair.refresh_tvl()
+
+            CACHE.set(cls.LAST_BLOCK_CACHE_KEY, current_block)
+            Pairs.recache()
+            return
+
+        runs = CACHE.incr(cls.RUNS_CACHE_KEY)
+
+        if (
+            last_block is None
+            or PAIRS_FULL_SYNC_EVERY <= 1
+            or runs % PAIRS_FULL_SYNC_EVERY == 0
+            or current_block - int(last_block) > PAIRS_MAX_INCREMENTAL_BLOCKS
+        ):
+            cls.full_sync()
+        else:
+            cls.incremental_sync(int(last_block) + 1, current_block)
+
+        CACHE.set(cls.LAST_BLOCK_CACHE_KEY, current_block)
+
+        Pairs.recache()
+
+    @classmethod
+    def tracked_addresses(cls):
+        """Returns the contracts whose logs can change the pairs data."""
+        addresses = [FACTORY_ADDRESS, VOTER_ADDRESS]
+        addresses.extend(
+            json.loads(CACHE.get(cls.ADDRESSES_CACHE_KEY) or "[]")
+        )
+
+        for gauge in Gauge.all():
+            addresses.extend(
+                address
+                for address in (
+                    gauge.address,
+                    gauge.bribe_address,
+                    gauge.fees_address,
+                    gauge.wrapped_bribe_address,
+                )
+                if address and address != ADDRESS_ZERO
+            )
+
+        return addresses
+
+    @classmethod
+    def full_sync(cls):
+        """Re-reads every pair from chain."""
         addresses = Pair.chain_addresses()
 
         previous_addresses_str = CACHE.get(cls.ADDRESSES_CACHE_KEY)
@@ -37,19 +154,258 @@ class Pairs(object):
 
         CACHE.set(cls.ADDRESSES_CACHE_KEY, json.dumps(addresses))
 
+        # Pairs synced before the index existed (ex. on resume)
+        if PairIndex.is_empty():
+            Pair.index(Pair.all())
+
+        deferred = cls.pop_deferred()
+        addresses = cls.prioritize(addresses)
+        addresses.extend(set(deferred) - set(addresses))
+
+        if SYNC_SHARDS > 1:
+            cls.sharded_sync(addresses)
+            return
+
+        # Pairs synced recently (ex. before a restart) are not synced again
+        addresses = cls.CHECKPOINT.pending(addresses)
+
         with ThreadPool(4) as pool:
             LOGGER.debug(
-                "Syncing %s pairs using %s threads...",
+                "Syncing %s pairs in batches of %s using %s threads...",
                 len(addresses),
+                PAIRS_SYNC_BATCH,
                 pool._processes,
             )
-            pool.map(Pair.from_chain, addresses)
+            pool.map(
+                bind_context(cls.sync_pairs_in_time), cls.batches(addresses)
+            )
             pool.close()
             pool.join()
 
-        Pairs.recache()
+    @classmethod
+    def prioritize(cls, addresses):
+        """
+        Returns the pairs due in this full sync by their value tier, within
+        the `PAIRS_SYNC_BUDGET`.
+
+        The value of a pair is the larger of its last known TVL and its
+        gauge votes value. Pairs not synced before are always due.
+        """
+        sweep = CACHE.incr(cls.SWEEPS_CACHE_KEY)
+        vote_token = Token.find(DEFAULT_TOKEN_ADDRESS)
+        vote_price = vote_token.price if vote_token else 0
+
+        values = {}
+        for address in addresses:
+            try:
+                pair = Pair.load(address)
+            except KeyError:
+                values[address] = None
+                continue
+
+            value = pair.tvl or 0
+            if pair.gauge_address:
+                try:
+                    gauge = Gauge.load(pair.gauge_address)
+                    value = max(value, (gauge.votes or 0) * vote_price)
+                except KeyError:
+                    pass
+
+            values[address] = value
+
+        carried = json.loads(CACHE.get(cls.OVERFLOW_CACHE_KEY) or "[]")
+        due, overflow = cls.TIERS.split(
+            values, sweep, PAIRS_SYNC_BUDGET, carried
+        )
+        CACHE.set(cls.OVERFLOW_CACHE_KEY, json.dumps(overflow))
+
+        LOGGER.info(
+            "Full sync %s refreshes %s of %s pairs, %s left for the next.",
+            sweep,
+            len(due),
+            len(addresses),
+            len(overflow),
+        )
 
-        reset_multicall_pool_executor()
+        return due
+
+    @staticmethod
+    def batches(addresses):
+        """Splits the addresses in batches of `PAIRS_SYNC_BATCH`."""
+        size = max(1, PAIRS_SYNC_BATCH)
+
+        return [
+            addresses[start:start + size]
+            for start in range(0, len(addresses), size)
+        ]
+
+    @classmethod
+    def sync_pairs(cls, addresses):
+        """Syncs pairs from chain together and records the progress."""
+        pairs = Pair.from_chain_many(addresses)
+
+        for pair in pairs.values():
+            cls.CHECKPOINT.mark(pair.address)
+
+        return pairs
+
+    @classmethod
+    def sync_pair(cls, address):
+        """Syncs a pair from chain and records the progress."""
+        return cls.sync_pairs([address]).get(address.lower())
+
+    @classmethod
+    def sync_pairs_in_time(cls, addresses):
+        """
+        Syncs pairs, unless the sync ran out of time. Late pairs are synced
+        in the next run.
+        """
+        if Deadline.exceeded():
+            if addresses:
+                CACHE.sadd(cls.DEFERRED_CACHE_KEY, *addresses)
+            return {}
+
+        return cls.sync_pairs(addresses)
+
+    @classmethod
+    def pop_deferred(cls):
+        """Returns and forgets the pairs deferred by the previous run."""
+        with CACHE.pipeline() as pipe:
+            pipe.smembers(cls.DEFERRED_CACHE_KEY)
+            pipe.delete(cls.DEFERRED_CACHE_KEY)
+            deferred, _ = pipe.execute()
+
+        return sorted(
+            address.decode("utf-8") if isinstance(address, bytes) else address
+            for address in deferred
+        )
+
+    @classmethod
+    def sharded_sync(cls, addresses):
+        """
+        Splits the pairs in `SYNC_SHARDS` shards to be synced together with
+        the other sync workers and waits until all of them are done.
+        """
+        cycle = int(CACHE.get(cls.SHARDS_CYCLE_CACHE_KEY) or 0) + 1
+        shards_key = cls.SHARDS_CACHE_KEY % cycle
+
+        # Shards need to be there before the workers see the new cycle
+        CACHE.set(shards_key, json.dumps(addresses), ex=SYNC_SHARDS_TIMEOUT)
+        CACHE.set(cls.SHARDS_CYCLE_CACHE_KEY, cycle)
+
+        LOGGER.info(
+            "Syncing %s pairs in %s shards (cycle %s)...",
+            len(addresses),
+            SYNC_SHARDS,
+            cycle,
+        )
+
+        deadline = time.time() + SYNC_SHARDS_TIMEOUT
+        done_key = shards_key + ":done"
+
+        while True:
+            cls.work_on_shards(cycle)
+
+            if CACHE.scard(done_key) >= SYNC_SHARDS:
+                break
+
+            if time.time() > deadline:
+                LOGGER.warning(
+                    "Only %s of %s shards synced in cycle %s.",
+                    CACHE.scard(done_key),
+                    SYNC_SHARDS,
+                    cycle,
+                )
+                break
+
+            # Shards leased by dead workers are picked up once expired
+            LEADER_LEASE.renew()
+            time.sleep(1)
+
+    @classmethod
+    def work_on_shards(cls, cycle=None):
+        """
+        Syncs the pairs of every shard of a cycle (the current one by
+        default) not done yet and not leased by another worker.
+        """
+        cycle = cycle or CACHE.get(cls.SHARDS_CYCLE_CACHE_KEY)
+        if cycle is None:
+            return 0
+
+        shards_key = cls.SHARDS_CACHE_KEY % int(cycle)
+        done_key = shards_key + ":done"
+        addresses = json.loads(CACHE.get(shards_key) or "[]")
+        synced = 0
+
+        if not addresses:
+            return synced
+
+        for shard in range(SYNC_SHARDS):
+            if CACHE.sismember(done_key, shard):
+                continue
+
+            lease = Lease("%s:%s" % (shards_key, shard), SYNC_LEASE_SECONDS)
+            if not lease.acquire():
+                continue
+
+            try:
+                shard_addresses = cls.CHECKPOINT.pending(
+                    addresses[shard::SYNC_SHARDS]
+                )
+                LOGGER.debug(
+                    "Syncing shard %s with %s pairs...",
+                    shard,
+                    len(shard_addresses),
+                )
+
+                with ThreadPool(4) as pool:
+                    for _ in pool.imap_unordered(
+                        bind_context(cls.sync_pairs_in_time),
+                        cls.batches(shard_addresses),
+                    ):
+                        lease.renew()
+
+                CACHE.sadd(done_key, shard)
+                CACHE.expire(done_key, SYNC_SHARDS_TIMEOUT)
+                synced += 1
+            finally:
+                lease.release()
+
+        return synced
+
+    @classmethod
+    def incremental_sync(cls, from_block, to_block):
+        """Syncs new pairs and pairs with reserve changes between blocks."""
+        addresses = json.loads(CACHE.get(cls.ADDRESSES_CACHE_KEY) or "[]")
+
+        new_addresses = Pair.chain_addresses(start=len(addresses))
+        if new_addresses:
+            LOGGER.info("Found %s new pairs.", len(new_addresses))
+            addresses.extend(new_addresses)
+            CACHE.set(cls.ADDRESSES_CACHE_KEY, json.dumps(addresses))
+
+            cls.sync_pairs(new_addresses)
+
+        for batch in cls.batches(cls.pop_deferred()):
+            cls.sync_pairs_in_time(batch)
+
+        known = set(addresses) - set(new_addresses)
+        touched = set()
+
+        if from_block <= to_block:
+            for log in fetch_logs([Pair.SYNC_TOPIC], from_block, to_block):
+                address = log["address"].lower()
+                if address in known:
+                    touched.add(address)
+
+        LOGGER.debug(
+            "Refreshing %s pairs changed between blocks %s and %s.",
+            len(touched),
+            from_block,
+            to_block,
+        )
+
+        Pair.refresh_reserves(sorted(touched))
 
     @classmethod
     def serialize(cls):
@@ -64,58 +420,64 @@ class Pairs(object):
             if pair is None or pair._data is None:
                 continue
 
-            data = pair._data
+            pairs.append(cls.serialize_pair(pair))
 
-            token0 = (
-                Token.find(pair.token0_address.decode("utf-8"))
-                if isinstance(pair.token0_address, bytes)
-                else Token.find(pair.token0_address)
-            )
-            token1 = (
-                Token.find(pair.token1_address.decode("utf-8"))
-                if isinstance(pair.token1_address, bytes)
-                else Token.find(pair.token1_address)
-            )
+        return pairs
 
-            if token0:
-                data["token0"] = token0.to_dict()
-            if token1:
-                data["token1"] = token1.to_dict()
+    @classmethod
+    def serialize_pair(cls, pair):
+        """Serializes a Pair object with its Token and Gauge data."""
 
-            if pair.gauge_address:
-                gauge = Gauge.find(pair.gauge_address)
-
-                if gauge and gauge._data is not None:
-                    data["gauge"] = gauge._data
-                    data["gauge"]["rewards"] = []
-                    data["gauge"]["bribes"] = []
-                    data["gauge"]["fees"] = []
-
-                    for token_addr, reward_ammount in gauge.rewards:
-                        data["gauge"]["rewards"].append(
-                            dict(
-                                token=Token.find(token_addr).to_dict(),
-                                reward_ammount=float(reward_ammount),
-                            )
+        data = pair._data
+
+        token0 = (
+            Token.find(pair.token0_address.decode("utf-8"))
+            if isinstance(pair.token0_address, bytes)
+            else Token.find(pair.token0_address)
+        )
+        token1 = (
+            Token.find(pair.token1_address.decode("utf-8"))
+            if isinstance(pair.token1_address, bytes)
+            else Token.find(pair.token1_address)
+        )
+
+        if token0:
+            data["token0"] = token0.to_dict()
+        if token1:
+            data["token1"] = token1.to_dict()
+
+        if pair.gauge_address:
+            gauge = Gauge.find(pair.gauge_address)
+
+            if gauge and gauge._data is not None:
+                data["gauge"] = gauge._data
+                data["gauge"]["rewards"] = []
+                data["gauge"]["bribes"] = []
+                data["gauge"]["fees"] = []
+
+                for token_addr, reward_ammount in gauge.rewards:
+                    data["gauge"]["rewards"].append(
+                        dict(
+                            token=Token.find(token_addr).to_dict(),
+                            reward_ammount=float(reward_ammount),
                         )
-                    for token_addr, reward_ammount in gauge.bribes:
-                        data["gauge"]["bribes"].append(
-                            dict(
-                                token=Token.find(token_addr).to_dict(),
-                                reward_ammount=float(reward_ammount),
-                            )
+                    )
+                for token_addr, reward_ammount in gauge.bribes:
+                    data["gauge"]["bribes"].append(
+                        dict(
+                            token=Token.find(token_addr).to_dict(),
+                            reward_ammount=float(reward_ammount),
                         )
-                    for token_addr, reward_ammount in gauge.fees:
-                        data["gauge"]["fees"].append(
-                            dict(
-                                token=Token.find(token_addr).to_dict(),
-                                reward_ammount=float(reward_ammount),
-                            )
+                    )
+                for token_addr, reward_ammount in gauge.fees:
+                    data["gauge"]["fees"].append(
+                        dict(
+                            token=Token.find(token_addr).to_dict(),
+                            reward_ammount=float(reward_ammount),
                         )
+                    )
 
-            pairs.append(data)
-
-        return pairs
+        return data
 
     @classmethod
     def recache_price_and_gauge_data(cls):
@@ -129,11 +491,98 @@ class Pairs(object):
 
         pairs = json.dumps(dict(data=cls.serialize()), cls=JSONEncoder)
 
-        CACHE.set(cls.CACHE_KEY, pairs)
+        with CACHE.lock(cls.LOCK_NAME, ttl=cls.LOCK_TTL):
+            generation = Snapshots.set(cls.CACHE_KEY, pairs)
+            # Older patches were read from the models already
+            CACHE.zremrangebyscore(
+                cls.PATCHES_CACHE_KEY, "-inf", "(%s" % generation
+            )
         LOGGER.debug("Cache updated for %s.", cls.CACHE_KEY)
 
         return pairs
 
+    @classmethod
+    def patch(cls, addresses, votes_only=False):
+        """
+        Updates only the given pairs in the cached serialized data.
+
+        Pairs not found anymore are removed from it. With `votes_only`,
+        only the gauge votes and APRs of the pairs are updated.
+        """
+        addresses = set(address.lower() for address in addresses)
+
+        with CACHE.lock(cls.LOCK_NAME, ttl=cls.LOCK_TTL):
+            cached = Snapshots.get(cls.CACHE_KEY)
+            if not cached:
+                return cls.recache()
+
+            if votes_only:
+                serialized = cls.votes_patched(cached, addresses)
+            else:
+                serialized = cls.patched(cached, addresses)
+            generation = Snapshots.set(cls.CACHE_KEY, serialized)
+
+            # Re-applied over the pairs of a sync building meanwhile
+            CACHE.zadd(
+                cls.PATCHES_CACHE_KEY,
+                {address: generation for address in addresses},
+            )
+
+        LOGGER.debug(
+            "Cache patched for %s with %s pairs.",
+            cls.CACHE_KEY,
+            len(addresses),
+        )
+
+        return serialized
+
+    @classmethod
+    def patched(cls, cached, addresses):
+        """Returns the serialized pairs, with the given pairs updated."""
+        pairs = [
+            data
+            for data in json.loads(cached)["data"]
+            if data["address"] not in addresses
+        ]
+
+        for address in addresses:
+            try:
+                pairs.append(cls.serialize_pair(Pair.load(address)))
+            except KeyError:
+                LOGGER.debug("Pair %s removed from cache.", address)
+
+        return json.dumps(dict(data=pairs), cls=JSONEncoder)
+
+    @classmethod
+    def votes_patched(cls, cached, addresses):
+        """Returns the serialized pairs, with the given pairs votes updated."""
+        pairs = json.loads(cached)["data"]
+
+        for data in pairs:
+            if data["address"] not in addresses or not data.get("gauge"):
+                continue
+
+            gauge = Gauge.find(data["gauge"]["address"])
+            if gauge is None:
+                continue
+
+            for field in cls.VOTES_FIELDS:
+                data["gauge"][field] = getattr(gauge, field)
+
+        return json.dumps(dict(data=pairs), cls=JSONEncoder)
+
+    @classmethod
+    def rebase(cls, cached, generation):
+        """Re-applies the patches published after a generation started."""
+        addresses = set(
+            address.decode("utf-8") if isinstance(address, bytes) else address
+            for address in CACHE.zrangebyscore(
+                cls.PATCHES_CACHE_KEY, "(%s" % generation, "+inf"
+            )
+        )
+
+        return cls.patched(cached, addresses) if addresses else cached
+
     def resync(self, pair_address, gauge_address):
         """Resyncs a pair based on it's address or gauge address."""
 
@@ -147,7 +596,6 @@ class Pairs(object):
         else:
             return
 
-        reset_multicall_pool_executor()
         Pairs.recache()
 
     def on_get(self, req, resp):
@@ -156,11 +604,26 @@ class Pairs(object):
         and updates or creates the corresponding Gauge object in the database.
         """
 
-        self.resync(
-            req.get_param("pair_address"), req.get_param("gauge_address")
-        )
+        pair_address = req.get_param("pair_address")
+        gauge_address = req.get_param("gauge_address")
 
-        pairs = CACHE.get(self.CACHE_KEY) or Pairs.recache()
+        self.resync(pair_address, gauge_address)
+
+        generation = Snapshots.generation(self.CACHE_KEY)
+        if (
+            generation is not None
+            and req.if_none_match
+            and not (pair_address or gauge_address)
+            and any(tag == str(generation) for tag in req.if_none_match)
+        ):
+            resp.status = falcon.HTTP_304
+            return
+
+        pairs = Snapshots.get(self.CACHE_KEY) or Pairs.recache()
 
         resp.status = falcon.HTTP_200
+        resp.etag = str(Snapshots.generation(self.CACHE_KEY))
         resp.text = pairs
+
+
+Snapshots.rebase_with(Pairs.CACHE_KEY, Pairs.rebase)
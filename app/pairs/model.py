@@ -2,12 +2,15 @@
 
 import time
 
-from multicall import Call, Multicall
+from multicall import Call
 from walrus import BooleanField, FloatField, IntegerField, Model, TextField
+from web3 import Web3
 from web3.constants import ADDRESS_ZERO
 
 from app.assets import Token
+from app.chain import CallPlan, PairIndex, PairsLens, read
 from app.gauges import Gauge
+from app.misc import ModelUteis
 from app.settings import (
     CACHE,
     DEFAULT_TOKEN_ADDRESS,
@@ -18,6 +21,7 @@ from app.settings import (
     RETRY_DELAY,
     VOTER_ADDRESS,
 )
+from app.sync import Deadline
 
 
 class Pair(Model):
@@ -26,6 +30,9 @@ class Pair(Model):
 
     __database__ = CACHE
 
+    # Emitted by the pair on every reserves change (swaps, mints, burns)
+    SYNC_TOPIC = Web3.keccak(text="Sync(uint256,uint256)").hex()
+
     address = TextField(primary_key=True)
     symbol = TextField()
     decimals = IntegerField()
@@ -61,6 +68,9 @@ class Pair(Model):
                 LOGGER.error(
                     f"Error fetching gauge for address {self.address}: {e}"
                 )
+                if Deadline.exceeded():
+                    LOGGER.info("Out of sync time, not retrying the gauge.")
+                    break
                 LOGGER.info(f"Retrying in {retry_delay} seconds...")
                 time.sleep(retry_delay)
 
@@ -79,6 +89,27 @@ class Pair(Model):
 
         self.save()
 
+    def refresh_tvl(self):
+        """Recomputes the TVL and APR from the stored reserves and the
+        latest token prices, without reading the chain."""
+
+        token0 = Token.find(self.token0_address)
+        token1 = Token.find(self.token1_address)
+
+        self.tvl = self._tvl(
+            dict(
+                symbol=self.symbol,
+                reserve0=self.reserve0,
+                reserve1=self.reserve1,
+            ),
+            token0,
+            token1,
+        )
+        self.save()
+
+        if self.gauge_address:
+            self._update_apr(Gauge.find(self.gauge_address))
+
     @classmethod
     def find(cls, address):
         if address is None:
@@ -90,128 +121,289 @@ class Pair(Model):
             return cls.from_chain(address.lower())
 
     @classmethod
-    def chain_addresses(cls):
+    def index(cls, pairs):
+        """Adds the pairs to the `PairIndex`, by their tokens and type."""
+        PairIndex.add_many(
+            (
+                pair.token0_address,
+                pair.token1_address,
+                pair.stable,
+                pair.address,
+            )
+            for pair in pairs
+            if pair is not None
+        )
+
+    @classmethod
+    def chain_addresses(cls, start=0):
+        """Returns the factory pair addresses, starting at an index."""
         LOGGER.debug("Fetching all pair addresses from the blockchain...")
-        pairs_count = Call(FACTORY_ADDRESS, "allPairsLength()(uint256)")()
+        pairs_count = read(Call(FACTORY_ADDRESS, "allPairsLength()(uint256)"))
         LOGGER.debug(f"Found {pairs_count} pairs.")
-        pairs_multi = Multicall(
+
+        if start >= pairs_count:
+            return []
+
+        pairs_multi = CallPlan().add(
             [
                 Call(
                     FACTORY_ADDRESS,
                     ["allPairs(uint256)(address)", idx],
                     [[idx, None]],
                 )
-                for idx in range(0, pairs_count)
+                for idx in range(start, pairs_count)
             ]
         )
-        return list(pairs_multi().values())
+        return [address.lower() for address in pairs_multi.run().values()]
 
     @classmethod
-    def from_chain(cls, address):
-        try:
-            address = address.lower()
+    def refresh_reserves(cls, addresses):
+        """
+        Refreshes the reserves, TVL and APR of already synced pairs.
+
+        Pairs not synced yet are fully fetched from chain instead.
+        """
+        pairs = {}
+        missing = []
+
+        for address in addresses:
+            try:
+                pairs[address] = cls.load(address)
+            except KeyError:
+                missing.append(address)
+
+        cls.from_chain_many(missing)
+
+        if not pairs:
+            return []
 
-            pair_multi = Multicall(
+        plan = CallPlan(PairsLens.read(list(pairs)))
+        for address in pairs:
+            key_prefix = CallPlan.key(cls.__name__, address)
+            plan.add(
                 [
                     Call(
                         address,
                         "getReserves()(uint256,uint256)",
-                        [["reserve0", None], ["reserve1", None]],
-                    ),
-                    Call(
-                        address,
-                        "token0()(address)",
-                        [["token0_address", None]],
-                    ),
-                    Call(
-                        address,
-                        "token1()(address)",
-                        [["token1_address", None]],
+                        [
+                            ["%s|reserve0" % key_prefix, None],
+                            ["%s|reserve1" % key_prefix, None],
+                        ],
                     ),
                     Call(
                         address,
                         "totalSupply()(uint256)",
-                        [["total_supply", None]],
-                    ),
-                    Call(address, "symbol()(string)", [["symbol", None]]),
-                    Call(address, "decimals()(uint8)", [["decimals", None]]),
-                    Call(address, "stable()(bool)", [["stable", None]]),
-                    Call(
-                        VOTER_ADDRESS,
-                        ["gauges(address)(address)", address],
-                        [["gauge_address", None]],
+                        [["%s|total_supply" % key_prefix, None]],
                     ),
                 ]
             )
 
-            data = pair_multi()
+        data = plan.run()
+
+        for address, pair in list(pairs.items()):
+            pair_data = CallPlan.scoped(data, cls.__name__, address)
+            if not pair_data:
+                del pairs[address]
+                continue
+
+            reserve0 = pair_data["reserve0"]
+            reserve1 = pair_data["reserve1"]
+
+            token0 = Token.find(pair.token0_address)
+            token1 = Token.find(pair.token1_address)
+
+            if token0 and token1:
+                reserve0 /= 10 ** token0.decimals
+                reserve1 /= 10 ** token1.decimals
+
+            pair.reserve0 = reserve0
+            pair.reserve1 = reserve1
+            pair.total_supply = pair_data["total_supply"] / (
+                10 ** pair.decimals
+            )
+            pair.refresh_tvl()
+
             LOGGER.debug(
-                "Loading %s:(%s) %s.", cls.__name__, data["symbol"], address
+                "Refreshed %s:(%s) %s.", cls.__name__, pair.symbol, address
             )
 
-            data["address"] = address
+        return list(pairs.values())
 
-            data["total_supply"] = data["total_supply"] / (
-                10 ** data["decimals"]
-            )
+    @classmethod
+    def from_chain(cls, address):
+        return cls.from_chain_many([address]).get(address.lower())
 
-            token0 = Token.find(data["token0_address"])
-            token1 = Token.find(data["token1_address"])
+    @classmethod
+    def from_chain_many(cls, addresses):
+        """
+        Fetches pairs, their tokens and gauges from chain, with a multicall
+        per step for all of them. Returns the pairs by address.
+        """
+        addresses = [address.lower() for address in addresses]
+
+        if not addresses:
+            return {}
+
+        # With the lens, only the immutable reads are left to the plan
+        known = PairsLens.read(addresses)
+        plan = CallPlan(known)
+        for address in addresses:
+            plan.add(cls.prepare_chain_calls(address))
+        data = plan.run()
+
+        pairs_data = {
+            address: CallPlan.scoped(data, cls.__name__, address)
+            for address in addresses
+        }
 
-            if token0 and token1:
-                data["reserve0"] = data["reserve0"] / (10 ** token0.decimals)
-                data["reserve1"] = data["reserve1"] / (10 ** token1.decimals)
-
-            if data.get("gauge_address") in (ADDRESS_ZERO, None):
-                data["gauge_address"] = None
-            else:
-                data["gauge_address"] = data["gauge_address"].lower()
-
-            data["tvl"] = cls._tvl(data, token0, token1)
-
-            data["isStable"] = data["stable"]
-            data["totalSupply"] = data["total_supply"]
-
-            symbol_patches = {
-                "0x1e221ea8d1440c3549942821412c03f101f5e99a":
-                    "vAMM-TOREv1/WKAVA",
-                "0xce3433baf2356e8404ca7dcc39eb61feda73e2c8":
-                    "vAMM-TOREv1/VARA",
-                "0x1ae83a1b9ee963213d1e3ff337f92930582d304f":
-                    "vAMM-TOREv2/WKAVA",
-            }
-            for address_map, symbol in symbol_patches.items():
-                if address_map in data["address"]:
-                    data["symbol"] = symbol
-                    LOGGER.debug(f"Symbol changed: {data['symbol']}")
-
-            if data["token0_address"] in MULTICHAIN_TOKEN_ADDRESSES:
-                aux_symbol = data["symbol"]
-                data["symbol"] = aux_symbol[:5] + "multi" + aux_symbol[5:]
-            if data["token1_address"] in MULTICHAIN_TOKEN_ADDRESSES:
-                slash_index = data["symbol"].find("/") + 1
-                data["symbol"] = (
-                    data["symbol"][:slash_index]
-                    + "multi"
-                    + data["symbol"][slash_index:]
-                )
+        # Tokens not seen yet are fetched together
+        token_addresses = set()
+        for pair_data in pairs_data.values():
+            token_addresses.add(pair_data.get("token0_address"))
+            token_addresses.add(pair_data.get("token1_address"))
+        token_addresses.discard(None)
+        Token.find_many(token_addresses)
+
+        pairs = {}
+        for address, pair_data in pairs_data.items():
             try:
-                cls.query_delete(cls.address == address.lower())
+                if not pair_data:
+                    raise ValueError("no chain data")
+
+                failed = plan.failed_fields(cls.__name__, address)
+                if failed:
+                    raise ValueError("failed calls %s" % failed)
+
+                pairs[address] = cls.from_chain_calls(address, pair_data)
             except Exception as e:
-                LOGGER.error(f"Error deleting pair {address}: {e}")
+                LOGGER.error(f"Error fetching pair for address {address}: {e}")
 
-            pair = cls.create(**data)
-            LOGGER.debug(
-                "Fetched %s:(%s) %s.", cls.__name__, pair.symbol, pair.address
-            )
+        cls.index(pairs.values())
 
-            pair.syncup_gauge()
+        gauges = Gauge.from_chain_many(
+            [
+                pair.gauge_address
+                for pair in pairs.values()
+                if pair.gauge_address
+            ],
+            known,
+        )
+        for pair in pairs.values():
+            if pair.gauge_address:
+                pair._update_apr(gauges.get(pair.gauge_address))
 
-            return pair
+        return pairs
 
-        except Exception as e:
-            LOGGER.error(f"Error fetching pair for address {address}: {e}")
-            return None
+    @classmethod
+    def prepare_chain_calls(cls, address):
+        """Returns prepared pair and voter calls for a pair address."""
+        key_prefix = "|".join([cls.__name__, address])
+
+        return [
+            Call(
+                address,
+                "getReserves()(uint256,uint256)",
+                [
+                    ["%s|reserve0" % key_prefix, None],
+                    ["%s|reserve1" % key_prefix, None],
+                ],
+            ),
+            Call(
+                address,
+                "token0()(address)",
+                [["%s|token0_address" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                "token1()(address)",
+                [["%s|token1_address" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                "totalSupply()(uint256)",
+                [["%s|total_supply" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                "symbol()(string)",
+                [["%s|symbol" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                "decimals()(uint8)",
+                [["%s|decimals" % key_prefix, None]],
+            ),
+            Call(
+                address,
+                "stable()(bool)",
+                [["%s|stable" % key_prefix, None]],
+            ),
+            Call(
+                VOTER_ADDRESS,
+                ["gauges(address)(address)", address],
+                [["%s|gauge_address" % key_prefix, None]],
+            ),
+        ]
+
+    @classmethod
+    def from_chain_calls(cls, address, data):
+        """Imports/creates a pair from the prepared calls data."""
+        LOGGER.debug(
+            "Loading %s:(%s) %s.", cls.__name__, data["symbol"], address
+        )
+
+        data["address"] = address
+
+        data["total_supply"] = data["total_supply"] / (
+            10 ** data["decimals"]
+        )
+
+        token0 = Token.find(data["token0_address"])
+        token1 = Token.find(data["token1_address"])
+
+        if token0 and token1:
+            data["reserve0"] = data["reserve0"] / (10 ** token0.decimals)
+            data["reserve1"] = data["reserve1"] / (10 ** token1.decimals)
+
+        if data.get("gauge_address") in (ADDRESS_ZERO, None):
+            data["gauge_address"] = None
+        else:
+            data["gauge_address"] = data["gauge_address"].lower()
+
+        data["tvl"] = cls._tvl(data, token0, token1)
+
+        data["isStable"] = data["stable"]
+        data["totalSupply"] = data["total_supply"]
+
+        symbol_patches = {
+            "0x1e221ea8d1440c3549942821412c03f101f5e99a":
+                "vAMM-TOREv1/WKAVA",
+            "0xce3433baf2356e8404ca7dcc39eb61feda73e2c8":
+                "vAMM-TOREv1/VARA",
+            "0x1ae83a1b9ee963213d1e3ff337f92930582d304f":
+                "vAMM-TOREv2/WKAVA",
+        }
+        for address_map, symbol in symbol_patches.items():
+            if address_map in data["address"]:
+                data["symbol"] = symbol
+                LOGGER.debug(f"Symbol changed: {data['symbol']}")
+
+        if data["token0_address"] in MULTICHAIN_TOKEN_ADDRESSES:
+            aux_symbol = data["symbol"]
+            data["symbol"] = aux_symbol[:5] + "multi" + aux_symbol[5:]
+        if data["token1_address"] in MULTICHAIN_TOKEN_ADDRESSES:
+            slash_index = data["symbol"].find("/") + 1
+            data["symbol"] = (
+                data["symbol"][:slash_index]
+                + "multi"
+                + data["symbol"][slash_index:]
+            )
+        pair = ModelUteis.save_over(cls, **data)
+        LOGGER.debug(
+            "Fetched %s:(%s) %s.", cls.__name__, pair.symbol, pair.address
+        )
+
+        return pair
 
     @classmethod
     def _tvl(cls, pool_data, token0, token1):
@@ -259,13 +451,12 @@ class Pair(Model):
 
     def balance_of(self, token_address):
         try:
-            balance_call = Call(
-                self.address, "balanceOf(address)(uint256)", [token_address]
+            return read(
+                Call(
+                    self.address,
+                    ["balanceOf(address)(uint256)", token_address],
+                )
             )
-            multicall = Multicall([balance_call])
-            result = multicall()
-            balance = result.get(balance_call)
-            return balance
 
         except Exception as e:
             LOGGER.error(
@@ -275,11 +466,7 @@ class Pair(Model):
 
     def total_liquidity(self):
         try:
-            liquidity_call = Call(self.address, "totalSupply()(uint256)")
-            multicall = Multicall([liquidity_call])
-            result = multicall()
-            liquidity = result.get(liquidity_call)
-            return liquidity
+            return read(Call(self.address, "totalSupply()(uint256)"))
 
         except Exception as e:
             LOGGER.error(
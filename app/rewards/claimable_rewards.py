@@ -1,5 +1,6 @@
-from multicall import Call, Multicall
+from multicall import Call
 
+from app.chain import CallPlan
 from app.pairs.aprs import get_apr
 
 
@@ -36,7 +37,7 @@ def get_voter_claimable_rewards(token_id):
                 )
             )
 
-    for key, value in Multicall(calls)().items():
+    for key, value in CallPlan().add(calls).run().items():
         fee_distributor_address, token_address = key.split("-")
         reward = rewards[fee_distributor_address][token_address]
         reward["earned"] = value
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app.settings import (
+    HTTP_BACKOFF,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_RETRIES,
+    HTTP_TIMEOUT,
+)
+
+
+class Session(requests.Session):
+    """
+    A keep-alive HTTP session with a connection pool per host.
+
+    Requests get a default timeout and are retried with backoff on
+    connection errors and `429`/`5xx` answers. Once the retries are over
+    the last response is returned, callers still `raise_for_status()`.
+
+    Every request is retried, POSTs included: the outbound calls only read
+    (GraphQL and JSON-RPC queries are POSTs).
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(
+        self,
+        timeout=HTTP_TIMEOUT,
+        retries=HTTP_RETRIES,
+        backoff=HTTP_BACKOFF,
+        connections=HTTP_MAX_CONNECTIONS,
+    ):
+        super().__init__()
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(
+            pool_maxsize=connections,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=self.RETRY_STATUSES,
+                allowed_methods=None,
+                raise_on_status=False,
+            ),
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+
+        return super().request(method, url, **kwargs)
+
+
+# Shared by all the outbound API calls and the web3 provider
+HTTP = Session()
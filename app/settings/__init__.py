@@ -4,19 +4,15 @@ from __future__ import absolute_import
 
 import logging
 import os
+import socket
 import sys
-from concurrent.futures import ThreadPoolExecutor
 
 import fakeredis
 import redis.exceptions
 from environ import Env
 from honeybadger import honeybadger
-from multicall import utils as multicall_utils
 from walrus import Database
 
-# Initialize a threaded executor
-multicall_utils.process_pool_executor = ThreadPoolExecutor()
-
 env = Env()
 if os.path.exists(".env"):
     Env.read_env(".env")
@@ -79,6 +75,16 @@ EXTERNAL_PRICE_ORDER = env(
         "_get_price_from_dexguru",
     ],
 )
+# Min. USD liquidity of a pair side for its quote to count in the prices
+PRICE_GRAPH_MIN_LIQUIDITY = env.float("PRICE_GRAPH_MIN_LIQUIDITY", default=100)
+# Seconds external prices are cached, and the tokens a source has no price
+# for (not listed) are not asked again
+EXTERNAL_PRICE_CACHE_SECONDS = env.int(
+    "EXTERNAL_PRICE_CACHE_SECONDS", default=300
+)
+EXTERNAL_PRICE_NEGATIVE_CACHE_SECONDS = env.int(
+    "EXTERNAL_PRICE_NEGATIVE_CACHE_SECONDS", default=6 * 60 * 60
+)
 
 # Will be picked automatically by web3.py
 WEB3_PROVIDER_URI = env("WEB3_PROVIDER_URI")
@@ -93,12 +99,100 @@ TREASURY_ADDRESS = env("TREASURY_ADDRESS")
 
 # Seconds to wait before running the chain syncup. `0` disables it!
 SYNC_WAIT_SECONDS = env.int("SYNC_WAIT_SECONDS", default=0)
+# Seconds a sync run is allowed to take before the work that can wait is
+# deferred to the next run. `0` disables it.
+SYNC_CYCLE_SECONDS = env.int("SYNC_CYCLE_SECONDS", default=0)
+# Max number of sync stages running at the same time
+SYNC_MAX_WORKERS = env.int("SYNC_MAX_WORKERS", default=4)
+# Seconds every dataset is allowed to age before the syncer refreshes it
+ASSETS_SYNC_SECONDS = env.int("ASSETS_SYNC_SECONDS", default=SYNC_WAIT_SECONDS)
+PAIRS_SYNC_SECONDS = env.int("PAIRS_SYNC_SECONDS", default=SYNC_WAIT_SECONDS)
+VOLUME_SYNC_SECONDS = env.int("VOLUME_SYNC_SECONDS", default=SYNC_WAIT_SECONDS)
+SUPPLY_SYNC_SECONDS = env.int("SUPPLY_SYNC_SECONDS", default=SYNC_WAIT_SECONDS)
+CIRCULATING_SYNC_SECONDS = env.int(
+    "CIRCULATING_SYNC_SECONDS", default=SYNC_WAIT_SECONDS
+)
+VARA_SYNC_SECONDS = env.int("VARA_SYNC_SECONDS", default=SYNC_WAIT_SECONDS)
+CL_POOLS_SYNC_SECONDS = env.int(
+    "CL_POOLS_SYNC_SECONDS", default=SYNC_WAIT_SECONDS
+)
+# Every how many pairs syncs all the pairs are re-read from chain,
+# in between only the pairs with new `Sync` events are refreshed
+PAIRS_FULL_SYNC_EVERY = env.int("PAIRS_FULL_SYNC_EVERY", default=10)
+# Max blocks to catch up with logs before falling back to a full sync
+PAIRS_MAX_INCREMENTAL_BLOCKS = env.int(
+    "PAIRS_MAX_INCREMENTAL_BLOCKS", default=50000
+)
+# Full syncs refresh the pairs worth (TVL or gauge votes, in USD) at least
+# `min_value` once every `N` full syncs, as `min_value:N` tiers
+PAIRS_TIERS = env.list(
+    "PAIRS_TIERS", default=["100000:1", "10000:2", "1000:5", "0:10"]
+)
+# Pairs (with their tokens and gauges) read together in a few multicalls
+PAIRS_SYNC_BATCH = env.int("PAIRS_SYNC_BATCH", default=50)
+# Max pairs re-read in a full sync, the most valuable first. `0` disables it
+PAIRS_SYNC_BUDGET = env.int("PAIRS_SYNC_BUDGET", default=0)
+# Max new blocks to check for tracked logs before a pairs sync,
+# above it the check is skipped and the sync always runs
+BLOOM_MAX_BLOCKS = env.int("BLOOM_MAX_BLOCKS", default=200)
+# Number of shards the full pairs sync is split in, to be shared by
+# several sync workers. `1` disables sharding.
+SYNC_SHARDS = env.int("SYNC_SHARDS", default=1)
+# Seconds a sync worker holds a lease (leadership, shard) without renewing
+SYNC_LEASE_SECONDS = env.int("SYNC_LEASE_SECONDS", default=120)
+# Max seconds the leader waits for all shards before publishing
+SYNC_SHARDS_TIMEOUT = env.int("SYNC_SHARDS_TIMEOUT", default=600)
+SYNC_WORKER_ID = env(
+    "SYNC_WORKER_ID", default="%s:%s" % (socket.gethostname(), os.getpid())
+)
+# Refresh pairs and gauges from the voter events next to the syncer
+VOTER_EVENTS_ENABLED = env.bool("VOTER_EVENTS_ENABLED", default=False)
+VOTER_EVENTS_POLL_SECONDS = env.int("VOTER_EVENTS_POLL_SECONDS", default=30)
+# Chain reads engine: requests in flight, HTTP connections and timeout
+RPC_MAX_CONCURRENCY = env.int("RPC_MAX_CONCURRENCY", default=64)
+RPC_MAX_CONNECTIONS = env.int("RPC_MAX_CONNECTIONS", default=32)
+RPC_TIMEOUT = env.int("RPC_TIMEOUT", default=30)
+# Max requests sent together in a JSON-RPC batch (block headers, logs)
+RPC_BATCH_SIZE = env.int("RPC_BATCH_SIZE", default=50)
+# Chain reads are balanced between these RPC endpoints, by latency
+RPC_ENDPOINTS = env.list("RPC_ENDPOINTS", default=[WEB3_PROVIDER_URI])
+# Seconds a failing endpoint is left out (times its failures in a row)
+RPC_ENDPOINT_COOLDOWN = env.int("RPC_ENDPOINT_COOLDOWN", default=10)
+# Send calls slower than the p95 latency of their endpoint to a second one,
+# after `RPC_HEDGE_SECONDS` until the latencies are known
+RPC_HEDGE = env.bool("RPC_HEDGE", default=True)
+RPC_HEDGE_SECONDS = env.float("RPC_HEDGE_SECONDS", default=1.0)
+# Multicall3 contract and calls aggregated in a single `eth_call`: the
+# chunk size every endpoint starts with, then learns up to the max one
+MULTICALL_ADDRESS = env(
+    "MULTICALL_ADDRESS", default="0xcA11bde05977b3631167028862bE2a173976CA11"
+)
+MULTICALL_CHUNK_SIZE = env.int("MULTICALL_CHUNK_SIZE", default=500)
+MULTICALL_MAX_CHUNK_SIZE = env.int("MULTICALL_MAX_CHUNK_SIZE", default=2000)
+# Cache the chain reads of the block a sync is pinned to in Redis too,
+# for these seconds (they are always cached in process)
+RPC_CACHE_REDIS = env.bool("RPC_CACHE_REDIS", default=False)
+RPC_CACHE_SECONDS = env.int("RPC_CACHE_SECONDS", default=600)
+# Outbound HTTP (external APIs and web3): timeout in seconds, retries with
+# backoff factor (in seconds) and max keep-alive connections per host
+HTTP_TIMEOUT = env.int("HTTP_TIMEOUT", default=15)
+HTTP_RETRIES = env.int("HTTP_RETRIES", default=2)
+HTTP_BACKOFF = env.float("HTTP_BACKOFF", default=0.5)
+HTTP_MAX_CONNECTIONS = env.int("HTTP_MAX_CONNECTIONS", default=32)
+# Runtime bytecode of the `PairsLens` contract (app/abis/PairsLens.sol),
+# to read whole pairs in a single call. Empty to use multicalls only.
+LENS_BYTECODE = env("LENS_BYTECODE", default="")
+# Max blocks requested in a single `eth_getLogs` call
+LOGS_BLOCK_RANGE = env.int("LOGS_BLOCK_RANGE", default=2000)
 CORS_ALLOWED_DOMAINS = env("CORS_ALLOWED_DOMAINS", default=None)
 
 # Get the price from external Source - Defillama
 GET_PRICE_INTERNAL_FIRST = env("GET_PRICE_INTERNAL_FIRST", default=False)
 
 CLEAR_INITIAL_CACHE = env("CLEAR_INITIAL_CACHE", default=False)
+# A sync restarted less than these seconds after the last synced item
+# resumes from its checkpoints, even with `CLEAR_INITIAL_CACHE`
+SYNC_RESUME_SECONDS = env.int("SYNC_RESUME_SECONDS", default=600)
 
 LOG_VERBOSE = env("LOG_VERBOSE", default="info")
 LOGGER.setLevel(env("LOG_VERBOSE", default="DEBUG"))
@@ -121,14 +215,6 @@ SUPPLY_CACHE_EXPIRATION = env.int(
 CACHE = None
 
 
-def reset_multicall_pool_executor():
-    """Cleanup asyncio leftovers and replace executor to free memory."""
-    multicall_utils.process_pool_executor.shutdown(
-        wait=True, cancel_futures=True
-    )
-    multicall_utils.process_pool_executor = ThreadPoolExecutor()
-
-
 def honeybadger_handler(req, resp, exc, params):
     """Custom error handler for exception notifications."""
     if exc is None:
@@ -4,15 +4,16 @@ import json
 from datetime import timedelta
 
 import falcon
-from multicall import Call, Multicall
+from multicall import Call
 
+from app.chain import CallPlan
 from app.settings import (
-    CACHE,
     DEFAULT_TOKEN_ADDRESS,
     LOGGER,
     TREASURY_ADDRESS,
     VE_ADDRESS,
 )
+from app.sync import Snapshots
 
 
 class Supply(object):
@@ -23,7 +24,7 @@ class Supply(object):
 
     @classmethod
     def recache(cls):
-        supply_multicall = Multicall(
+        supply_multicall = CallPlan().add(
             [
                 Call(
                     DEFAULT_TOKEN_ADDRESS,
@@ -53,7 +54,7 @@ class Supply(object):
             ]
         )
 
-        data = supply_multicall()
+        data = supply_multicall.run()
 
         data["total_supply"] = (
             data["raw_total_supply"] / 10 ** data["token_decimals"]
@@ -72,14 +73,14 @@ class Supply(object):
 
         supply_data = json.dumps(dict(data=data))
 
-        CACHE.setex(cls.CACHE_KEY, cls.CACHE_TIME, supply_data)
+        Snapshots.set(cls.CACHE_KEY, supply_data, ttl=cls.CACHE_TIME)
         LOGGER.debug("Cache updated for %s.", cls.CACHE_KEY)
 
         return supply_data
 
     def on_get(self, req, resp):
         """Caches and returns our supply info"""
-        supply_data = CACHE.get(self.CACHE_KEY) or Supply.recache()
+        supply_data = Snapshots.get(self.CACHE_KEY) or Supply.recache()
 
         resp.text = supply_data
         resp.status = falcon.HTTP_200
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+from .checkpoints import Checkpoint  # noqa
+from .context import bind_context  # noqa
+from .deadline import Deadline  # noqa
+from .freshness import Dataset, FreshnessRegistry  # noqa
+from .leases import LEADER_LEASE, Lease  # noqa
+from .scheduler import Stage, StageScheduler  # noqa
+from .snapshots import Snapshots  # noqa
+from .tiers import Tiers  # noqa
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from app.settings import CACHE
+
+
+class Checkpoint(object):
+    """
+    Per-item progress of a sync stage, stored in Redis.
+
+    Items refreshed less than `max_age` seconds ago are skipped, so a
+    restarted sync resumes where the previous one stopped.
+    """
+
+    KEY_PREFIX = "sync:checkpoint:"
+
+    def __init__(self, stage, max_age):
+        self.stage = stage
+        self.key = self.KEY_PREFIX + stage
+        self.max_age = max_age
+
+    def mark(self, item, at=None):
+        CACHE.hset(self.key, item, at or time.time())
+
+    def is_fresh(self, item, now=None):
+        value = CACHE.hget(self.key, item)
+        if value is None:
+            return False
+
+        return (now or time.time()) - float(value) < self.max_age
+
+    def pending(self, items, now=None):
+        """Returns the items not refreshed within `max_age`."""
+        items = list(items)
+        if not items or self.max_age <= 0:
+            return items
+
+        now = now or time.time()
+        values = CACHE.hmget(self.key, items)
+
+        return [
+            item
+            for item, value in zip(items, values)
+            if value is None or now - float(value) >= self.max_age
+        ]
+
+    def clear(self):
+        CACHE.delete(self.key)
+
+    @classmethod
+    def last_progress(cls):
+        """Returns the timestamp of the latest progress of any stage."""
+        latest = None
+
+        for key in CACHE.scan_iter(match=cls.KEY_PREFIX + "*"):
+            values = [float(value) for value in CACHE.hvals(key)]
+            if values and (latest is None or max(values) > latest):
+                latest = max(values)
+
+        return latest
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+
+import contextvars
+
+
+def bind_context(function):
+    """
+    Wraps a function to run in the context it was wrapped in (sync
+    deadline, pinned block...), for thread pools that do not carry it.
+
+    Every call runs in its own copy, so the wrapper can be used by several
+    threads at once.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
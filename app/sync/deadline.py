@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar("sync_deadline", default=None)
+
+
+class Deadline(object):
+    """
+    A wall-clock budget for a sync cycle.
+
+    Work started under `Deadline.within()` checks `Deadline.exceeded()`
+    and defers what can wait (retries, external prices, low value pairs)
+    to the next cycle once the time is over. See `bind_context` for the
+    thread pools.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.at = time.time() + seconds if seconds > 0 else None
+
+    def remaining(self):
+        if self.at is None:
+            return None
+
+        return max(0, self.at - time.time())
+
+    def expired(self):
+        return self.at is not None and time.time() >= self.at
+
+    @classmethod
+    @contextmanager
+    def within(cls, seconds):
+        """Runs the context with a budget of `seconds`, `0` for no limit."""
+        deadline = cls(seconds)
+        token = _current.set(deadline)
+
+        try:
+            yield deadline
+        finally:
+            _current.reset(token)
+
+    @classmethod
+    def current(cls):
+        return _current.get()
+
+    @classmethod
+    def exceeded(cls):
+        """Tells if the current deadline, if any, is over."""
+        deadline = _current.get()
+
+        return deadline is not None and deadline.expired()
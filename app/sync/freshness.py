@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+from app.settings import CACHE, LOGGER
+
+from .snapshots import Snapshots
+
+
+class Dataset(object):
+    """
+    A published dataset, the function refreshing it and how stale it is
+    allowed to get.
+
+    The cost is a rough relative weight of a refresh, expensive datasets
+    get started first when several are due at the same time.
+    """
+
+    def __init__(
+        self, name, key, function, max_age, cost=1, depends_on=()
+    ):
+        self.name = name
+        self.key = key
+        self.function = function
+        self.max_age = max_age
+        self.cost = cost
+        self.depends_on = tuple(depends_on)
+
+    def __repr__(self):
+        return "Dataset(%s, %s)" % (self.name, self.key)
+
+
+class FreshnessRegistry(object):
+    """
+    Keeps track of when every dataset was last refreshed.
+
+    Successful refreshes are stored in Redis so restarts and other
+    processes know how fresh the data is. Attempts are tracked in process,
+    a failing dataset is retried on its own cadence instead of every loop.
+    """
+
+    CACHE_KEY = "sync:freshness"
+
+    def __init__(self, datasets=()):
+        self.datasets = {}
+        self._attempts = {}
+
+        for dataset in datasets:
+            self.register(dataset)
+
+    def register(self, dataset):
+        self.datasets[dataset.name] = dataset
+
+    def last_refreshed(self, dataset):
+        """Returns the timestamp of the last successful refresh."""
+        value = CACHE.hget(self.CACHE_KEY, dataset.name)
+
+        return float(value) if value else None
+
+    def is_due(self, dataset, now=None):
+        now = now or time.time()
+
+        attempted_at = self._attempts.get(dataset.name)
+        if attempted_at and now - attempted_at < dataset.max_age:
+            return False
+
+        refreshed_at = self.last_refreshed(dataset)
+        if not Snapshots.exists(dataset.key) or refreshed_at is None:
+            return True
+
+        return now - refreshed_at >= dataset.max_age
+
+    def due(self, now=None):
+        """Returns the datasets that need a refresh, most expensive first."""
+        now = now or time.time()
+
+        return sorted(
+            [d for d in self.datasets.values() if self.is_due(d, now)],
+            key=lambda d: -d.cost,
+        )
+
+    def next_due_in(self, now=None):
+        """Returns the seconds until the next dataset becomes due."""
+        now = now or time.time()
+        waits = []
+
+        for dataset in self.datasets.values():
+            if self.is_due(dataset, now):
+                return 0
+
+            last = max(
+                self._attempts.get(dataset.name) or 0,
+                self.last_refreshed(dataset) or 0,
+            )
+            waits.append(last + dataset.max_age - now)
+
+        return max(0, min(waits)) if waits else 0
+
+    def mark_fresh(self, dataset, at=None):
+        CACHE.hset(self.CACHE_KEY, dataset.name, at or time.time())
+
+    def refresh(self, dataset):
+        """Runs the dataset refresh and records it as fresh on success."""
+        self._attempts[dataset.name] = time.time()
+
+        LOGGER.debug("Updating %s data...", dataset.name)
+        dataset.function()
+
+        self.mark_fresh(dataset)
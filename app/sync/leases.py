@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+import redis.exceptions
+
+from app.settings import CACHE, SYNC_LEASE_SECONDS, SYNC_WORKER_ID
+
+
+class Lease(object):
+    """
+    A Redis key owned by one sync worker until it expires.
+
+    A worker that dies stops renewing its leases, they expire and other
+    workers can acquire them.
+    """
+
+    def __init__(self, name, ttl, owner=SYNC_WORKER_ID):
+        self.key = "lease:%s" % name
+        self.ttl = ttl
+        self.owner = owner
+
+    def acquire(self):
+        """Acquires (or renews if already owned) the lease."""
+        if CACHE.set(self.key, self.owner, nx=True, px=int(self.ttl * 1000)):
+            return True
+
+        return self.renew()
+
+    def renew(self):
+        """Extends the lease, only if it is still owned."""
+        return self._if_owned(
+            lambda pipe: pipe.pexpire(self.key, int(self.ttl * 1000))
+        )
+
+    def release(self):
+        """Releases the lease, only if it is still owned."""
+        return self._if_owned(lambda pipe: pipe.delete(self.key))
+
+    def is_owned(self):
+        owner = CACHE.get(self.key)
+        return owner is not None and owner.decode("utf-8") == self.owner
+
+    def _if_owned(self, action):
+        with CACHE.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                owner = pipe.get(self.key)
+
+                if owner is None or owner.decode("utf-8") != self.owner:
+                    pipe.unwatch()
+                    return False
+
+                pipe.multi()
+                action(pipe)
+                pipe.execute()
+                return True
+            except redis.exceptions.WatchError:
+                return False
+
+
+# Held by the sync worker running the datasets and publishing them
+LEADER_LEASE = Lease("sync:leader", SYNC_LEASE_SECONDS)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+import contextvars
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from app.settings import LOGGER, SYNC_MAX_WORKERS
+
+from .deadline import Deadline
+
+
+class Stage(object):
+    """A named unit of sync work and the stages it has to wait for."""
+
+    def __init__(self, name, function, depends_on=(), cost=1):
+        self.name = name
+        self.function = function
+        self.depends_on = tuple(depends_on)
+        self.cost = cost
+
+    def __repr__(self):
+        return "Stage(%s)" % self.name
+
+
+class StageScheduler(object):
+    """
+    Runs sync stages on a bounded worker pool, respecting dependencies.
+
+    Stages without pending dependencies run at the same time, the most
+    expensive ones are started first. When a stage fails, the stages
+    depending on it are skipped, independent ones still run. Stages not
+    started before the current `Deadline` are deferred (and skipped).
+    """
+
+    def __init__(self, stages, max_workers=SYNC_MAX_WORKERS):
+        self.stages = {stage.name: stage for stage in stages}
+        self.max_workers = max(1, max_workers)
+        self.timings = {}
+        self.failed = set()
+        self.skipped = set()
+        self.deferred = set()
+
+        self._validate()
+
+    def _validate(self):
+        """Ensures dependencies exist and do not form a cycle."""
+        for stage in self.stages.values():
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(
+                        "Stage %s depends on unknown stage %s"
+                        % (stage.name, dependency)
+                    )
+
+        self.topological_order()
+
+    def topological_order(self):
+        """Returns the stage names so that dependencies come first."""
+        order = []
+        visiting = set()
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError("Stage dependency cycle at %s" % name)
+
+            visiting.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+        return order
+
+    def _run_stage(self, stage):
+        started_at = time.time()
+        try:
+            stage.function()
+        finally:
+            self.timings[stage.name] = (started_at, time.time())
+
+    def run(self):
+        """Runs all the stages and returns their (start, end) timings."""
+        waiting = {
+            name: set(stage.depends_on) for name, stage in self.stages.items()
+        }
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def submit_ready():
+                ready = sorted(
+                    waiting.items(),
+                    key=lambda item: -self.stages[item[0]].cost,
+                )
+                for name, dependencies in ready:
+                    if dependencies & (self.failed | self.skipped):
+                        LOGGER.warning(
+                            "Skipping sync stage %s, a dependency failed.",
+                            name,
+                        )
+                        del waiting[name]
+                        self.skipped.add(name)
+                    elif Deadline.exceeded():
+                        LOGGER.warning(
+                            "Out of sync time, deferring stage %s.", name
+                        )
+                        del waiting[name]
+                        self.deferred.add(name)
+                        self.skipped.add(name)
+                    elif not dependencies:
+                        del waiting[name]
+                        # Stages see the context they were scheduled from
+                        future = executor.submit(
+                            contextvars.copy_context().run,
+                            self._run_stage,
+                            self.stages[name],
+                        )
+                        running[future] = name
+
+            submit_ready()
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        LOGGER.error("Sync stage %s failed: %s", name, error)
+                        self.failed.add(name)
+                        continue
+
+                    for dependencies in waiting.values():
+                        dependencies.discard(name)
+
+                # Dependents of skipped stages can only be released here
+                while True:
+                    skipped = len(self.skipped)
+                    submit_ready()
+                    if len(self.skipped) == skipped:
+                        break
+
+        return self.timings
+
+    def critical_path(self):
+        """
+        Returns the longest chain of dependent stages (by duration) as a
+        list of names, together with its total duration.
+        """
+        finish = {}
+        previous = {}
+
+        for name in self.topological_order():
+            if name not in self.timings:
+                continue
+
+            started_at, ended_at = self.timings[name]
+            best = None
+            for dependency in self.stages[name].depends_on:
+                if dependency in finish and (
+                    best is None or finish[dependency] > finish[best]
+                ):
+                    best = dependency
+
+            previous[name] = best
+            finish[name] = (ended_at - started_at) + (
+                finish[best] if best else 0
+            )
+
+        if not finish:
+            return [], 0
+
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+
+        return list(reversed(path)), total
+
+    def log_timings(self):
+        """Logs each stage duration and the critical path."""
+        for name in self.topological_order():
+            if name in self.timings:
+                started_at, ended_at = self.timings[name]
+                LOGGER.info(
+                    "Syncing %s data done in %s seconds.",
+                    name,
+                    ended_at - started_at,
+                )
+
+        path, total = self.critical_path()
+        if path:
+            LOGGER.info(
+                "Sync critical path: %s (%s seconds).",
+                " -> ".join(
+                    "%s (%.2fs)"
+                    % (name, self.timings[name][1] - self.timings[name][0])
+                    for name in path
+                ),
+                total,
+            )
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import redis.exceptions
+
+from app.settings import CACHE, LOGGER
+
+_building = ContextVar("snapshot_generation", default=None)
+
+
+class Generation(object):
+    """A set of datasets written together and published at once."""
+
+    def __init__(self):
+        self.number = int(CACHE.incr(Snapshots.GENERATION_KEY))
+        self.names = set()
+        self._lock = threading.Lock()
+
+    def add(self, name, value, ttl=None):
+        CACHE.set(Snapshots.data_key(name, self.number), value, ex=ttl)
+
+        with self._lock:
+            self.names.add(name)
+
+    def publish(self):
+        if self.names:
+            Snapshots.publish(self.number, sorted(self.names))
+
+
+class Snapshots(object):
+    """
+    Published datasets, written in generations.
+
+    A sync writes its datasets under the keys of a new generation, then
+    one transaction points every dataset to it. Readers go through the
+    pointer and always get a complete generation, the previous one is kept
+    for rollback.
+    """
+
+    GENERATION_KEY = "snapshots:generation"
+    POINTER_KEY = "snapshots:current"
+    PREVIOUS_KEY = "snapshots:previous"
+
+    # Dataset name -> `rebase(value, generation)`, see `rebase_with()`
+    REBASERS = {}
+
+    @staticmethod
+    def data_key(name, generation):
+        return "snapshot:%s:%s" % (name, int(generation))
+
+    @classmethod
+    @contextmanager
+    def building(cls):
+        """
+        Collects the datasets written in this context (and in the sync
+        stages started from it) in a new generation, published on exit.
+        """
+        generation = Generation()
+        token = _building.set(generation)
+
+        try:
+            yield generation
+        finally:
+            _building.reset(token)
+            generation.publish()
+
+    @classmethod
+    def rebase_with(cls, name, rebase):
+        """
+        Registers how to re-apply the patches of a dataset published while
+        a generation was built: `rebase(value, generation)` returns the
+        value with the patches published after the generation started.
+        """
+        cls.REBASERS[name] = rebase
+
+    @classmethod
+    def set(cls, name, value, ttl=None):
+        """
+        Writes a dataset, published now unless a generation is built.
+        Returns the generation number.
+        """
+        generation = _building.get()
+
+        if generation is not None:
+            generation.add(name, value, ttl)
+            return generation.number
+
+        generation = Generation()
+        generation.add(name, value, ttl)
+        generation.publish()
+
+        return generation.number
+
+    @classmethod
+    def generation(cls, name):
+        value = CACHE.hget(cls.POINTER_KEY, name)
+
+        return int(value) if value is not None else None
+
+    @classmethod
+    def get(cls, name):
+        generation = cls.generation(name)
+
+        if generation is None:
+            return None
+
+        return CACHE.get(cls.data_key(name, generation))
+
+    @classmethod
+    def exists(cls, name):
+        generation = cls.generation(name)
+
+        return generation is not None and bool(
+            CACHE.exists(cls.data_key(name, generation))
+        )
+
+    @classmethod
+    def publish(cls, generation, names):
+        """
+        Points the datasets to a generation in a single transaction.
+
+        Datasets already published in a newer generation (ex. patched while
+        a longer sync was building) are rebased on those patches, in a new
+        generation, when they have a rebaser. Otherwise they are not moved
+        back, and the older data is dropped.
+        """
+        generations = dict.fromkeys(names, generation)
+
+        while True:
+            with CACHE.pipeline() as pipe:
+                try:
+                    pipe.watch(cls.POINTER_KEY, cls.PREVIOUS_KEY)
+                    current = pipe.hmget(cls.POINTER_KEY, names)
+                    previous = pipe.hmget(cls.PREVIOUS_KEY, names)
+
+                    stale = [
+                        name
+                        for name, cur in zip(names, current)
+                        if cur is not None and int(cur) > generations[name]
+                    ]
+
+                    rebased = [name for name in stale if name in cls.REBASERS]
+                    if rebased:
+                        pipe.reset()
+                        for name in rebased:
+                            generations[name] = cls._rebase(
+                                name, generations[name], generation
+                            )
+                        continue
+
+                    pipe.multi()
+                    for name, cur, prev in zip(names, current, previous):
+                        number = generations[name]
+
+                        if name in stale:
+                            pipe.delete(cls.data_key(name, number))
+                            continue
+
+                        pipe.hset(cls.POINTER_KEY, name, number)
+
+                        if cur is not None:
+                            pipe.hset(cls.PREVIOUS_KEY, name, cur)
+                        if prev is not None and prev != cur:
+                            pipe.delete(cls.data_key(name, prev))
+
+                    pipe.execute()
+                    break
+                except redis.exceptions.WatchError:
+                    continue
+
+        if stale:
+            LOGGER.info(
+                "Generation %s of %s is stale, not published.",
+                generation,
+                ", ".join(stale),
+            )
+
+        LOGGER.debug(
+            "Published generation %s of %s.", generation, ", ".join(names)
+        )
+
+    @classmethod
+    def _rebase(cls, name, number, base):
+        """
+        Moves a dataset of a generation to a new one, with the patches
+        published since the `base` generation re-applied.
+        """
+        rebased = int(CACHE.incr(cls.GENERATION_KEY))
+        key = cls.data_key(name, number)
+        ttl = CACHE.pttl(key)
+
+        CACHE.set(
+            cls.data_key(name, rebased),
+            cls.REBASERS[name](CACHE.get(key), base),
+            px=ttl if ttl > 0 else None,
+        )
+        CACHE.delete(key)
+
+        LOGGER.info(
+            "Rebased %s of generation %s on newer patches.", name, base
+        )
+        return rebased
+
+    @classmethod
+    def rollback(cls, name):
+        """Points a dataset back to its previous generation."""
+        previous = CACHE.hget(cls.PREVIOUS_KEY, name)
+
+        if previous is None:
+            return False
+
+        current = CACHE.hget(cls.POINTER_KEY, name)
+        with CACHE.pipeline() as pipe:
+            pipe.hset(cls.POINTER_KEY, name, previous)
+            pipe.hset(cls.PREVIOUS_KEY, name, current)
+            pipe.execute()
+
+        LOGGER.info("Rolled %s back to generation %s.", name, int(previous))
+        return True
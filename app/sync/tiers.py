@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+import zlib
+
+
+class Tiers(object):
+    """
+    Refresh tiers by value: items worth more are refreshed more often.
+
+    Every tier is a `(min_value, every)` pair, items worth at least
+    `min_value` are refreshed once every `every` cycles. Items of the same
+    tier are spread over the cycles so the work does not pile up on one.
+    """
+
+    def __init__(self, tiers):
+        self.tiers = sorted(
+            ((float(value), max(1, int(every))) for value, every in tiers),
+            reverse=True,
+        )
+
+    @classmethod
+    def parse(cls, specs):
+        """Builds the tiers from `min_value:every` strings."""
+        tiers = []
+
+        for spec in specs:
+            value, _, every = str(spec).partition(":")
+            tiers.append((value, every or 1))
+
+        return cls(tiers)
+
+    def every(self, value):
+        """Returns every how many cycles an item worth `value` is due."""
+        if value is None:
+            return 1
+
+        for min_value, every in self.tiers:
+            if value >= min_value:
+                return every
+
+        return self.tiers[-1][1] if self.tiers else 1
+
+    def is_due(self, item, value, cycle):
+        every = self.every(value)
+
+        return zlib.crc32(str(item).encode("utf-8")) % every == cycle % every
+
+    def due(self, values, cycle, budget=0, carried=()):
+        """Returns the items due in a cycle, see `split()`."""
+        return self.split(values, cycle, budget, carried)[0]
+
+    def split(self, values, cycle, budget=0, carried=()):
+        """
+        Returns the items due in a cycle, most valuable first, and the
+        items left over by the budget.
+
+        Items without a value (never synced) always come first. A positive
+        `budget` caps the number of items, the left over items are to be
+        `carried` to the next cycle: they come before any other, oldest
+        first, so every item gets its turn.
+        """
+        carried = [item for item in dict.fromkeys(carried) if item in values]
+        items = [
+            item
+            for item, value in values.items()
+            if item not in carried and self.is_due(item, value, cycle)
+        ]
+        items.sort(
+            key=lambda item: (
+                values[item] is not None,
+                -(values[item] or 0),
+            )
+        )
+        items = carried + items
+
+        if budget > 0:
+            return items[:budget], items[budget:]
+
+        return items, []
@@ -1,115 +1,195 @@
 # -*- coding: utf-8 -*-
 
+import threading
 import time
+from functools import partial
 
 from app.assets import Assets
+from app.chain import ImmutableReads, PairIndex, PinnedBlock, RPCStats
 from app.circulating import CirculatingSupply
+from app.cl.pools import get_cl_pools
 from app.configuration import Configuration
 from app.pairs import Pairs
 from app.settings import (
+    ASSETS_SYNC_SECONDS,
     CACHE,
+    CIRCULATING_SYNC_SECONDS,
+    CL_POOLS_SYNC_SECONDS,
     CLEAR_INITIAL_CACHE,
     LOGGER,
-    SYNC_WAIT_SECONDS,
-    reset_multicall_pool_executor,
+    PAIRS_SYNC_SECONDS,
+    SUPPLY_SYNC_SECONDS,
+    SYNC_CYCLE_SECONDS,
+    SYNC_LEASE_SECONDS,
+    SYNC_MAX_WORKERS,
+    SYNC_RESUME_SECONDS,
+    SYNC_SHARDS,
+    VARA_SYNC_SECONDS,
+    VOLUME_SYNC_SECONDS,
+    VOTER_EVENTS_ENABLED,
+)
+from app.supply import Supply
+from app.sync import (
+    LEADER_LEASE,
+    Checkpoint,
+    Dataset,
+    Deadline,
+    FreshnessRegistry,
+    Snapshots,
+    Stage,
+    StageScheduler,
 )
 from app.vara import VaraPrice
+from app.voter.events import monitor_forever
 
 
 class Syncer:
-    @staticmethod
-    def is_cache_expired(key):
-        ttl = CACHE.ttl(key)
-        return ttl is None or ttl <= 0
-
-    @staticmethod
-    def sync_with_cache(key, task_name, sync_function, *args):
-        """Generalized function to check cache and run sync functions."""
-        if not CACHE.get(key) or Syncer.is_cache_expired(key):
-            LOGGER.debug(f"Updating {task_name} data...")
-            sync_function(*args)
-        else:
-            LOGGER.debug(f"Using cached {task_name}.")
-
-    @staticmethod
-    def sync_tokens():
-        Syncer.sync_with_cache("assets:json", "Token List", Assets.sync)
+    """
+    Refreshes every published dataset on its own cadence.
+
+    Pairs need the token prices, the configuration volume uses the synced
+    pairs and the VARA price is read from the synced tokens.
+    """
+
+    REGISTRY = FreshnessRegistry(
+        [
+            Dataset(
+                "tokens",
+                Assets.CACHE_KEY,
+                Assets.sync,
+                ASSETS_SYNC_SECONDS,
+                cost=5,
+            ),
+            Dataset(
+                "pairs",
+                Pairs.CACHE_KEY,
+                Pairs.sync,
+                PAIRS_SYNC_SECONDS,
+                cost=10,
+                depends_on=["tokens"],
+            ),
+            Dataset(
+                "circulating",
+                CirculatingSupply.CACHE_KEY,
+                CirculatingSupply.sync,
+                CIRCULATING_SYNC_SECONDS,
+            ),
+            Dataset(
+                "configuration",
+                "volume:json",
+                Configuration.sync,
+                VOLUME_SYNC_SECONDS,
+                cost=2,
+                depends_on=["pairs"],
+            ),
+            Dataset(
+                "supply",
+                Supply.CACHE_KEY,
+                Supply.recache,
+                SUPPLY_SYNC_SECONDS,
+            ),
+            Dataset(
+                "vara",
+                VaraPrice.CACHE_KEY,
+                VaraPrice.sync,
+                VARA_SYNC_SECONDS,
+                depends_on=["tokens"],
+            ),
+            Dataset(
+                "cl_pools",
+                "cl_pools",
+                get_cl_pools,
+                CL_POOLS_SYNC_SECONDS,
+                cost=3,
+            ),
+        ]
+    )
 
     @staticmethod
-    def sync_circulating():
-        Syncer.sync_with_cache(
-            "circulating:string", "circulating supply", CirculatingSupply.sync
-        )
+    def stages(datasets):
+        """Returns the sync stages for the datasets to refresh."""
+        names = set(dataset.name for dataset in datasets)
+
+        return [
+            Stage(
+                dataset.name,
+                partial(Syncer.REGISTRY.refresh, dataset),
+                depends_on=[d for d in dataset.depends_on if d in names],
+                cost=dataset.cost,
+            )
+            for dataset in datasets
+        ]
 
     @staticmethod
-    def sync_configuration():
-        Syncer.sync_with_cache(
-            "volume:json", "configuration", Configuration.sync
+    def sync(force=False):
+        """Refreshes the due datasets, or all of them when forced."""
+        datasets = (
+            list(Syncer.REGISTRY.datasets.values())
+            if force
+            else Syncer.REGISTRY.due()
         )
 
-    @staticmethod
-    def sync_pairs():
-        Syncer.sync_with_cache("pairs:json", "Pairs", Pairs.sync)
-
-    @staticmethod
-    def sync_supply():
-        Syncer.sync_with_cache("supply:json", "supply", CirculatingSupply.sync)
-
-    @staticmethod
-    def sync_vara():
-        Syncer.sync_with_cache("vara:json", "VARA price", VaraPrice.sync)
+        if not datasets:
+            LOGGER.debug("All datasets are fresh.")
+            return
 
-    @staticmethod
-    def sync():
         t0 = time.time()
-        LOGGER.info("Syncing data...")
-
-        Syncer.sync_tokens()
-        t1 = time.time()
-
-        Syncer.sync_pairs()
-        t2 = time.time()
-
-        Syncer.sync_circulating()
-        t4 = time.time()
-
-        Syncer.sync_configuration()
-        t5 = time.time()
-
-        Syncer.sync_supply()
-        t6 = time.time()
-
-        Syncer.sync_vara()
-        t7 = time.time()
+        LOGGER.info(
+            "Syncing data: %s...", ", ".join(d.name for d in datasets)
+        )
 
-        LOGGER.info("Syncing tokens data done in %s seconds.", t1 - t0)
-        LOGGER.info("Syncing pairs data done in %s seconds.", t2 - t1)
-        LOGGER.info("Syncing circulating data done in %s seconds.", t4 - t2)
-        LOGGER.info("Syncing configuration data done in %s seconds.", t5 - t4)
-        LOGGER.info("Syncing supply data done in %s seconds.", t6 - t5)
-        LOGGER.info("Syncing vara data done in %s seconds.", t7 - t6)
-        LOGGER.info("Total syncing time: %s seconds.", t7 - t0)
+        # Everything refreshed in this run is read at the same block and
+        # published at once, including what made it before the deadline
+        with RPCStats.within(), Snapshots.building(), Deadline.within(
+            SYNC_CYCLE_SECONDS
+        ), PinnedBlock.within():
+            scheduler = StageScheduler(
+                Syncer.stages(datasets), SYNC_MAX_WORKERS
+            )
+            scheduler.run()
 
-        reset_multicall_pool_executor()
+        scheduler.log_timings()
+        LOGGER.info("Total syncing time: %s seconds.", time.time() - t0)
 
 
 def clear_cache():
     """Clears the entire cache (Redis database)."""
-    if CACHE:
-        CACHE.flushdb()
+    last_progress = (
+        Checkpoint.last_progress() if CACHE is not None else None
+    )
+
+    if last_progress and time.time() - last_progress < SYNC_RESUME_SECONDS:
+        LOGGER.info("Resuming the previous sync, cache not cleared.")
+    elif CACHE is not None:
+        with ImmutableReads.kept(), PairIndex.kept():
+            CACHE.flushdb()
         LOGGER.info("Cache cleared!")
     else:
         LOGGER.warning("Cache not initialized!")
 
 
 def sync_forever():
-    LOGGER.info(f"Syncing every {SYNC_WAIT_SECONDS} seconds ...")
+    LOGGER.info(
+        "Syncing %s datasets on their own cadence ...",
+        len(Syncer.REGISTRY.datasets),
+    )
 
     if CLEAR_INITIAL_CACHE:
         clear_cache()
 
+    if VOTER_EVENTS_ENABLED:
+        LOGGER.info("Refreshing pairs from voter events ...")
+        threading.Thread(target=monitor_forever, daemon=True).start()
+
     while True:
         try:
+            # With shards, only the leader refreshes and publishes the
+            # datasets, the other workers help with the pairs shards.
+            if SYNC_SHARDS > 1 and not LEADER_LEASE.acquire():
+                Pairs.work_on_shards()
+                time.sleep(1)
+                continue
+
             Syncer.sync()
         except KeyboardInterrupt:
             LOGGER.info("Syncing stopped!")
@@ -117,7 +197,14 @@ def sync_forever():
         except Exception as error:
             LOGGER.error(f"Sync proccess failed: {error}")
 
-        time.sleep(SYNC_WAIT_SECONDS)
+        # Wake up only when the next dataset is due, or in time to keep
+        # the leadership
+        time.sleep(
+            max(
+                1,
+                min(Syncer.REGISTRY.next_due_in(), SYNC_LEASE_SECONDS / 2),
+            )
+        )
 
 
 if __name__ == "__main__":
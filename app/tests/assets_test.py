@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 
+from unittest import TestCase, mock
+
 from app.assets import Token
-from app.settings import IGNORED_TOKEN_ADDRESSES
+from app.assets.model import DEXSCREENER_PAIRS
+from app.assets.prices import ExternalPriceCache, PriceGraph
+from app.settings import CACHE, IGNORED_TOKEN_ADDRESSES
 from app.tests.helpers import AppTestCase
 
 
@@ -22,3 +26,153 @@ class AssetsTestCase(AppTestCase):
         zero_priced_symbols = list(map(lambda t: t.symbol, zero_priced))
 
         self.assertFalse("BOND" in zero_priced_symbols)
+
+
+class ExternalPricesTestCase(TestCase):
+    addresses = ["0x%040x" % idx for idx in range(31)]
+
+    def setUp(self):
+        for source in ("dexscreener", "test"):
+            CACHE.delete(
+                *[
+                    ExternalPriceCache.CACHE_KEY % (source, address)
+                    for address in self.addresses
+                ]
+            )
+
+    def test_dexscreener_batches(self):
+        addresses = self.addresses
+        response = mock.Mock()
+        # As many pairs as answered at most, other tokens crowded out
+        response.json.return_value = dict(
+            pairs=[
+                dict(
+                    chainId="kava",
+                    dexId="other",
+                    baseToken=dict(address=addresses[0].upper()),
+                    priceUsd="1,000.5",
+                )
+            ]
+            * (DEXSCREENER_PAIRS - 1)
+            + [
+                dict(
+                    chainId="kava",
+                    dexId="equilibre",
+                    baseToken=dict(address=addresses[0]),
+                    priceUsd="2",
+                ),
+            ]
+        )
+
+        with mock.patch("app.assets.model.HTTP") as http:
+            http.get.return_value = response
+            prices = Token._get_prices_from_dexscreener(addresses)
+
+        # 30 tokens at most per request
+        self.assertEqual(http.get.call_count, 2)
+        self.assertEqual(prices, {addresses[0]: 2.0})
+
+        # Priced tokens are not asked again, crowded out ones are, the one
+        # asked alone is not listed
+        with mock.patch("app.assets.model.HTTP") as http:
+            http.get.return_value.json.return_value = dict(pairs=None)
+            prices = Token._get_prices_from_dexscreener(addresses)
+
+        self.assertEqual(http.get.call_count, 1)
+        self.assertNotIn(addresses[0], http.get.call_args_list[0][0][0])
+        self.assertNotIn(addresses[30], http.get.call_args_list[0][0][0])
+        self.assertIn(addresses[1], http.get.call_args_list[0][0][0])
+        self.assertEqual(prices, {addresses[0]: 2.0})
+
+        # Tokens missing from a complete answer are not listed
+        with mock.patch("app.assets.model.HTTP") as http:
+            Token._get_prices_from_dexscreener(addresses)
+
+        self.assertEqual(http.get.call_count, 0)
+
+    def test_cache(self):
+        first, second, third = self.addresses[:3]
+        ExternalPriceCache.set_many("test", {first: 1.5, second: 0})
+
+        self.assertEqual(
+            ExternalPriceCache.get_many("test", [first, second, third]),
+            {first: 1.5, second: 0},
+        )
+
+
+class PriceGraphTestCase(TestCase):
+    def pair(self, token0, token1, reserve0, reserve1, stable=False):
+        return dict(
+            token0_address=token0,
+            token1_address=token1,
+            reserve0=reserve0,
+            reserve1=reserve1,
+            stable=stable,
+        )
+
+    def test_prices_spread_from_the_anchor(self):
+        graph = PriceGraph(
+            [
+                self.pair("0xusd", "0xA", 10000, 5000),
+                self.pair("0xa", "0xb", 1000, 4000),
+                self.pair("0xc", "0xd", 1000, 1000),
+            ],
+            anchors={"0xusd": 1.0},
+        )
+
+        self.assertEqual(graph.price_of("0xUSD"), 1.0)
+        self.assertEqual(graph.price_of("0xa"), 2.0)
+        self.assertEqual(graph.price_of("0xb"), 0.5)
+        # Not connected to the anchor
+        self.assertEqual(graph.price_of("0xc"), 0)
+
+    def test_prices_are_weighted_by_liquidity(self):
+        graph = PriceGraph(
+            [
+                self.pair("0xusd", "0xa", 9000, 9000),
+                self.pair("0xa", "0xusd", 1000, 3000),
+            ],
+            anchors={"0xusd": 1.0},
+        )
+
+        # 1.0 for $9000, 3.0 for $3000
+        self.assertEqual(graph.price_of("0xa"), 1.5)
+
+    def test_stable_pairs_quote_their_curve(self):
+        graph = PriceGraph(
+            [
+                self.pair("0xusd", "0xa", 1000, 1000, stable=True),
+                self.pair("0xusd", "0xb", 1000, 3000, stable=True),
+            ],
+            anchors={"0xusd": 1.0},
+        )
+
+        self.assertAlmostEqual(graph.price_of("0xa"), 1.0)
+        # Not the 1/3 reserves ratio of an unbalanced pool
+        self.assertAlmostEqual(graph.price_of("0xb"), 28 / 36)
+
+    def test_thin_pairs_are_left_out(self):
+        graph = PriceGraph(
+            [
+                self.pair("0xusd", "0xa", 1000, 1000),
+                self.pair("0xusd", "0xa", 1, 1000),
+                self.pair("0xusd", "0xb", 0, 1000),
+            ],
+            anchors={"0xusd": 1.0},
+        )
+
+        self.assertEqual(graph.price_of("0xa"), 1.0)
+        self.assertEqual(graph.price_of("0xb"), 0)
+
+    def test_current_graph(self):
+        self.assertIsNone(PriceGraph.current())
+
+        graph = PriceGraph([self.pair("0xusd", "0xa", 1000, 1000)])
+        with PriceGraph.within(graph):
+            self.assertIs(PriceGraph.current(), graph)
+
+            # Nothing to price from, like before the first pairs sync
+            with PriceGraph.within(PriceGraph([])):
+                self.assertIsNone(PriceGraph.current())
+
+        self.assertIsNone(PriceGraph.current())
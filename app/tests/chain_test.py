@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+from unittest import TestCase
+
+import aiohttp
+from multicall import Call
+
+from app.chain import (
+    CallPlan,
+    ChainEngine,
+    ImmutableReads,
+    PairIndex,
+    PinnedBlock,
+    RPCError,
+    RPCStats,
+    bloom_bits,
+    bloom_contains,
+)
+
+PAIR_ADDRESS = "0x1e221ea8d1440c3549942821412c03f101f5e99a"
+OTHER_ADDRESS = "0xce3433baf2356e8404ca7dcc39eb61feda73e2c8"
+
+
+class BloomTestCase(TestCase):
+    def bloom_of(self, *addresses):
+        value = 0
+        for address in addresses:
+            for bit in bloom_bits(address):
+                value |= 1 << bit
+
+        return value.to_bytes(256, "big")
+
+    def test_bits_are_in_range(self):
+        bits = bloom_bits(PAIR_ADDRESS)
+
+        self.assertEqual(len(bits), 3)
+        self.assertTrue(all(0 <= bit < 2048 for bit in bits))
+
+    def test_contains(self):
+        bloom = self.bloom_of(PAIR_ADDRESS)
+
+        self.assertTrue(bloom_contains(bloom, bloom_bits(PAIR_ADDRESS)))
+        self.assertFalse(bloom_contains(bloom, bloom_bits(OTHER_ADDRESS)))
+
+    def test_empty_bloom(self):
+        bloom = bytes(256)
+
+        self.assertFalse(bloom_contains(bloom, bloom_bits(PAIR_ADDRESS)))
+
+
+class CallPlanTestCase(TestCase):
+    def test_scoped_routes_results_back(self):
+        data = {
+            "Pair|0xa|symbol": "vAMM-A/B",
+            "Pair|0xa|decimals": 18,
+            "Pair|0xab|symbol": "vAMM-AB/C",
+            "Gauge|0xa|isAlive": True,
+        }
+
+        self.assertEqual(
+            CallPlan.scoped(data, "Pair", "0xa"),
+            dict(symbol="vAMM-A/B", decimals=18),
+        )
+        self.assertEqual(CallPlan.scoped(data, "Pair", "0xc"), {})
+
+    def test_known_results_are_not_read(self):
+        plan = CallPlan({"Pair|0xa|reserve0": 1, "Pair|0xa|reserve1": 2})
+        plan.add(
+            [
+                Call(
+                    PAIR_ADDRESS,
+                    "getReserves()(uint256,uint256)",
+                    [["Pair|0xa|reserve0", None], ["Pair|0xa|reserve1", None]],
+                )
+            ]
+        )
+
+        self.assertEqual(
+            plan.run(), {"Pair|0xa|reserve0": 1, "Pair|0xa|reserve1": 2}
+        )
+
+    def test_failed_fields(self):
+        plan = CallPlan()
+        plan.failed = [
+            Call(PAIR_ADDRESS, "symbol()(string)", [["Token|0xa|sym", None]]),
+            Call(PAIR_ADDRESS, "name()(string)", [["Token|0xb|name", None]]),
+        ]
+
+        self.assertEqual(plan.failed_fields("Token", "0xa"), ["sym"])
+        self.assertEqual(plan.failed_fields("Token", "0xc"), [])
+
+    def test_calls_are_grouped_by_item(self):
+        calls = [
+            Call(PAIR_ADDRESS, "symbol()(string)", [["Pair|0xa|sym", None]]),
+            Call(PAIR_ADDRESS, "stable()(bool)", [["Pair|0xa|stable", None]]),
+            Call(OTHER_ADDRESS, "symbol()(string)", [["Pair|0xb|sym", None]]),
+        ]
+
+        groups = CallPlan.by_item(calls)
+
+        self.assertEqual(list(groups), ["Pair|0xa", "Pair|0xb"])
+        self.assertEqual(len(groups["Pair|0xa"]), 2)
+
+
+class PinnedBlockTestCase(TestCase):
+    def test_results_are_cached_by_block_target_and_calldata(self):
+        signature = "symbol()(string)"
+        call = Call(PAIR_ADDRESS, signature, [["Pair|0xa|sym", None]])
+        same = Call(PAIR_ADDRESS, signature, [["Pair|0xb|sym", None]])
+        other = Call(OTHER_ADDRESS, signature, [["Pair|0xa|sym", None]])
+
+        with PinnedBlock.within(100) as pinned:
+            self.assertEqual(PinnedBlock.block_id(), 100)
+            self.assertEqual(pinned.get(call), (False, None))
+
+            pinned.set(call, ["vAMM-A/B"])
+
+            self.assertEqual(pinned.get(same), (True, ["vAMM-A/B"]))
+            self.assertEqual(pinned.get(other), (False, None))
+            self.assertEqual(pinned.get(call, "result"), (False, None))
+
+        with PinnedBlock.within(101) as pinned:
+            self.assertEqual(pinned.get(call), (False, None))
+
+        self.assertIsNone(PinnedBlock.block_id())
+
+    def test_custom_handlers_are_not_cacheable(self):
+        self.assertTrue(
+            PinnedBlock.is_cacheable(
+                Call(PAIR_ADDRESS, "decimals()(uint8)", [["decimals", str]])
+            )
+        )
+        self.assertFalse(
+            PinnedBlock.is_cacheable(
+                Call(
+                    PAIR_ADDRESS,
+                    "decimals()(uint8)",
+                    [["decimals", lambda value: value * 2]],
+                )
+            )
+        )
+
+
+class SlowEngine(ChainEngine):
+    """Answers with the endpoint name, after the endpoint delay."""
+
+    def __init__(self, delays):
+        super().__init__(endpoints=list(delays), hedge=True)
+        self.delays = delays
+        self.posted = []
+
+    async def _post(self, endpoint, payload):
+        self.posted.append(endpoint.uri)
+        if self.delays[endpoint.uri] is None:
+            endpoint.fail()
+            raise aiohttp.ClientError(endpoint.uri)
+
+        await asyncio.sleep(self.delays[endpoint.uri])
+        endpoint.record(self.delays[endpoint.uri])
+
+        return endpoint.uri
+
+
+class ListSignature(object):
+    """Passes the aggregated calls as they are."""
+
+    def encode_data(self, args):
+        return args[1]
+
+    def decode_data(self, output):
+        return (output,)
+
+
+class SmallEngine(ChainEngine):
+    """
+    Runs multicalls of up to `limit` calls, each answering `18`, but the
+    calls to `reverting`.
+    """
+
+    TRY_AGGREGATE = ListSignature()
+
+    def __init__(self, limit, reverting=None):
+        super().__init__(endpoints=["node"], hedge=False)
+        self.limit = limit
+        self.reverting = reverting
+        self.sizes = []
+
+    async def eth_call(self, target, data, block_id=None, endpoint=None):
+        self.sizes.append(len(data))
+        if len(data) > self.limit:
+            raise RPCError("eth_call: out of gas")
+
+        return [
+            (target.lower() != self.reverting, (18).to_bytes(32, "big"))
+            for target, _ in data
+        ]
+
+
+class EchoEngine(ChainEngine):
+    """Answers every request with its first param, batches if `batches`."""
+
+    def __init__(self, batches):
+        super().__init__(endpoints=["node"], hedge=False)
+        self.batches = batches
+        self.sent = []
+
+    async def _send(self, endpoint, payload):
+        self.sent.append(payload)
+
+        if not isinstance(payload, list):
+            return dict(id=payload["id"], result=payload["params"][0])
+        if not self.batches:
+            return dict(id=None, error="batches not supported")
+
+        return [
+            dict(id=request["id"], result=request["params"][0])
+            for request in reversed(payload)
+        ]
+
+
+class ChainEngineTestCase(TestCase):
+    def test_slow_calls_are_hedged(self):
+        engine = SlowEngine({"slow": 0.5, "fast": 0.01})
+        slow, fast = engine.endpoints
+        slow.latencies.extend([0.01] * 20)
+        fast.fail()
+
+        result = engine.run(engine.request("eth_call", [], hedge=True))
+
+        self.assertEqual(result, "fast")
+        self.assertEqual(engine.posted, ["slow", "fast"])
+
+    def test_failed_requests_go_to_another_endpoint(self):
+        engine = SlowEngine({"down": None, "up": 0})
+        down, up = engine.endpoints
+        up.fail()
+
+        result = engine.run(engine.request("eth_blockNumber", []))
+
+        self.assertEqual(result, "up")
+        self.assertFalse(down.healthy())
+
+    def test_shutdown_stops_the_loop(self):
+        engine = SlowEngine({"up": 0})
+        engine.run(engine.request("eth_blockNumber", []))
+        loop, thread = engine.loop, engine._thread
+
+        engine.shutdown()
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(loop.is_closed())
+        self.assertIsNone(engine._session)
+
+    def test_failing_multicalls_are_split(self):
+        engine = SmallEngine(limit=3)
+        endpoint = engine.endpoints[0]
+        endpoint.chunk_size = 8
+        calls = [
+            Call(PAIR_ADDRESS, "decimals()(uint8)", [["Pair|%s|d" % i, None]])
+            for i in range(8)
+        ]
+
+        results, failed = engine.run(engine.aggregate(calls))
+
+        self.assertEqual(failed, [])
+        self.assertEqual(len(results), 8)
+        self.assertEqual(set(results.values()), {18})
+        self.assertEqual(engine.sizes, [8, 4, 4, 2, 2, 2, 2])
+        # Halved under 4, then grown once a full chunk of 2 was answered
+        self.assertEqual(endpoint.chunk_size, 3)
+
+        engine.sizes = []
+        engine.run(engine.aggregate(calls))
+
+        self.assertEqual(engine.sizes, [3, 3, 2])
+        self.assertEqual(endpoint.chunk_size, 4)
+
+    def test_failed_calls_are_isolated(self):
+        engine = SmallEngine(limit=10, reverting=OTHER_ADDRESS)
+        good = Call(PAIR_ADDRESS, "decimals()(uint8)", [["Pair|a|d", None]])
+        bad = Call(OTHER_ADDRESS, "decimals()(uint8)", [["Pair|b|d", None]])
+
+        results, failed = engine.run(engine.aggregate([good, bad]))
+
+        self.assertEqual(results, {"Pair|a|d": 18})
+        self.assertEqual(failed, [bad])
+
+    def test_reverted_multicalls_are_not_split(self):
+        engine = SmallEngine(limit=0)
+        chunk_size = engine.endpoints[0].chunk_size
+        calls = [Call(PAIR_ADDRESS, "decimals()(uint8)", [["d", None]])] * 2
+
+        async def revert(*args, **kwargs):
+            raise RPCError("eth_call: execution reverted")
+
+        engine.eth_call = revert
+
+        with self.assertRaises(RPCError):
+            engine.run(engine.aggregate(calls))
+
+        self.assertEqual(engine.endpoints[0].chunk_size, chunk_size)
+
+    def test_requests_are_batched(self):
+        engine = EchoEngine(batches=True)
+        requests = [("eth_getBlockByNumber", [number]) for number in range(3)]
+
+        self.assertEqual(engine.run(engine.batch(requests)), [0, 1, 2])
+        self.assertEqual(len(engine.sent), 1)
+
+    def test_batches_fall_back_to_single_requests(self):
+        engine = EchoEngine(batches=False)
+        requests = [("eth_getLogs", [number]) for number in range(3)]
+
+        self.assertEqual(engine.run(engine.batch(requests)), [0, 1, 2])
+        self.assertEqual(len(engine.sent), 4)
+        self.assertFalse(engine.endpoints[0].batches)
+
+        engine.run(engine.batch(requests))
+
+        self.assertEqual(len(engine.sent), 7)
+
+    def test_p95(self):
+        engine = SlowEngine({"one": 0})
+        endpoint = engine.endpoints[0]
+
+        self.assertIsNone(endpoint.p95())
+        self.assertFalse(engine.hedge)
+
+        endpoint.latencies.extend(range(1, 101))
+
+        self.assertEqual(endpoint.p95(), 95)
+
+
+class RPCStatsTestCase(TestCase):
+    def test_requests_are_counted_by_method_and_caller(self):
+        with RPCStats.within() as stats:
+            with RPCStats.bound(stats, "Pair.from_chain_many"):
+                RPCStats.record_request("eth_call", 100, 300, 0.02)
+                RPCStats.record_calls(25)
+                RPCStats.record_request("eth_call", 100, 300, 20)
+                RPCStats.record_calls(25)
+
+        data = stats.to_dict()
+
+        self.assertIsNone(RPCStats.current())
+        self.assertEqual(data["methods"]["eth_call"]["requests"], 2)
+        self.assertEqual(data["methods"]["eth_call"]["sent"], 200)
+        self.assertEqual(
+            data["methods"]["eth_call"]["latency"], {"0.025": 1, "+Inf": 1}
+        )
+        self.assertEqual(data["callers"]["Pair.from_chain_many"]["calls"], 50)
+        self.assertEqual(data["callers"]["Pair.from_chain_many"]["bytes"], 800)
+
+    def test_nothing_is_counted_outside_a_cycle(self):
+        RPCStats.record_request("eth_call", 100, 300, 0.02)
+        RPCStats.record_calls(1)
+
+        self.assertIsNone(RPCStats.current())
+
+    def test_caller(self):
+        self.assertEqual(RPCStats.caller(1), "RPCStatsTestCase.test_caller")
+
+
+class ImmutableReadsTestCase(TestCase):
+    def test_only_fixed_reads_are_immutable(self):
+        self.assertTrue(
+            ImmutableReads.is_immutable(
+                Call(PAIR_ADDRESS, "token0()(address)", [["t0", None]])
+            )
+        )
+        self.assertFalse(
+            ImmutableReads.is_immutable(
+                Call(PAIR_ADDRESS, "totalSupply()(uint256)", [["ts", None]])
+            )
+        )
+        self.assertFalse(
+            ImmutableReads.is_immutable(
+                Call(PAIR_ADDRESS, "fee()(uint24)", [["f", lambda v: v]])
+            )
+        )
+
+    def test_known_reads_are_not_made_again(self):
+        call = Call(OTHER_ADDRESS, "decimals()(uint8)", [["Pair|0xa|d", None]])
+        ImmutableReads.set_many({ImmutableReads.field_of(call): [18]})
+        ImmutableReads._values.clear()
+
+        plan = CallPlan().add([call])
+
+        self.assertEqual(plan.run(), {"Pair|0xa|d": 18})
+        self.assertEqual(plan.failed, [])
+
+
+class PairIndexTestCase(TestCase):
+    def test_pairs_by_tokens_and_type(self):
+        PairIndex.add_many(
+            [(PAIR_ADDRESS, OTHER_ADDRESS, True, "0xA"), (None, None, 0, "")]
+        )
+
+        self.assertFalse(PairIndex.is_empty())
+        self.assertEqual(
+            PairIndex.get(OTHER_ADDRESS.upper(), PAIR_ADDRESS, True), "0xa"
+        )
+        self.assertIsNone(PairIndex.get(PAIR_ADDRESS, OTHER_ADDRESS, False))
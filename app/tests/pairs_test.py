@@ -1,6 +1,11 @@
 # -*- coding: utf-8 -*-
 
-from app.pairs import Pair
+import json
+from unittest import TestCase
+
+from app.gauges import Gauge
+from app.misc import ModelUteis
+from app.pairs import Pair, Pairs
 from app.tests.helpers import AppTestCase
 
 
@@ -17,3 +22,49 @@ class PairsTestCase(AppTestCase):
         )
 
         self.assertEqual(type(result.json["data"]), list)
+
+
+class SaveOverTestCase(TestCase):
+    def test_gauge_rewards_do_not_add_up(self):
+        address = "0x000000000000000000000000000000000000dead"
+        token = "0x000000000000000000000000000000000000beef"
+
+        for _ in range(2):
+            gauge = ModelUteis.save_over(Gauge, address=address, reward=1)
+            gauge.rewards[token] = float(gauge.rewards.get(token) or 0) + 1.5
+
+        gauge = Gauge.load(address)
+        self.assertEqual(float(gauge.rewards[token]), 1.5)
+
+        gauge.delete()
+
+
+class VotesPatchedTestCase(TestCase):
+    def test_only_votes_and_aprs_are_updated(self):
+        address = "0x000000000000000000000000000000000000dead"
+        gauge = ModelUteis.save_over(
+            Gauge, address=address, votes=10, apr=5, fees_apr=1
+        )
+        cached = json.dumps(
+            dict(
+                data=[
+                    dict(
+                        address="0xpair",
+                        tvl=100,
+                        gauge=dict(address=address, votes=1, apr=1, tbv=7),
+                    ),
+                    dict(address="0xother", gauge=None),
+                ]
+            )
+        )
+
+        pairs = json.loads(Pairs.votes_patched(cached, {"0xpair"}))["data"]
+
+        self.assertEqual(pairs[0]["tvl"], 100)
+        self.assertEqual(pairs[0]["gauge"]["tbv"], 7)
+        self.assertEqual(pairs[0]["gauge"]["votes"], 10)
+        self.assertEqual(pairs[0]["gauge"]["apr"], 5)
+        self.assertEqual(pairs[0]["gauge"]["fees_apr"], 1)
+        self.assertIsNone(pairs[1]["gauge"])
+
+        gauge.delete()
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+from unittest import TestCase
+
+from app.settings import CACHE
+from app.sync import (
+    Checkpoint,
+    Dataset,
+    Deadline,
+    FreshnessRegistry,
+    Lease,
+    Snapshots,
+    Stage,
+    StageScheduler,
+    Tiers,
+    bind_context,
+)
+
+
+class StageSchedulerTestCase(TestCase):
+    def test_dependencies_run_first(self):
+        calls = []
+        lock = threading.Lock()
+
+        def task(name, delay=0):
+            def run():
+                time.sleep(delay)
+                with lock:
+                    calls.append(name)
+
+            return run
+
+        scheduler = StageScheduler(
+            [
+                Stage("pairs", task("pairs"), depends_on=["tokens"]),
+                Stage("tokens", task("tokens", 0.05)),
+                Stage("supply", task("supply")),
+            ],
+            max_workers=3,
+        )
+        scheduler.run()
+
+        self.assertEqual(len(calls), 3)
+        self.assertLess(calls.index("tokens"), calls.index("pairs"))
+
+        path, total = scheduler.critical_path()
+        self.assertEqual(path, ["tokens", "pairs"])
+        self.assertGreater(total, 0)
+
+    def test_failed_stage_skips_dependents(self):
+        calls = []
+
+        def fail():
+            raise RuntimeError("boom")
+
+        scheduler = StageScheduler(
+            [
+                Stage("tokens", fail),
+                Stage("pairs", lambda: calls.append("pairs"), ["tokens"]),
+                Stage("vara", lambda: calls.append("vara"), ["pairs"]),
+                Stage("supply", lambda: calls.append("supply")),
+            ]
+        )
+        scheduler.run()
+
+        self.assertEqual(calls, ["supply"])
+        self.assertEqual(scheduler.failed, {"tokens"})
+        self.assertEqual(scheduler.skipped, {"pairs", "vara"})
+
+    def test_cycle_is_rejected(self):
+        with self.assertRaises(ValueError):
+            StageScheduler(
+                [
+                    Stage("a", lambda: None, ["b"]),
+                    Stage("b", lambda: None, ["a"]),
+                ]
+            )
+
+
+class FreshnessRegistryTestCase(TestCase):
+    def setUp(self):
+        CACHE.delete(FreshnessRegistry.CACHE_KEY, "test:fast", "test:slow")
+
+        self.fast = Dataset(
+            "fast", "test:fast", lambda: CACHE.set("test:fast", 1), 5
+        )
+        self.slow = Dataset(
+            "slow", "test:slow", lambda: CACHE.set("test:slow", 1), 60, 10
+        )
+        self.registry = FreshnessRegistry([self.fast, self.slow])
+
+    def test_missing_data_is_due(self):
+        self.assertEqual(self.registry.due(), [self.slow, self.fast])
+
+    def test_refresh_follows_each_cadence(self):
+        now = time.time()
+        self.registry.refresh(self.fast)
+        self.registry.refresh(self.slow)
+
+        self.assertEqual(self.registry.due(now + 1), [])
+        self.assertEqual(self.registry.due(now + 10), [self.fast])
+        self.assertEqual(self.registry.due(now + 61), [self.slow, self.fast])
+        self.assertLessEqual(self.registry.next_due_in(), 5)
+
+    def test_failed_refresh_waits_for_its_cadence(self):
+        def fail():
+            raise RuntimeError("boom")
+
+        broken = Dataset("broken", "test:broken", fail, 30)
+        registry = FreshnessRegistry([broken])
+
+        with self.assertRaises(RuntimeError):
+            registry.refresh(broken)
+
+        self.assertEqual(registry.due(), [])
+        self.assertEqual(registry.due(time.time() + 31), [broken])
+
+
+class LeaseTestCase(TestCase):
+    def setUp(self):
+        self.lease = Lease("test:shard", 10, owner="worker-a")
+        self.other = Lease("test:shard", 10, owner="worker-b")
+        CACHE.delete(self.lease.key)
+
+    def test_single_owner(self):
+        self.assertTrue(self.lease.acquire())
+        self.assertFalse(self.other.acquire())
+        self.assertTrue(self.lease.acquire())
+        self.assertTrue(self.lease.is_owned())
+        self.assertFalse(self.other.is_owned())
+
+    def test_only_owner_renews_and_releases(self):
+        self.lease.acquire()
+
+        self.assertFalse(self.other.renew())
+        self.assertFalse(self.other.release())
+        self.assertTrue(self.lease.renew())
+        self.assertTrue(self.lease.release())
+        self.assertTrue(self.other.acquire())
+
+    def test_expired_lease_is_taken_over(self):
+        self.lease.acquire()
+        CACHE.delete(self.lease.key)
+
+        self.assertTrue(self.other.acquire())
+        self.assertFalse(self.lease.renew())
+
+
+class CheckpointTestCase(TestCase):
+    def setUp(self):
+        self.checkpoint = Checkpoint("test", 60)
+        self.checkpoint.clear()
+
+    def test_pending_skips_fresh_items(self):
+        now = time.time()
+        self.checkpoint.mark("0xa", now - 10)
+        self.checkpoint.mark("0xb", now - 120)
+
+        self.assertTrue(self.checkpoint.is_fresh("0xa", now))
+        self.assertFalse(self.checkpoint.is_fresh("0xb", now))
+        self.assertEqual(
+            self.checkpoint.pending(["0xa", "0xb", "0xc"], now),
+            ["0xb", "0xc"],
+        )
+        self.assertGreaterEqual(Checkpoint.last_progress(), now - 10)
+
+
+class SnapshotsTestCase(TestCase):
+    def setUp(self):
+        CACHE.delete(Snapshots.POINTER_KEY, Snapshots.PREVIOUS_KEY)
+
+    def test_building_publishes_on_exit(self):
+        Snapshots.set("test:a", "old")
+
+        with Snapshots.building():
+            Snapshots.set("test:a", "new")
+            Snapshots.set("test:b", "new")
+
+            self.assertEqual(Snapshots.get("test:a"), b"old")
+            self.assertIsNone(Snapshots.get("test:b"))
+
+        self.assertEqual(Snapshots.get("test:a"), b"new")
+        self.assertEqual(Snapshots.get("test:b"), b"new")
+        self.assertEqual(
+            Snapshots.generation("test:a"), Snapshots.generation("test:b")
+        )
+
+    def test_rollback_and_cleanup(self):
+        Snapshots.set("test:a", "1")
+        first = Snapshots.generation("test:a")
+        Snapshots.set("test:a", "2")
+
+        self.assertTrue(Snapshots.rollback("test:a"))
+        self.assertEqual(Snapshots.get("test:a"), b"1")
+
+        Snapshots.set("test:a", "3")
+        Snapshots.set("test:a", "4")
+        self.assertFalse(CACHE.exists(Snapshots.data_key("test:a", first)))
+
+    def test_newer_generations_are_kept(self):
+        with Snapshots.building() as generation:
+            Snapshots.set("test:a", "sync")
+
+            # Fully written again meanwhile, without a rebaser
+            with Snapshots.building():
+                Snapshots.set("test:a", "patch")
+
+        self.assertEqual(Snapshots.get("test:a"), b"patch")
+        self.assertFalse(
+            CACHE.exists(Snapshots.data_key("test:a", generation.number))
+        )
+
+    def test_syncs_are_rebased_on_newer_patches(self):
+        bases = []
+
+        def rebase(value, generation):
+            bases.append(generation)
+            return value + b"+patch"
+
+        Snapshots.rebase_with("test:c", rebase)
+        self.addCleanup(Snapshots.REBASERS.pop, "test:c")
+
+        with Snapshots.building() as generation:
+            Snapshots.set("test:c", "sync")
+
+            # Patched meanwhile, ex. by the voter monitor
+            with Snapshots.building() as patch:
+                Snapshots.set("test:c", "patch")
+
+        self.assertEqual(Snapshots.get("test:c"), b"sync+patch")
+        self.assertEqual(bases, [generation.number])
+        self.assertGreater(Snapshots.generation("test:c"), patch.number)
+        self.assertFalse(
+            CACHE.exists(Snapshots.data_key("test:c", generation.number))
+        )
+
+
+class TiersTestCase(TestCase):
+    def setUp(self):
+        self.tiers = Tiers.parse(["1000:1", "10:3", "0:10"])
+
+    def test_every(self):
+        self.assertEqual(self.tiers.every(5000), 1)
+        self.assertEqual(self.tiers.every(10), 3)
+        self.assertEqual(self.tiers.every(1), 10)
+        self.assertEqual(self.tiers.every(None), 1)
+
+    def test_due_spreads_and_prioritizes(self):
+        values = dict(("0x%s" % idx, 1) for idx in range(100))
+        values.update(big=5000, new=None)
+
+        due = [set(self.tiers.due(values, cycle)) for cycle in range(10)]
+
+        for cycle_due in due:
+            self.assertIn("big", cycle_due)
+            self.assertIn("new", cycle_due)
+            self.assertLess(len(cycle_due), len(values))
+        self.assertEqual(set().union(*due), set(values))
+
+        self.assertEqual(self.tiers.due(values, 0, budget=2), ["new", "big"])
+
+    def test_left_over_items_get_their_turn(self):
+        # A single tier, all due every cycle, 3 times the budget
+        tiers = Tiers.parse(["0:1"])
+        values = dict(("0x%s" % idx, idx) for idx in range(6))
+
+        synced, carried = [], []
+        for cycle in range(3):
+            due, carried = tiers.split(values, cycle, 2, carried)
+            synced.extend(due)
+
+        self.assertEqual(synced[:2], ["0x5", "0x4"])
+        self.assertEqual(set(synced), set(values))
+        self.assertEqual(len(carried), 4)
+
+
+class DeadlineTestCase(TestCase):
+    def test_no_deadline(self):
+        self.assertIsNone(Deadline.current())
+        self.assertFalse(Deadline.exceeded())
+
+        with Deadline.within(0) as deadline:
+            self.assertIsNone(deadline.remaining())
+            self.assertFalse(Deadline.exceeded())
+
+    def test_bind_context_carries_deadline_to_threads(self):
+        results = []
+
+        with Deadline.within(0.01):
+            check = bind_context(
+                lambda: results.append(Deadline.exceeded())
+            )
+            time.sleep(0.02)
+
+        thread = threading.Thread(target=check)
+        thread.start()
+        thread.join()
+
+        self.assertEqual(results, [True])
+        self.assertFalse(Deadline.exceeded())
+
+    def test_scheduler_defers_stages_once_expired(self):
+        calls = []
+
+        stages = [
+            Stage("slow", lambda: time.sleep(0.02) or calls.append("slow")),
+            Stage("after", lambda: calls.append("after"), ["slow"]),
+        ]
+
+        with Deadline.within(0.01):
+            scheduler = StageScheduler(stages, max_workers=2)
+            scheduler.run()
+
+        self.assertEqual(calls, ["slow"])
+        self.assertEqual(scheduler.deferred, {"after"})
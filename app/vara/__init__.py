@@ -6,11 +6,11 @@ import falcon
 
 from app.assets import Token
 from app.settings import (
-    CACHE,
     DEFAULT_TOKEN_ADDRESS,
     LOGGER,
     VARA_CACHE_EXPIRATION,
 )
+from app.sync import Snapshots
 
 
 class VaraPrice(object):
@@ -27,6 +27,12 @@ class VaraPrice(object):
 
     @classmethod
     def sync(cls):
+        """Refreshes the Vara token price and caches it."""
+        token = Token.find(DEFAULT_TOKEN_ADDRESS)
+
+        if token:
+            token._price_feed()
+
         cls.recache()
 
     @classmethod
@@ -46,8 +52,9 @@ class VaraPrice(object):
                 LOGGER.debug("Token: %s", token)
                 LOGGER.debug("VARA price: %s", token.price)
 
-                CACHE.set(cls.CACHE_KEY, str(token.price))
-                CACHE.expire(cls.CACHE_KEY, VARA_CACHE_EXPIRATION)
+                Snapshots.set(
+                    cls.CACHE_KEY, str(token.price), ttl=VARA_CACHE_EXPIRATION
+                )
 
                 LOGGER.debug("Cache updated for %s.", cls.CACHE_KEY)
                 return str(token.price)
@@ -67,7 +74,7 @@ class VaraPrice(object):
         This method gets the Vara price from the cache. If the price isn't in
         the cache, it calls the recache() method to get fresh data.
         """
-        vara_price = CACHE.get(self.CACHE_KEY) or VaraPrice.recache()
+        vara_price = Snapshots.get(self.CACHE_KEY) or VaraPrice.recache()
 
         if vara_price:
             resp.text = vara_price
@@ -8,12 +8,7 @@ from web3 import Web3
 from app.misc import JSONEncoder
 from app.pairs import Gauge, Pair, Token
 from app.rewards import BribeReward, EmissionReward, FeeReward
-from app.settings import (
-    CACHE,
-    DEFAULT_TOKEN_ADDRESS,
-    LOGGER,
-    reset_multicall_pool_executor,
-)
+from app.settings import CACHE, DEFAULT_TOKEN_ADDRESS, LOGGER
 
 from .model import VeNFT
 
@@ -40,7 +35,6 @@ class Accounts(object):
         to_meta = []
 
         venfts = VeNFT.from_chain(address)
-        reset_multicall_pool_executor()
 
         default_token = Token.find(DEFAULT_TOKEN_ADDRESS)
         emissions = EmissionReward.query(
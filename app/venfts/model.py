@@ -2,9 +2,10 @@
 
 from datetime import datetime
 
-from multicall import Call, Multicall
+from multicall import Call
 from walrus import DateTimeField, IntegerField, Model, TextField
 
+from app.chain import CallPlan, read
 from app.pairs import Gauge, Pair
 from app.rewards import BribeReward, EmissionReward, FeeReward
 from app.settings import (
@@ -71,9 +72,10 @@ class VeNFT(Model):
                 )
 
         t0 = datetime.utcnow()
-        multi_data = Multicall(calls)()
-        multi_fees = Multicall(fee_calls)()
-        multi_bribes = Multicall(bribe_calls)()
+        # Identical calls (ex. `decimals()` per veNFT) are only made once
+        multi_data = CallPlan().add(calls).run()
+        multi_fees = CallPlan().add(fee_calls).run()
+        multi_bribes = CallPlan().add(bribe_calls).run()
         tdelta = datetime.utcnow() - t0
 
         LOGGER.debug(
@@ -165,9 +167,9 @@ class VeNFT(Model):
     @classmethod
     def _fetch_token_ids(cls, address):
         """Returns account address veNFT ids."""
-        tokens_count = Call(
-            VE_ADDRESS, ["balanceOf(address)(uint256)", address]
-        )()
+        tokens_count = read(
+            Call(VE_ADDRESS, ["balanceOf(address)(uint256)", address])
+        )
 
         if tokens_count == 0:
             return []
@@ -186,4 +188,4 @@ class VeNFT(Model):
             )
             calls.append(call)
 
-        return list(Multicall(calls)().values())
+        return list(CallPlan().add(calls).run().values())
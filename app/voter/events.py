@@ -2,27 +2,130 @@ import json
 import time
 
 from blinker import signal
+from eth_utils import event_abi_to_log_topic
 from web3 import Web3, exceptions
 
-from app.settings import LOGGER, VOTER_ADDRESS, WEB3_PROVIDER_URI
+from app.gauges import Gauge
+from app.pairs import Pair, Pairs
+from app.sessions import HTTP
+from app.sync import LEADER_LEASE
+from app.settings import (
+    LOGGER,
+    SYNC_SHARDS,
+    VOTER_ADDRESS,
+    VOTER_EVENTS_POLL_SECONDS,
+    WEB3_PROVIDER_URI,
+)
 
 eventGaugeCreated = signal("GaugeCreated")
 eventGaugeKilled = signal("GaugeKilled")
+eventGaugeRevived = signal("GaugeRevived")
+eventVoted = signal("Voted")
+eventNotifyReward = signal("NotifyReward")
+eventDistributeReward = signal("DistributeReward")
 
 
 class EventListener:
+    """
+    Applies voter events to the synced pairs and gauges.
+
+    Events are collected while a batch of logs is processed, `flush`
+    then refreshes the affected pairs and gauges and patches the cached
+    pairs data.
+    """
+
     def __init__(self):
-        eventGaugeCreated.connect(self.on_event_received)
-        eventGaugeKilled.connect(self.on_event_received)
+        self.reset()
+
+        eventGaugeCreated.connect(self.on_gauge_created)
+        eventGaugeKilled.connect(self.on_gauge_changed)
+        eventGaugeRevived.connect(self.on_gauge_changed)
+        eventVoted.connect(self.on_voted)
+        eventNotifyReward.connect(self.on_notify_reward)
+        eventDistributeReward.connect(self.on_distribute_reward)
+
+    def on_gauge_created(self, sender, event):
+        self.pair_addresses.add(event["args"]["pool"].lower())
+
+    def on_gauge_changed(self, sender, event):
+        gauge_address = event["args"]["gauge"].lower()
+
+        try:
+            pair = Pair.get(Pair.gauge_address == gauge_address)
+            self.pair_addresses.add(pair.address)
+        except ValueError:
+            LOGGER.debug("No pair synced for gauge %s.", gauge_address)
+
+    def on_voted(self, sender, event):
+        # Votes do not carry the pool, every gauge weight is re-read
+        self.votes_changed = True
+
+    def on_notify_reward(self, sender, event):
+        self.rewards_notified = True
+
+    def on_distribute_reward(self, sender, event):
+        self.gauge_addresses.add(event["args"]["gauge"].lower())
+
+    def flush(self):
+        """Refreshes everything the received events touched."""
+        if SYNC_SHARDS > 1 and not LEADER_LEASE.is_owned():
+            # Only the leading sync worker publishes
+            self.reset()
+            return
+
+        if self.rewards_notified:
+            # New emissions change every gauge reward rate
+            self.pair_addresses.update(
+                pair.address for pair in Pair.all() if pair.gauge_address
+            )
 
-    def on_event_received(self, sender, event):
-        print(f"Received event in EventListener: {event}")
+        for addresses in Pairs.batches(list(self.pair_addresses)):
+            Pairs.sync_pairs(addresses)
+
+        for address in self.gauge_addresses:
+            try:
+                pair = Pair.get(Pair.gauge_address == address)
+            except ValueError:
+                continue
+
+            if pair.address not in self.pair_addresses:
+                pair.syncup_gauge()
+                self.pair_addresses.add(pair.address)
+
+        voted_addresses = set()
+        if self.votes_changed:
+            Gauge.refresh_votes(list(Gauge.all()))
+            # Only the votes and APRs of the other pairs changed
+            voted_addresses = set(
+                pair.address for pair in Pair.all() if pair.gauge_address
+            ) - self.pair_addresses
+
+        if self.pair_addresses:
+            LOGGER.info(
+                "Voter events refreshed %s pairs.", len(self.pair_addresses)
+            )
+            Pairs.patch(self.pair_addresses)
+
+        if voted_addresses:
+            LOGGER.info(
+                "Voter events refreshed %s pairs votes.", len(voted_addresses)
+            )
+            Pairs.patch(voted_addresses, votes_only=True)
+
+        self.reset()
+
+    def reset(self):
+        self.pair_addresses = set()
+        self.gauge_addresses = set()
+        self.votes_changed = False
+        self.rewards_notified = False
 
 
 class VoterContractMonitor:
-    def __init__(self, contract_address, node_endpoint):
-        self.w3 = Web3(Web3.HTTPProvider(node_endpoint))
-        self.contract_address = contract_address
+    def __init__(self, contract_address, node_endpoint, listener=None):
+        self.w3 = Web3(Web3.HTTPProvider(node_endpoint, session=HTTP))
+        self.contract_address = Web3.toChecksumAddress(contract_address)
+        self.listener = listener
         self.last_processed_block = self.get_current_block()
 
         LOGGER.info(
@@ -42,7 +145,7 @@ class VoterContractMonitor:
         except exceptions.ConnectionError:
             LOGGER.error(
                 "Error: Unable to connect to Ethereum node %s",
-                self.w3.eth.blockNumber,
+                self.w3.provider.endpoint_uri,
             )
             return None
 
@@ -51,39 +154,72 @@ class VoterContractMonitor:
         if not current_block:
             return
 
-        event_names = [
-            event["name"]
+        if self.last_processed_block is None:
+            self.last_processed_block = current_block
+            return
+
+        if current_block <= self.last_processed_block:
+            return
+
+        # Only the events someone listens to are fetched, all of them with
+        # a single `eth_getLogs` request, in chain order
+        event_names = {
+            Web3.toHex(event_abi_to_log_topic(event)): event["name"]
             for event in self.CONTRACT_ABI
-            if event["type"] == "event"
-        ]
+            if event["type"] == "event" and signal(event["name"]).receivers
+        }
+
+        if event_names:
+            logs = self.w3.eth.get_logs(
+                dict(
+                    address=self.contract_address,
+                    fromBlock=self.last_processed_block + 1,
+                    toBlock=current_block,
+                    topics=[list(event_names)],
+                )
+            )
+        else:
+            logs = []
 
-        for event_name in event_names:
+        for log in logs:
+            event_name = event_names.get(Web3.toHex(log["topics"][0]))
             try:
                 event = getattr(self.contract.events, event_name)
-                for log in event.getPastEvents(
-                    fromBlock=self.last_processed_block, toBlock=current_block
-                ):
-                    self.handle_event(log)
-            except exceptions.ContractLogicError as e:
+                self.handle_event(event().processLog(log))
+            except (
+                exceptions.ContractLogicError,
+                exceptions.MismatchedABI,
+            ) as e:
                 LOGGER.error("Error processing %s %s", event_name, e)
 
         self.last_processed_block = current_block
 
+        if self.listener:
+            self.listener.flush()
+
     def handle_event(self, event):
-        print(event)
+        LOGGER.debug("Voter event %s: %s", event["event"], event["args"])
+        signal(event["event"]).send(self, event=event)
 
     def monitor(self):
         while True:
             try:
-                time.sleep(30)
+                time.sleep(VOTER_EVENTS_POLL_SECONDS)
                 self.process_events()
             except Exception as e:
                 LOGGER.error("Error processing %s", e)
 
 
-if __name__ == "__main__":
+def monitor_forever():
+    """Refreshes pairs and gauges from the voter events, forever."""
     listener = EventListener()
     voter_monitor = VoterContractMonitor(
-        contract_address=VOTER_ADDRESS, node_endpoint=WEB3_PROVIDER_URI
+        contract_address=VOTER_ADDRESS,
+        node_endpoint=WEB3_PROVIDER_URI,
+        listener=listener,
     )
     voter_monitor.monitor()
+
+
+if __name__ == "__main__":
+    monitor_forever()